@@ -0,0 +1,147 @@
+import math
+
+import numpy as np
+
+from store import (
+    AGGREGATE_GROUPS,
+    AVERAGE_BINS,
+    AVERAGE_BINS_PER_POINT,
+    COHORT_KEYSPACE,
+    MAX_HISTOGRAM_GRADE,
+    Keyspace,
+    average_bin,
+    compute_aggregate_sums,
+    get_averages,
+    get_group_average,
+    grade_bin,
+    iter_courses,
+    watched_transaction,
+)
+
+# One histogram bin per grade, see store.grade_bin
+GRADE_BINS = MAX_HISTOGRAM_GRADE + 1
+PERCENTILES = (10, 25, 50, 75, 90)
+
+
+def _histogram(hash_values, bins):
+    # Values outside the bins (written before they were clamped) are
+    # counted in the first or last one rather than dropped
+    histogram = np.zeros(bins, dtype=np.int64)
+    for value, count in hash_values.items():
+        histogram[min(max(int(value), 0), bins - 1)] += int(count)
+    return histogram
+
+
+def histogram_percentile(cumulative, percentile):
+    """Return the bin holding the ``percentile``-th value (nearest rank), from cumulative counts."""
+    rank = max(math.ceil(percentile / 100 * cumulative[-1]), 1)
+    return int(np.searchsorted(cumulative, rank))
+
+
+def describe_distribution(course_name, grade_counts):
+    """Return the histogram, mean and percentiles of {grade: count}, or None if empty.
+
+    Grades below 0 or above 100 count as 0 or 100, in the mean as well.
+    """
+    histogram = _histogram(grade_counts, GRADE_BINS)
+    count = int(histogram.sum())
+    if count == 0:
+        return None
+    cumulative = np.cumsum(histogram)
+    return {
+        "course_name": course_name,
+        "count": count,
+        "mean": float(np.arange(GRADE_BINS) @ histogram / count),
+        "percentiles": {str(p): histogram_percentile(cumulative, p) for p in PERCENTILES},
+        "histogram": histogram.tolist(),
+    }
+
+
+def percentile_rank(average, student_bin, bin_counts):
+    """Return ``average`` with its percentile rank, given the student's bin and {bin: students}.
+
+    The rank is the share of students with a lower average plus half of
+    those in the same bin, so no population is sorted.
+    """
+    histogram = _histogram(bin_counts, AVERAGE_BINS)
+    students = int(histogram.sum())
+    below = int(histogram[:student_bin].sum())
+    return {
+        **average,
+        "percentile": float(100 * (below + histogram[student_bin] / 2) / students),
+        "students": students,
+        "bin_width": 1 / AVERAGE_BINS_PER_POINT,
+    }
+
+
+async def grade_distribution(client, course_name, cohort=COHORT_KEYSPACE):
+    """Return the grade histogram and percentiles of a course across all students.
+
+    Reads one 101-field hash; returns None if no student has the course.
+    """
+    return describe_distribution(course_name, await client.hgetall(cohort.histogram(course_name)))
+
+
+async def average_rank(client, keyspace):
+    """Return a student's weighted average and its percentile rank in the cohort.
+
+    The rank is read off the cohort histogram of averages (see
+    percentile_rank). Returns None if the student has no credits.
+    """
+    pipe = client.pipeline(transaction=False)
+    pipe.get(keyspace.average_bin)
+    pipe.hgetall(keyspace.cohort.average_bins)
+    student_bin, bins = await pipe.execute()
+    average = await get_group_average(client, keyspace, "total", "all")
+    if student_bin is None or average is None:
+        return None
+    return percentile_rank(average, int(student_bin), bins)
+
+
+async def rebuild_cohort(client, cohort=COHORT_KEYSPACE):
+    """Recompute every cohort statistic from the courses of its students.
+
+    Students are those ever written to (the ``students`` set). The courses
+    are read under WATCH of that set and of every student's version, and
+    read again if a write commits before the statistics are replaced.
+    """
+    async def write(pipe):
+        prefixes = sorted(await pipe.smembers(cohort.students))
+        keyspaces = [Keyspace(prefix, cohort=cohort) for prefix in prefixes]
+        if keyspaces:
+            await pipe.watch(*(keyspace.version for keyspace in keyspaces))
+        totals = {group: {} for group in AGGREGATE_GROUPS}
+        histograms = {}
+        student_bins = {}
+        for keyspace in keyspaces:
+            courses = [course async for _, course in iter_courses(client, keyspace)]
+            sums = compute_aggregate_sums(courses)
+            student_bins[keyspace] = average_bin(sums["total"].get("all", {"count": 0, "credits": 0}))
+            for group in AGGREGATE_GROUPS:
+                for key, group_sums in sums[group].items():
+                    target = totals[group].setdefault(key, dict.fromkeys(group_sums, 0.0))
+                    for metric, value in group_sums.items():
+                        target[metric] += value
+            for course in courses:
+                counts = histograms.setdefault(course["course_name"], {})
+                grade = grade_bin(course["course_grade"])
+                counts[grade] = counts.get(grade, 0) + 1
+
+        stale = [key async for key in client.scan_iter(match=cohort.histogram("*"))]
+        pipe.multi()
+        pipe.delete(cohort.average_bins, *(cohort.averages(group) for group in AGGREGATE_GROUPS), *stale)
+        for group in AGGREGATE_GROUPS:
+            mapping = {f"{key}:{metric}": value for key, sums in totals[group].items() for metric, value in sums.items()}
+            if mapping:
+                pipe.hset(cohort.averages(group), mapping=mapping)
+        for course_name, counts in histograms.items():
+            pipe.hset(cohort.histogram(course_name), mapping=counts)
+        for keyspace, student_bin in student_bins.items():
+            if student_bin is None:
+                pipe.delete(keyspace.average_bin)
+            else:
+                pipe.set(keyspace.average_bin, student_bin)
+                pipe.hincrby(cohort.average_bins, student_bin, 1)
+
+    await watched_transaction(client, [cohort.students], write)
+    return await get_averages(client, cohort)
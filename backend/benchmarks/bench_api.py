@@ -0,0 +1,276 @@
+"""Latency percentiles and throughput of every API route, as JSON.
+
+Usage:
+    python benchmarks/bench_api.py --output results.json
+    python benchmarks/bench_api.py --students 100 --courses 40 --concurrency 32
+    python benchmarks/bench_api.py --baseline results.json   # compare with an earlier run
+    python benchmarks/bench_api.py --storage sqlite --output sqlite.json --baseline results.json
+    python benchmarks/bench_api.py --base-url http://localhost:8080
+
+The app is driven in-process through ASGI, backed by fakeredis, unless
+--redis-url (a real Redis, flushed first), --storage sqlite (a database
+file in a temporary directory) or --base-url (a running server) is given. Synthetic transcripts are seeded through the batch endpoint,
+then each scenario sends --requests requests from --concurrency clients.
+The same --seed gives the same transcripts and request order.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import numpy as np
+from common import instrument_redis, make_client, synthetic_courses
+
+SEED_BATCH_SIZE = 500
+
+
+def student_path(student, path=""):
+    return f"/students/s{student}{path}"
+
+
+def scenarios(students, ids, course_names, rng):
+    """Return (name, request factory, response hook) triples, in the order they are run.
+
+    A factory takes the request number and returns (student, method, path,
+    json). Scenarios that change data run last, delete removing what
+    create added.
+    """
+    created = []
+
+    def any_student():
+        return rng.randrange(students)
+
+    def any_course():
+        student = any_student()
+        return student, rng.choice(ids[student])
+
+    def get(i):
+        student, item_id = any_course()
+        return student, "GET", student_path(student, f"/courses/{item_id}"), None
+
+    def student_get(path):
+        def factory(i):
+            student = any_student()
+            return student, "GET", student_path(student, path), None
+        return factory
+
+    def cohort_get(path):
+        return lambda i: (None, "GET", path, None)
+
+    def distribution(i):
+        return None, "GET", f"/cohort/courses/{rng.choice(course_names)}/distribution", None
+
+    def create(i):
+        student = any_student()
+        return student, "POST", student_path(student, "/courses/"), synthetic_courses(1, seed=i)[0]
+
+    def created_course(student, response):
+        if response.status_code == 200:
+            created.append((student, response.json()["id"]))
+
+    def update(i):
+        student, item_id = any_course()
+        return student, "PUT", student_path(student, f"/courses/{item_id}"), synthetic_courses(1, seed=i)[0]
+
+    def delete(i):
+        student, item_id = created[i % len(created)]
+        return student, "DELETE", student_path(student, f"/courses/{item_id}"), None
+
+    def simulate(i):
+        student, item_id = any_course()
+        body = {"overrides": [{"id": item_id, "course_grade": 100}], "new_courses": []}
+        return student, "POST", student_path(student, "/simulations"), body
+
+    return [
+        ("get", get, None),
+        ("list", student_get("/courses"), None),
+        ("list_page", student_get("/courses?limit=20"), None),
+        ("list_filtered", student_get("/courses?course_year=2024&min_grade=80"), None),
+        ("export", student_get("/courses/export"), None),
+        ("average_year", student_get("/courses/average-year"), None),
+        ("averages", student_get("/averages"), None),
+        ("averages_total", student_get("/averages/total"), None),
+        ("rank", student_get("/rank"), None),
+        ("cohort_averages", cohort_get("/cohort/averages"), None),
+        ("cohort_distribution", distribution, None),
+        ("simulate", simulate, None),
+        ("create", create, created_course),
+        ("update", update, None),
+        # Only runs when create did, and sends at most as many requests
+        ("delete", delete, None),
+    ], created
+
+
+async def seed(http, students, courses_per_student, rng):
+    """Create the transcripts through the API.
+
+    Returns the course ids per student and the names of the seeded courses.
+    """
+    ids = []
+    course_names = set()
+    for student in range(students):
+        courses = synthetic_courses(courses_per_student, seed=rng.randrange(2**32))
+        course_names.update(course["course_name"] for course in courses)
+        student_ids = []
+        for start in range(0, len(courses), SEED_BATCH_SIZE):
+            response = await http.post(student_path(student, "/courses/batch"), json=courses[start:start + SEED_BATCH_SIZE])
+            response.raise_for_status()
+            student_ids += [result["id"] for result in response.json()["results"]]
+        ids.append(student_ids)
+    return ids, sorted(course_names)
+
+
+async def run_scenario(http, factory, on_response, requests, concurrency):
+    latencies = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def client():
+        nonlocal errors
+        for i in counter:
+            student, method, path, body = factory(i)
+            start = time.perf_counter()
+            response = await http.request(method, path, json=body)
+            latencies.append(time.perf_counter() - start)
+            errors += response.status_code >= 400
+            if on_response is not None:
+                on_response(student, response)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "requests": requests,
+        "errors": errors,
+        "seconds": round(elapsed, 4),
+        "throughput_rps": round(requests / elapsed, 1),
+        "latency_ms": {
+            "p50": round(float(np.percentile(latencies_ms, 50)), 3),
+            "p95": round(float(np.percentile(latencies_ms, 95)), 3),
+            "p99": round(float(np.percentile(latencies_ms, 99)), 3),
+            "mean": round(float(latencies_ms.mean()), 3),
+            "max": round(float(latencies_ms.max()), 3),
+        },
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """Print, per scenario, how p95 latency and throughput moved against ``baseline``."""
+    print(f"{'scenario':>20} {'p95 ms':>10} {'change':>8} {'req/s':>9} {'change':>8}", file=sys.stderr)
+    for name, result in results["results"].items():
+        before = baseline["results"].get(name)
+        p95, rps = result["latency_ms"]["p95"], result["throughput_rps"]
+        if before is None:
+            print(f"{name:>20} {p95:>10.3f} {'new':>8} {rps:>9.1f} {'new':>8}", file=sys.stderr)
+            continue
+        p95_change = (p95 / before["latency_ms"]["p95"] - 1) * 100 if before["latency_ms"]["p95"] else 0.0
+        rps_change = (rps / before["throughput_rps"] - 1) * 100 if before["throughput_rps"] else 0.0
+        print(f"{name:>20} {p95:>10.3f} {p95_change:>+7.1f}% {rps:>9.1f} {rps_change:>+7.1f}%", file=sys.stderr)
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    backend = database_directory = None
+    if args.base_url:
+        http = httpx.AsyncClient(base_url=args.base_url, timeout=60)
+    else:
+        import main as backend
+        import storage
+
+        if args.storage == "sqlite":
+            import sqlite_store
+
+            database_directory = tempfile.TemporaryDirectory()
+            backend.storage = sqlite_store.SQLiteStorage(os.path.join(database_directory.name, "bench.db"))
+        else:
+            backend.storage = storage.RedisStorage(make_client(args.redis_url, args.max_connections))
+            await backend.storage.client.flushdb()
+        http = httpx.AsyncClient(transport=httpx.ASGITransport(app=backend.app), base_url="http://bench", timeout=60)
+
+    results = {}
+    async with http:
+        ids, course_names = await seed(http, args.students, args.courses, rng)
+        named, created = scenarios(args.students, ids, course_names, rng)
+        selected = set(args.scenarios.split(",")) if args.scenarios else None
+        with instrument_redis(args.latency):
+            for name, factory, on_response in named:
+                if selected is not None and name not in selected:
+                    continue
+                requests = min(args.requests, len(created)) if name == "delete" else args.requests
+                if requests == 0:
+                    continue
+                results[name] = await run_scenario(http, factory, on_response, requests, args.concurrency)
+                print(f"{name:>20}: p50 {results[name]['latency_ms']['p50']:.2f} ms, "
+                      f"p99 {results[name]['latency_ms']['p99']:.2f} ms, "
+                      f"{results[name]['throughput_rps']:.0f} req/s", file=sys.stderr)
+
+    if backend is not None:
+        if database_directory is None:
+            await backend.storage.client.flushdb()
+        await backend.storage.close()
+    if database_directory is not None:
+        database_directory.cleanup()
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "target": args.base_url or args.redis_url or f"in-process app + {'sqlite' if args.storage == 'sqlite' else 'fakeredis'}",
+            "students": args.students,
+            "courses_per_student": args.courses,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "redis_latency": args.latency,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--students", type=int, default=20)
+    parser.add_argument("--courses", type=int, default=40, help="courses per student")
+    parser.add_argument("--requests", type=int, default=1000, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added per Redis round-trip (in-process only)")
+    parser.add_argument("--max-connections", type=int, default=50)
+    parser.add_argument("--scenarios", help="comma-separated subset of scenarios to run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--storage", choices=["redis", "sqlite"], default="redis", help="backend of the in-process app")
+    parser.add_argument("--redis-url", help="run the in-process app against a real Redis (flushed)")
+    parser.add_argument("--base-url", help="benchmark a running server instead of the in-process app")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="JSON report of an earlier run to compare with")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(report + "\n")
+    else:
+        print(report)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            compare(results, json.load(baseline))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Compare the legacy KEYS + GET read path with the indexed bulk reader.
+
+Usage:
+    python benchmarks/bench_bulk_read.py                      # fakeredis
+    python benchmarks/bench_bulk_read.py --redis-url redis://localhost:6379/15
+
+Round-trips are counted at the connection level, so the numbers are the same
+against fakeredis and a real redis-server; latency is only meaningful on the
+latter. The target database is flushed before every run.
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from common import SAMPLE_COURSE, instrument_redis, make_client
+
+from store import DEFAULT_KEYSPACE, SCAN_CHUNK_SIZE, create_course, iter_courses
+
+
+async def seed_legacy(client, size):
+    await client.flushdb()
+    pipe = client.pipeline(transaction=False)
+    value = json.dumps(SAMPLE_COURSE)
+    for i in range(size):
+        pipe.set(f"course_id_{i}", value)
+        if len(pipe) >= 10000:
+            await pipe.execute()
+    await pipe.execute()
+
+
+async def seed_indexed(client, size):
+    await client.flushdb()
+    for i in range(size):
+        await create_course(client, DEFAULT_KEYSPACE, f"course_id_{i}", SAMPLE_COURSE)
+
+
+async def read_legacy(client):
+    return [json.loads(await client.get(key)) for key in await client.keys()]
+
+
+async def read_bulk(client, chunk_size):
+    return [course async for _, course in iter_courses(client, DEFAULT_KEYSPACE, chunk_size=chunk_size)]
+
+
+async def measure(read, client, *args):
+    with instrument_redis() as counter:
+        start = time.perf_counter()
+        courses = await read(client, *args)
+        elapsed = time.perf_counter() - start
+    return len(courses), counter["round_trips"], elapsed
+
+
+async def run(args):
+    client = make_client(args.redis_url)
+    print(f"{'courses':>8} {'path':>7} {'round-trips':>12} {'seconds':>9}")
+    for size in args.sizes:
+        runs = [("bulk", seed_indexed, read_bulk, (args.chunk_size,))]
+        if not args.skip_legacy:
+            runs.insert(0, ("legacy", seed_legacy, read_legacy, ()))
+        for name, seed, read, extra in runs:
+            await seed(client, size)
+            count, round_trips, elapsed = await measure(read, client, *extra)
+            assert count == size, f"{name} read {count} of {size} courses"
+            print(f"{size:>8} {name:>7} {round_trips:>12} {elapsed:>9.3f}")
+    await client.flushdb()
+    await client.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--chunk-size", type=int, default=SCAN_CHUNK_SIZE)
+    parser.add_argument("--redis-url", help="benchmark a real Redis instead of fakeredis")
+    parser.add_argument("--skip-legacy", action="store_true", help="only run the bulk engine")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
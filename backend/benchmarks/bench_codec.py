@@ -0,0 +1,69 @@
+"""Size and decode throughput of the course storage codecs.
+
+Usage:
+    python benchmarks/bench_codec.py
+    python benchmarks/bench_codec.py --redis-url redis://localhost:6379/15
+
+Value sizes are computed locally. With --redis-url the courses are also
+written to Redis and MEMORY USAGE is sampled per key, which includes Redis'
+own per-key overhead. The target database is flushed.
+"""
+import argparse
+import asyncio
+import time
+
+from common import make_client, synthetic_courses
+
+from codec import CODECS, decode_course
+from store import DEFAULT_KEYSPACE
+
+
+async def redis_memory_per_course(client, values, sample):
+    await client.flushdb()
+    pipe = client.pipeline(transaction=False)
+    for i, value in enumerate(values):
+        pipe.set(DEFAULT_KEYSPACE.course(f"course_id_{i}"), value)
+    await pipe.execute()
+    pipe = client.pipeline(transaction=False)
+    for i in range(min(sample, len(values))):
+        pipe.memory_usage(DEFAULT_KEYSPACE.course(f"course_id_{i}"))
+    usages = await pipe.execute()
+    await client.flushdb()
+    return sum(usages) / len(usages)
+
+
+async def run(args):
+    courses = synthetic_courses(args.courses)
+    client = make_client(args.redis_url) if args.redis_url else None
+
+    print(f"{'codec':>7} {'bytes/value':>12} {'redis bytes/key':>16} {'decodes/s':>11}")
+    for name, codec in CODECS.items():
+        encoded = [codec.encode(course) for course in courses]
+        # Values come back from Redis as str (see codec.CLIENT_OPTIONS)
+        stored = [value.decode("utf-8", "surrogateescape") if isinstance(value, bytes) else value for value in encoded]
+        size = sum(len(value.encode() if isinstance(value, str) else value) for value in encoded) / len(encoded)
+
+        start = time.perf_counter()
+        for value in stored:
+            decode_course(value)
+        rate = len(stored) / (time.perf_counter() - start)
+
+        memory = "-"
+        if client is not None:
+            memory = f"{await redis_memory_per_course(client, encoded, args.sample):.1f}"
+        print(f"{name:>7} {size:>12.1f} {memory:>16} {rate:>11.0f}")
+
+    if client is not None:
+        await client.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--courses", type=int, default=100000)
+    parser.add_argument("--sample", type=int, default=1000, help="keys sampled with MEMORY USAGE")
+    parser.add_argument("--redis-url", help="also measure memory in a real Redis")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
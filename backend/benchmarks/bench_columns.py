@@ -0,0 +1,58 @@
+"""Aggregate query latency of the columnar course store.
+
+Usage:
+    python benchmarks/bench_columns.py
+    python benchmarks/bench_columns.py --courses 1000000 --subset 1000
+
+Courses are put straight into a ColumnStore (Redis is not involved), then
+every aggregate group is computed over the whole table and over a random
+subset of ids, and compared with the dict-based store.compute_aggregate_sums.
+"""
+import argparse
+import random
+import time
+
+from common import synthetic_courses
+
+from columns import ColumnStore
+from store import compute_aggregate_sums
+
+
+def timed(func, repeat):
+    """Return the result of func() and its median duration in milliseconds."""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        durations.append((time.perf_counter() - start) * 1000)
+    return result, sorted(durations)[len(durations) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--courses", type=int, default=1000000)
+    parser.add_argument("--subset", type=int, default=1000, help="ids in the restricted query")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    courses = synthetic_courses(args.courses)
+    ids = [f"course_id_{i}" for i in range(args.courses)]
+    column_store = ColumnStore()
+    start = time.perf_counter()
+    for item_id, course in zip(ids, courses):
+        column_store.put(item_id, course)
+    print(f"loaded {args.courses} courses in {time.perf_counter() - start:.2f} s")
+
+    subset = random.Random(0).sample(ids, min(args.subset, args.courses))
+    _, columnar = timed(column_store.group_sums, args.repeat)
+    _, dicts = timed(lambda: compute_aggregate_sums(courses), 1)
+    print(f"{'all courses':>20}: columnar {columnar:8.2f} ms   dict loop {dicts:8.2f} ms")
+
+    by_id = dict(zip(ids, courses))
+    _, columnar = timed(lambda: column_store.group_sums(column_store.select(subset)), args.repeat)
+    _, dicts = timed(lambda: compute_aggregate_sums(by_id[item_id] for item_id in subset), args.repeat)
+    print(f"{f'{len(subset)} ids':>20}: columnar {columnar:8.2f} ms   dict loop {dicts:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Throughput of concurrent GET requests through the ASGI app, in-process.
+
+Usage:
+    python benchmarks/bench_load.py --latency 0.002
+    python benchmarks/bench_load.py --redis-url redis://localhost:6379/15
+
+``--latency`` adds a delay to every Redis round-trip to stand in for the
+network. Each run is repeated in "blocking" mode, where the delay stalls the
+event loop the way the synchronous redis.Redis client used to, and in
+"async" mode, where requests overlap their Redis I/O.
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+from common import SAMPLE_COURSE, instrument_redis, make_client
+
+import main as backend
+import storage
+from store import DEFAULT_KEYSPACE, create_course
+
+
+async def seed(client, courses):
+    await client.flushdb()
+    ids = [f"course_id_{i}" for i in range(courses)]
+    for item_id in ids:
+        await create_course(client, DEFAULT_KEYSPACE, item_id, SAMPLE_COURSE)
+    return ids
+
+
+async def drive(http, paths, concurrency):
+    queue = list(reversed(paths))
+
+    async def worker():
+        while queue:
+            response = await http.get(queue.pop())
+            response.raise_for_status()
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+async def run(args):
+    client = make_client(args.redis_url, args.max_connections)
+    backend.storage = storage.RedisStorage(client)
+    ids = await seed(client, args.courses)
+    paths = [f"/courses/{ids[i % len(ids)]}" for i in range(args.requests)]
+    transport = httpx.ASGITransport(app=backend.app)
+
+    print(f"{'mode':>9} {'requests':>9} {'concurrency':>12} {'seconds':>9} {'req/s':>9}")
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+        for mode in ("blocking", "async"):
+            with instrument_redis(args.latency, blocking=mode == "blocking"):
+                start = time.perf_counter()
+                await drive(http, paths, args.concurrency)
+                elapsed = time.perf_counter() - start
+            print(f"{mode:>9} {args.requests:>9} {args.concurrency:>12} {elapsed:>9.3f} {args.requests / elapsed:>9.0f}")
+
+    await client.flushdb()
+    await backend.storage.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--courses", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.002, help="seconds added per Redis round-trip")
+    parser.add_argument("--max-connections", type=int, default=storage.REDIS_MAX_CONNECTIONS)
+    parser.add_argument("--redis-url", help="benchmark a real Redis instead of fakeredis")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Cold-start cost of a column store: scanning every course vs. snapshot + journal.
+
+Usage:
+    python benchmarks/bench_snapshot.py
+    python benchmarks/bench_snapshot.py --courses 100000 --tail 1000 --redis-url redis://localhost:6379/15
+
+Courses are stored through the batch writes, a snapshot is taken, and
+--tail more courses are written after it. The column store is then loaded
+by reading and decoding every course key, and from the snapshot file and
+the journal entries after it, and the Redis round-trips of each are
+counted. The target database is flushed.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from common import instrument_redis, make_client, synthetic_courses
+
+import journal
+import store
+from columns import ColumnStore
+
+BATCH_SIZE = 1000
+
+
+async def write(client, courses, first_id):
+    for start in range(0, len(courses), BATCH_SIZE):
+        batch = courses[start:start + BATCH_SIZE]
+        await store.create_courses(client, store.DEFAULT_KEYSPACE,
+                                   [(f"course_{first_id + start + i:08d}", course) for i, course in enumerate(batch)])
+
+
+async def timed_load(load):
+    with instrument_redis() as counter:
+        start = time.perf_counter()
+        column_store = await load()
+        elapsed = time.perf_counter() - start
+    return column_store, elapsed, counter["round_trips"]
+
+
+async def run(args):
+    client = make_client(args.redis_url)
+    await client.flushdb()
+    await write(client, synthetic_courses(args.courses), 0)
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        path = await journal.take_snapshot(client, store.DEFAULT_KEYSPACE, directory)
+        print(f"snapshot of {args.courses} courses written in {time.perf_counter() - start:.2f} s")
+        await write(client, synthetic_courses(args.tail, seed=1), args.courses)
+
+        scanned, scan_seconds, scan_trips = await timed_load(lambda: ColumnStore.load(client, store.DEFAULT_KEYSPACE))
+        replayed, replay_seconds, replay_trips = await timed_load(
+            lambda: journal.load_column_store(client, store.DEFAULT_KEYSPACE, directory)
+        )
+        size = os.path.getsize(path)
+    assert sorted(scanned.ids) == sorted(replayed.ids)
+    print(f"snapshot file: {size / 1e6:.1f} MB ({size / args.courses:.1f} bytes per course)")
+    print(f"{'scan every key':>24}: {scan_seconds * 1000:9.1f} ms {scan_trips:7} round-trips")
+    print(f"{f'snapshot + {args.tail} tail':>24}: {replay_seconds * 1000:9.1f} ms {replay_trips:7} round-trips")
+    await client.flushdb()
+    await client.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--courses", type=int, default=100000, help="courses in the snapshot")
+    parser.add_argument("--tail", type=int, default=1000, help="courses written after the snapshot")
+    parser.add_argument("--redis-url", help="use a real Redis (flushed) instead of fakeredis")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Requests per second of the production server for a range of worker counts.
+
+Usage:
+    python benchmarks/bench_workers.py
+    python benchmarks/bench_workers.py --workers 1,2,4,8 --redis-url redis://localhost:6379/15
+
+For each worker count the backend is started with gunicorn.conf.py (as in
+docker-compose), loaded over HTTP by concurrent clients for --duration
+seconds, and stopped with SIGTERM. Without --redis-url a fakeredis TCP
+server is started in this process; it is single-threaded, so use a real
+Redis to measure how the workers scale. The target database is flushed.
+"""
+import argparse
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+
+from common import SAMPLE_COURSE, make_client
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_fake_redis():
+    from fakeredis import TcpFakeServer
+
+    server = TcpFakeServer(("127.0.0.1", free_port()), server_type="redis")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    return f"redis://{host}:{port}/0"
+
+
+async def seed(redis_url, courses):
+    import store
+
+    client = make_client(redis_url)
+    await client.flushdb()
+    await store.create_courses(client, store.DEFAULT_KEYSPACE, [(f"course_{i}", SAMPLE_COURSE) for i in range(courses)])
+    await client.aclose()
+
+
+def start_server(workers, port, redis_url):
+    url = httpx.URL(redis_url)
+    env = {
+        **os.environ,
+        "WEB_CONCURRENCY": str(workers),
+        "PORT": str(port),
+        "REDIS_HOST": url.host,
+        "REDIS_PORT": str(url.port or 6379),
+        "ACCESS_LOG": "",
+    }
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "main:app", "-c", "gunicorn.conf.py"],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/averages/total").status_code == 200:
+                return process
+        except httpx.TransportError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"the server with {workers} workers did not start")
+
+
+def stop_server(process):
+    """Stop gracefully (SIGTERM) and return the seconds it took."""
+    start = time.perf_counter()
+    process.send_signal(signal.SIGTERM)
+    process.wait(timeout=60)
+    return time.perf_counter() - start
+
+
+async def load(base_url, path, concurrency, duration):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits) as client:
+        deadline = time.perf_counter() + duration
+        counts = {"ok": 0, "failed": 0}
+
+        async def worker():
+            while time.perf_counter() < deadline:
+                response = await client.get(path)
+                counts["ok" if response.status_code == 200 else "failed"] += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return counts, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", default=f"1,2,{os.cpu_count()}", help="comma-separated worker counts")
+    parser.add_argument("--path", default="/averages", help="route requested by every client")
+    parser.add_argument("--courses", type=int, default=1000, help="courses stored before the run")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--redis-url", help="Redis used by the workers (default: a fakeredis TCP server)")
+    args = parser.parse_args()
+
+    redis_url = args.redis_url or start_fake_redis()
+    asyncio.run(seed(redis_url, args.courses))
+    print(f"GET {args.path}, {args.concurrency} concurrent clients, {args.duration:.0f} s per run, {os.cpu_count()} CPUs")
+    print(f"{'workers':>7} {'req/s':>9} {'failed':>7} {'shutdown s':>11}")
+    for workers in sorted({int(count) for count in args.workers.split(",")}):
+        port = free_port()
+        process = start_server(workers, port, redis_url)
+        try:
+            counts, elapsed = asyncio.run(load(f"http://127.0.0.1:{port}", args.path, args.concurrency, args.duration))
+        finally:
+            shutdown = stop_server(process)
+        print(f"{workers:>7} {counts['ok'] / elapsed:>9.0f} {counts['failed']:>7} {shutdown:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Helpers shared by the benchmark scripts."""
+import asyncio
+import os
+import random
+import sys
+import time
+from contextlib import contextmanager
+
+import redis.asyncio.connection
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from codec import CLIENT_OPTIONS  # noqa: E402
+
+SAMPLE_COURSE = {
+    "course_name": "EASS",
+    "course_grade": 95,
+    "course_credit": 3.5,
+    "course_year": 2024,
+    "course_semester": "Semester A",
+}
+
+
+COURSE_NAMES = [
+    "Calculus 1", "Linear Algebra", "Data Structures", "Algorithms", "Operating Systems",
+    "Computer Networks", "Databases", "Deep Learning", "Data Science", "Software Engineering",
+]
+
+
+def synthetic_courses(count, seed=0):
+    """Return ``count`` plausible random courses; the same seed gives the same courses."""
+    rng = random.Random(seed)
+    return [
+        {
+            "course_name": f"{rng.choice(COURSE_NAMES)} {i}",
+            "course_grade": rng.randint(55, 100),
+            "course_credit": rng.choice([1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 5.0]),
+            "course_year": rng.randint(2018, 2025),
+            "course_semester": rng.choice(["Semester A", "Semester B", "Semester C"]),
+        }
+        for i in range(count)
+    ]
+
+
+def make_client(redis_url=None, max_connections=50):
+    """Return an asyncio client for ``redis_url``, or fakeredis when it is None."""
+    if redis_url:
+        pool = redis.asyncio.BlockingConnectionPool.from_url(
+            redis_url, max_connections=max_connections, **CLIENT_OPTIONS
+        )
+        return redis.asyncio.Redis(connection_pool=pool)
+    import fakeredis
+
+    return fakeredis.FakeAsyncRedis(**CLIENT_OPTIONS)
+
+
+@contextmanager
+def instrument_redis(latency=0.0, blocking=False):
+    """Count round-trips to Redis and optionally delay each one.
+
+    Every packet sent counts as one round-trip (a pipeline is one packet).
+    ``latency`` seconds are added per round-trip. With ``blocking`` the delay
+    is a time.sleep that stalls the event loop, which is how a synchronous
+    client behaves inside an ``async def`` handler.
+    """
+    counter = {"round_trips": 0}
+    connection_class = redis.asyncio.connection.AbstractConnection
+    original = connection_class.send_packed_command
+
+    async def send_packed_command(self, *args, **kwargs):
+        counter["round_trips"] += 1
+        if latency and blocking:
+            time.sleep(latency)
+        elif latency:
+            await asyncio.sleep(latency)
+        return await original(self, *args, **kwargs)
+
+    connection_class.send_packed_command = send_packed_command
+    try:
+        yield counter
+    finally:
+        connection_class.send_packed_command = original
@@ -0,0 +1,99 @@
+import json
+import os
+import struct
+
+# Semesters offered by the UI get a one-byte code; any other semester name
+# is stored as a length-prefixed string after the fixed-size header.
+SEMESTER_CODES = {"Semester A": 0, "Semester B": 1, "Semester C": 2}
+SEMESTERS = {code: semester for semester, code in SEMESTER_CODES.items()}
+CUSTOM_SEMESTER = 0xFF
+
+# 0xC1 can never start a UTF-8 string, so packed values are told apart from
+# JSON documents (which start with "{") by their first byte.
+PACKED_MAGIC = 0xC1
+# magic, semester code, grade, year, credit
+PACKED_HEADER = struct.Struct("<BBhHd")
+# Ranges of the header fields and of a custom semester's length prefix
+PACKED_GRADES = range(-2**15, 2**15)
+PACKED_YEARS = range(2**16)
+PACKED_SEMESTER_BYTES = 255
+
+
+class JsonCodec:
+    """The original format: one JSON document per course."""
+    name = "json"
+
+    def encode(self, course):
+        return json.dumps(course)
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class PackedCodec:
+    """A fixed 14-byte header followed by the UTF-8 course name.
+
+    Field names are not stored and the semester is a one-byte code, so a
+    course takes 14 bytes plus its name instead of ~130 bytes of JSON.
+    A course whose grade, year or semester does not fit the header is
+    written as JSON instead, which reads recognize just the same.
+    """
+    name = "packed"
+
+    def encode(self, course):
+        semester = course["course_semester"]
+        code = SEMESTER_CODES.get(semester, CUSTOM_SEMESTER)
+        if (course["course_grade"] not in PACKED_GRADES or course["course_year"] not in PACKED_YEARS
+                or (code == CUSTOM_SEMESTER and len(semester.encode()) > PACKED_SEMESTER_BYTES)):
+            return CODECS["json"].encode(course)
+        header = PACKED_HEADER.pack(
+            PACKED_MAGIC, code, course["course_grade"], course["course_year"], course["course_credit"]
+        )
+        if code == CUSTOM_SEMESTER:
+            semester_bytes = semester.encode()
+            header += bytes([len(semester_bytes)]) + semester_bytes
+        return header + course["course_name"].encode()
+
+    def decode(self, data):
+        _, code, grade, year, credit = PACKED_HEADER.unpack_from(data)
+        offset = PACKED_HEADER.size
+        if code == CUSTOM_SEMESTER:
+            length = data[offset]
+            semester = data[offset + 1:offset + 1 + length].decode()
+            offset += 1 + length
+        else:
+            semester = SEMESTERS[code]
+        return {
+            "course_name": data[offset:].decode(),
+            "course_grade": grade,
+            "course_credit": credit,
+            "course_year": year,
+            "course_semester": semester,
+        }
+
+
+CODECS = {codec.name: codec for codec in (JsonCodec(), PackedCodec())}
+
+# Codec used for writes; reads understand every codec regardless.
+COURSE_CODEC = CODECS[os.getenv("COURSE_CODEC", "json")]
+
+# Options every Redis client of the store must use: values come back as str,
+# and bytes that are not valid UTF-8 (packed values) survive the round-trip.
+CLIENT_OPTIONS = {"decode_responses": True, "encoding_errors": "surrogateescape"}
+
+
+def raw_bytes(value):
+    return value.encode("utf-8", "surrogateescape") if isinstance(value, str) else value
+
+
+def detect_codec(value):
+    return CODECS["packed"] if raw_bytes(value)[:1] == bytes([PACKED_MAGIC]) else CODECS["json"]
+
+
+def encode_course(course, codec=None):
+    return (codec or COURSE_CODEC).encode(course)
+
+
+def decode_course(value):
+    """Decode a stored course whatever codec it was written with."""
+    return detect_codec(value).decode(raw_bytes(value))
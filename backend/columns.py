@@ -0,0 +1,234 @@
+import asyncio
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+import metrics
+
+from store import AGGREGATE_GROUPS, get_version, iter_course_chunks
+
+INITIAL_CAPACITY = 1024
+
+# Number of keyspaces (students) kept loaded; the least recently queried
+# one is dropped beyond it and reloaded from Redis if queried again.
+MAX_LOADED_KEYSPACES = int(os.getenv("COLUMN_STORE_KEYSPACES", "256"))
+
+
+class ColumnStore:
+    """An in-memory, column-oriented copy of the courses of one keyspace.
+
+    Grades, credits, grade x credit, years and semester codes are kept in
+    parallel NumPy arrays, one row per course, with ``rows`` mapping a course
+    id to its row. Every distinct (year, semester) pair gets a group code, so
+    all the aggregate groups are computed with one ``np.bincount`` per metric
+    over the group codes, and then reduced over the few distinct pairs.
+
+    Deleting a course moves the last row into the freed one, so the arrays
+    stay dense and ``[:size]`` is always the full table.
+    """
+
+    def __init__(self, version=0, capacity=INITIAL_CAPACITY):
+        self.version = version
+        self.size = 0
+        self.ids = []
+        self.rows = {}
+        self.grade = np.zeros(capacity)
+        self.credit = np.zeros(capacity)
+        self.weighted = np.zeros(capacity)
+        self.year = np.zeros(capacity, dtype=np.int32)
+        self.semester = np.zeros(capacity, dtype=np.int32)
+        self.group = np.zeros(capacity, dtype=np.int32)
+        # Dictionary encoding of semesters and (year, semester) pairs
+        self.semesters = []
+        self.semester_codes = {}
+        self.pairs = []
+        self.pair_codes = {}
+
+    def _code(self, values, codes, value):
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(values)
+            values.append(value)
+        return code
+
+    def _grow(self):
+        capacity = 2 * len(self.grade)
+        for name in ("grade", "credit", "weighted", "year", "semester", "group"):
+            column = getattr(self, name)
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            setattr(self, name, grown)
+
+    def put(self, item_id, course):
+        """Insert or replace a course."""
+        row = self.rows.get(item_id)
+        if row is None:
+            if self.size == len(self.grade):
+                self._grow()
+            row = self.rows[item_id] = self.size
+            self.ids.append(item_id)
+            self.size += 1
+        year, semester = course["course_year"], course["course_semester"]
+        self.grade[row] = course["course_grade"]
+        self.credit[row] = course["course_credit"]
+        self.weighted[row] = course["course_grade"] * course["course_credit"]
+        self.year[row] = year
+        self.semester[row] = self._code(self.semesters, self.semester_codes, semester)
+        self.group[row] = self._code(self.pairs, self.pair_codes, (year, semester))
+
+    def remove(self, item_id):
+        row = self.rows.pop(item_id, None)
+        if row is None:
+            return
+        last = self.size - 1
+        last_id = self.ids.pop()
+        if row != last:
+            for column in (self.grade, self.credit, self.weighted, self.year, self.semester, self.group):
+                column[row] = column[last]
+            self.ids[row] = last_id
+            self.rows[last_id] = row
+        self.size = last
+
+    def apply(self, version, changes):
+        """Apply the changes of the write that produced ``version``.
+
+        Changes are applied only when they directly follow the version held;
+        after a gap (a write missed, e.g. made by another process) the store
+        is marked stale and reloaded on its next use. Applying a change
+        sets the course to its new state, so replaying one is harmless.
+        """
+        if self.version is None or version != self.version + 1:
+            self.version = None
+            return
+        for item_id, _, course in changes:
+            if course is None:
+                self.remove(item_id)
+            else:
+                self.put(item_id, course)
+        self.version = version
+
+    def select(self, item_ids):
+        """Return the rows of the given ids that are stored."""
+        rows = self.rows
+        return np.fromiter((rows[item_id] for item_id in item_ids if item_id in rows), dtype=np.intp)
+
+    def group_sums(self, rows=None):
+        """Return the aggregate sums of every group, as store.compute_aggregate_sums does.
+
+        ``rows`` restricts the sums to those rows (see ``select``).
+        """
+        n = self.size
+        group = self.group[:n] if rows is None else self.group[rows]
+
+        def column(values):
+            return values[:n] if rows is None else values[rows]
+
+        pairs = len(self.pairs)
+        # One row per (year, semester) pair, one column per metric
+        table = np.stack([
+            np.bincount(group, weights=column(self.weighted), minlength=pairs),
+            np.bincount(group, weights=column(self.credit), minlength=pairs),
+            np.bincount(group, weights=column(self.grade), minlength=pairs),
+            np.bincount(group, minlength=pairs).astype(float),
+        ], axis=1)
+
+        result = {group_name: {} for group_name in AGGREGATE_GROUPS}
+        present = table[:, 3] > 0
+        if not present.any():
+            return result
+        years = np.array([year for year, _ in self.pairs])
+        semesters = np.array([self.semester_codes[semester] for _, semester in self.pairs])
+
+        def add(group_name, key, sums):
+            result[group_name][key] = dict(zip(("weighted", "credits", "grades", "count"), sums.tolist()))
+
+        for code in np.flatnonzero(present):
+            year, semester = self.pairs[code]
+            add("year_semester", f"{year}_{semester}", table[code])
+        for year in np.unique(years[present]):
+            add("year", str(year), table[present & (years == year)].sum(axis=0))
+        for code in np.unique(semesters[present]):
+            add("semester", self.semesters[code], table[present & (semesters == code)].sum(axis=0))
+        add("total", "all", table[present].sum(axis=0))
+        return result
+
+    @classmethod
+    def from_columns(cls, version, ids, grade, credit, year, semester):
+        """Build a column store from whole columns (e.g. a snapshot) without a per-course loop."""
+        size = len(ids)
+        column_store = cls(version, capacity=max(size, INITIAL_CAPACITY))
+        column_store.size = size
+        column_store.ids = list(ids)
+        column_store.rows = dict(zip(column_store.ids, range(size)))
+        column_store.grade[:size] = grade
+        column_store.credit[:size] = credit
+        column_store.weighted[:size] = column_store.grade[:size] * column_store.credit[:size]
+        column_store.year[:size] = year
+        semesters, semester_codes = np.unique(np.asarray(semester, dtype=str), return_inverse=True)
+        column_store.semesters = semesters.tolist()
+        column_store.semester_codes = {name: code for code, name in enumerate(column_store.semesters)}
+        column_store.semester[:size] = semester_codes
+        pairs, pair_codes = np.unique(np.stack([column_store.year[:size], column_store.semester[:size]], axis=1),
+                                      axis=0, return_inverse=True)
+        column_store.pairs = [(int(pair_year), column_store.semesters[code]) for pair_year, code in pairs]
+        column_store.pair_codes = {pair: code for code, pair in enumerate(column_store.pairs)}
+        column_store.group[:size] = pair_codes.reshape(-1)
+        return column_store
+
+    @classmethod
+    async def load(cls, client, keyspace):
+        """Build a column store from every course of ``keyspace``.
+
+        The version is read before the courses, so a write made while they
+        are being read makes the store look stale rather than up to date.
+        """
+        column_store = cls(await get_version(client, keyspace))
+        async for chunk in iter_course_chunks(client, keyspace):
+            for item_id, course in chunk:
+                column_store.put(item_id, course)
+        return column_store
+
+
+class ColumnStores:
+    """The column stores of every loaded keyspace, kept in sync with writes.
+
+    ``apply`` is registered in store.WRITE_LISTENERS. Before each query the
+    data version in Redis is compared with the loaded one (one GET), so
+    writes made by other processes trigger a reload instead of stale answers.
+    Stores are (re)loaded with ``loader(client, keyspace)``.
+    """
+
+    def __init__(self, max_keyspaces=MAX_LOADED_KEYSPACES, loader=ColumnStore.load):
+        self.max_keyspaces = max_keyspaces
+        self.loader = loader
+        self.stores = OrderedDict()
+        self.locks = {}
+
+    def apply(self, keyspace, version, changes):
+        column_store = self.stores.get(keyspace)
+        if column_store is not None:
+            column_store.apply(version, changes)
+
+    async def get(self, client, keyspace):
+        version = await get_version(client, keyspace)
+        column_store = self.stores.get(keyspace)
+        hit = column_store is not None and column_store.version == version
+        metrics.cache_lookup("column_store", hit)
+        if hit:
+            self.stores.move_to_end(keyspace)
+            return column_store
+        lock = self.locks.setdefault(keyspace, asyncio.Lock())
+        async with lock:
+            column_store = self.stores.get(keyspace)
+            if column_store is None or column_store.version != version:
+                column_store = self.stores[keyspace] = await self.loader(client, keyspace)
+            self.stores.move_to_end(keyspace)
+        while len(self.stores) > self.max_keyspaces:
+            evicted, _ = self.stores.popitem(last=False)
+            self.locks.pop(evicted, None)
+        return column_store
+
+    def clear(self):
+        self.stores.clear()
+        self.locks.clear()
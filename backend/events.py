@@ -0,0 +1,116 @@
+"""Fan-out of the change events published by store writes.
+
+Every write publishes a JSON event on its keyspace's Redis channel (see
+store.change_event). Each worker process reads them over a single pub/sub
+connection and hands them to the Server-Sent Events streams it serves, so
+the number of open streams does not tie up Redis connections.
+"""
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+
+# Events buffered per stream. A client that falls this far behind gets a
+# reset event instead of the events it missed.
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "100"))
+# Seconds between keepalive comments on an idle stream, which also make
+# proxies keep the connection open and let clients detect a dead one.
+EVENT_KEEPALIVE = float(os.getenv("EVENT_KEEPALIVE", "15"))
+
+# Longest wait of the reader for a message, and so for it to notice close()
+READ_TIMEOUT = 1.0
+
+logger = logging.getLogger("grades.events")
+
+# Queued in place of the events a slow stream missed
+RESET = None
+
+
+def format_event(event, data):
+    """Return one Server-Sent Events message; ``data`` is a JSON string."""
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+def deliver(queue, data):
+    if queue.full():
+        while not queue.empty():
+            queue.get_nowait()
+        data = RESET
+    queue.put_nowait(data)
+
+
+class ChangeFeed:
+    """One pub/sub subscription per worker, shared by all the streams it serves.
+
+    A channel is subscribed while at least one stream follows it. The
+    reader task is bound to the client and event loop of the first
+    subscriber and is recreated if either changes.
+    """
+
+    def __init__(self, queue_size=EVENT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.client = None
+        self.loop = None
+        self.pubsub = None
+        self.reader = None
+        # channel -> queues of the streams following it
+        self.queues = {}
+
+    def _bind(self, client):
+        loop = asyncio.get_running_loop()
+        if self.pubsub is not None and self.client is client and self.loop is loop:
+            return
+        self.client, self.loop = client, loop
+        self.pubsub = client.pubsub(ignore_subscribe_messages=True)
+        self.reader = None
+        self.queues = {}
+
+    async def _read(self, pubsub):
+        # Runs until the feed lets go of ``pubsub``, rather than relying on
+        # cancellation alone, which the pub/sub read can swallow
+        while self.pubsub is pubsub:
+            try:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=READ_TIMEOUT)
+            except Exception:
+                if self.pubsub is not pubsub:
+                    return
+                # The connection is reestablished and resubscribed by the
+                # next read; streams may have missed events meanwhile.
+                logger.exception("Change feed read failed")
+                for queues in self.queues.values():
+                    for queue in queues:
+                        deliver(queue, RESET)
+                await asyncio.sleep(1)
+                continue
+            if message is not None and message["type"] == "message":
+                for queue in self.queues.get(message["channel"], ()):
+                    deliver(queue, message["data"])
+
+    @asynccontextmanager
+    async def subscribe(self, client, channel):
+        """Yield a queue receiving the events of ``channel`` (RESET after an overflow)."""
+        self._bind(client)
+        queue = asyncio.Queue(self.queue_size)
+        queues = self.queues.setdefault(channel, set())
+        if not queues:
+            await self.pubsub.subscribe(channel)
+        queues.add(queue)
+        if self.reader is None:
+            self.reader = asyncio.create_task(self._read(self.pubsub))
+        try:
+            yield queue
+        finally:
+            queues.discard(queue)
+            if not queues and self.queues.get(channel) is queues:
+                del self.queues[channel]
+                await self.pubsub.unsubscribe(channel)
+
+    async def close(self):
+        pubsub, reader = self.pubsub, self.reader
+        self.client = self.loop = self.pubsub = self.reader = None
+        self.queues = {}
+        if reader is not None:
+            reader.cancel()
+            await asyncio.wait([reader], timeout=READ_TIMEOUT * 2)
+        if pubsub is not None:
+            await pubsub.aclose()
@@ -0,0 +1,30 @@
+"""Production server settings: ``gunicorn main:app -c gunicorn.conf.py``.
+
+Gunicorn supervises a pool of uvicorn worker processes. The app is not
+preloaded, so each worker imports main.py itself and its lifespan hook
+opens a Redis connection pool owned by that worker; no socket is ever
+shared across a fork.
+"""
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+worker_class = "uvicorn_worker.UvicornWorker"
+# One asyncio worker per core is enough; each one serves many requests at once.
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+preload_app = False
+
+# On SIGTERM workers stop accepting connections and get graceful_timeout
+# seconds to finish in-flight requests and run the lifespan shutdown
+# (closing the Redis pool) before they are killed.
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+timeout = int(os.getenv("WORKER_TIMEOUT", "60"))
+keepalive = int(os.getenv("KEEPALIVE", "5"))
+
+# Restart workers after this many requests (0 disables), with jitter so
+# they do not all restart at once.
+max_requests = int(os.getenv("MAX_REQUESTS", "0"))
+max_requests_jitter = max_requests // 10
+
+accesslog = os.getenv("ACCESS_LOG", "-") or None
+errorlog = "-"
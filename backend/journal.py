@@ -0,0 +1,239 @@
+"""Snapshots of a keyspace's courses, and replay of the journal written since.
+
+Every write appends the courses it leaves behind to the keyspace's journal
+stream (see store.journal_entry). A snapshot is a compressed NumPy ``.npz``
+file with one column per course field, together with the id of the last
+journal entry it covers; the journal is trimmed up to that entry once the
+file is written. The current courses are the snapshot plus the journal
+entries after it, which is how column stores are loaded and aggregates
+rebuilt without reading and decoding every course key.
+
+Usage (in the backend container):
+    python journal.py snapshot [--student alice]
+    python journal.py restore [--student alice]   # into an empty keyspace
+    python journal.py rebuild [--student alice]   # the aggregates
+"""
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+import store
+from columns import ColumnStore
+from store import COHORT_KEYSPACE, DEFAULT_KEYSPACE, SCAN_CHUNK_SIZE, Keyspace
+
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "snapshots")
+# Seconds between snapshots of every keyspace written to since its last
+# one; 0 turns the periodic snapshots off.
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "300"))
+# Held by the process taking the periodic snapshots, so that of several
+# workers only one takes them
+SNAPSHOT_LOCK = "grades:snapshot_lock"
+
+logger = logging.getLogger("grades.journal")
+
+
+def snapshot_path(keyspace, directory=SNAPSHOT_DIR):
+    return os.path.join(directory, keyspace.prefix.replace(":", "_") + ".npz")
+
+
+def _next_id(entry_id):
+    # The smallest stream id after entry_id
+    milliseconds, sequence = entry_id.split("-")
+    return f"{milliseconds}-{int(sequence) + 1}"
+
+
+async def take_snapshot(client, keyspace, directory=SNAPSHOT_DIR):
+    """Write every course of ``keyspace`` to its snapshot file and trim the journal.
+
+    The last journal entry is read before the courses. Courses written
+    while they are read may or may not be in the file, but their entries
+    come after that one, and replaying them sets each course to its latest
+    state either way. Returns the path of the file.
+    """
+    last = await client.xrevrange(keyspace.journal, count=1)
+    journal_id = last[0][0] if last else "0-0"
+    version = await store.get_version(client, keyspace)
+    columns = {field: [] for field in ("id", *store.COURSE_FIELDS)}
+    async for chunk in store.iter_course_chunks(client, keyspace):
+        for item_id, course in chunk:
+            columns["id"].append(item_id)
+            for field in store.COURSE_FIELDS:
+                columns[field].append(course[field])
+
+    os.makedirs(directory, exist_ok=True)
+    path = snapshot_path(keyspace, directory)
+    # Written next to the old file and renamed over it, so a crash never
+    # leaves a partial snapshot behind
+    with tempfile.NamedTemporaryFile(dir=directory, suffix=".npz", delete=False) as temporary:
+        np.savez_compressed(
+            temporary,
+            journal_id=np.array(journal_id),
+            version=np.array(version),
+            id=np.array(columns["id"], dtype=str),
+            course_name=np.array(columns["course_name"], dtype=str),
+            course_grade=np.array(columns["course_grade"], dtype=np.int64),
+            course_credit=np.array(columns["course_credit"], dtype=np.float64),
+            course_year=np.array(columns["course_year"], dtype=np.int64),
+            course_semester=np.array(columns["course_semester"], dtype=str),
+        )
+    os.replace(temporary.name, path)
+    if last:
+        await client.xtrim(keyspace.journal, minid=_next_id(journal_id), approximate=False)
+    return path
+
+
+def read_snapshot(keyspace, directory=SNAPSHOT_DIR):
+    """Return the snapshot's columns by name (with ``journal_id`` and ``version``), or None."""
+    try:
+        with np.load(snapshot_path(keyspace, directory)) as snapshot:
+            columns = {name: snapshot[name] for name in snapshot.files}
+    except FileNotFoundError:
+        return None
+    columns["journal_id"] = str(columns["journal_id"])
+    columns["version"] = int(columns["version"])
+    return columns
+
+
+async def iter_journal(client, keyspace, after="0-0", chunk_size=SCAN_CHUNK_SIZE):
+    """Yield the (id, course or None) pairs of every journal entry after ``after``, in order."""
+    while True:
+        entries = await client.xrange(keyspace.journal, f"({after}", "+", count=chunk_size)
+        for entry_id, fields in entries:
+            for item_id, course in store.read_journal_entry(fields):
+                yield item_id, course
+        if len(entries) < chunk_size:
+            return
+        after = entries[-1][0]
+
+
+async def load_column_store(client, keyspace, directory=SNAPSHOT_DIR):
+    """Build the column store of ``keyspace`` from its snapshot and the journal since.
+
+    The version is read before the journal, so the store may be ahead of
+    it but never behind, and at worst is reloaded on its next use. Without
+    a snapshot or journal, or if the result disagrees with the number of
+    stored courses (a write was not journaled), the courses are read from
+    Redis.
+    """
+    snapshot = read_snapshot(keyspace, directory) if store.JOURNAL else None
+    if snapshot is None:
+        return await ColumnStore.load(client, keyspace)
+    column_store = ColumnStore.from_columns(
+        await store.get_version(client, keyspace), snapshot["id"], snapshot["course_grade"],
+        snapshot["course_credit"], snapshot["course_year"], snapshot["course_semester"],
+    )
+    async for item_id, course in iter_journal(client, keyspace, snapshot["journal_id"]):
+        if course is None:
+            column_store.remove(item_id)
+        else:
+            column_store.put(item_id, course)
+    if column_store.size != await client.zcard(keyspace.index):
+        logger.warning("Snapshot and journal of %s disagree with the stored courses", keyspace.prefix)
+        return await ColumnStore.load(client, keyspace)
+    return column_store
+
+
+async def rebuild_aggregates(client, keyspace, directory=SNAPSHOT_DIR):
+    """store.rebuild_aggregates from the snapshot and journal instead of every course key."""
+    async def compute_sums(client, keyspace):
+        return (await load_column_store(client, keyspace, directory)).group_sums()
+
+    return await store.rebuild_aggregates(client, keyspace, compute_sums)
+
+
+async def restore(client, keyspace, directory=SNAPSHOT_DIR):
+    """Write the courses of the snapshot, updated by the journal since, into an empty keyspace.
+
+    Returns the number of courses restored.
+    """
+    snapshot = read_snapshot(keyspace, directory)
+    if snapshot is None:
+        raise ValueError(f"No snapshot of {keyspace.prefix} in {directory}")
+    courses = {
+        item_id: {
+            "course_name": str(name),
+            "course_grade": int(grade),
+            "course_credit": float(credit),
+            "course_year": int(year),
+            "course_semester": str(semester),
+        }
+        for item_id, name, grade, credit, year, semester in zip(
+            snapshot["id"].tolist(), snapshot["course_name"], snapshot["course_grade"],
+            snapshot["course_credit"], snapshot["course_year"], snapshot["course_semester"],
+        )
+    }
+    async for item_id, course in iter_journal(client, keyspace, snapshot["journal_id"]):
+        if course is None:
+            courses.pop(item_id, None)
+        else:
+            courses[item_id] = course
+    return await store.restore_courses(client, keyspace, list(courses.items()))
+
+
+async def journaled_keyspaces(client):
+    """Return the shared keyspace and every student's, if written to since their last snapshot."""
+    prefixes = await client.smembers(COHORT_KEYSPACE.students)
+    keyspaces = [DEFAULT_KEYSPACE, *(Keyspace(prefix, cohort=COHORT_KEYSPACE) for prefix in sorted(prefixes))]
+    pipe = client.pipeline(transaction=False)
+    for keyspace in keyspaces:
+        pipe.xlen(keyspace.journal)
+    return [keyspace for keyspace, length in zip(keyspaces, await pipe.execute()) if length]
+
+
+async def snapshot_periodically(client, interval=SNAPSHOT_INTERVAL, directory=SNAPSHOT_DIR):
+    """Every ``interval`` seconds, snapshot each keyspace written to since its last snapshot.
+
+    Run as a task by each worker; the lock lets only one of them work per
+    interval.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if not await client.set(SNAPSHOT_LOCK, os.getpid(), nx=True, ex=max(int(interval), 1)):
+                continue
+            keyspaces = await journaled_keyspaces(client)
+        except Exception:
+            logger.exception("Snapshot failed")
+            continue
+        # One keyspace that cannot be snapshotted does not hold up the others
+        for keyspace in keyspaces:
+            try:
+                await take_snapshot(client, keyspace, directory)
+            except Exception:
+                logger.exception("Snapshot of %s failed", keyspace.prefix)
+
+
+async def run_command(command, redis_url, keyspace, directory):
+    import redis.asyncio as redis
+
+    client = redis.Redis.from_url(redis_url, **store.CLIENT_OPTIONS)
+    try:
+        if command == "snapshot":
+            print(f"Wrote {await take_snapshot(client, keyspace, directory)}")
+        elif command == "restore":
+            print(f"Restored {await restore(client, keyspace, directory)} courses")
+        elif command == "rebuild":
+            await rebuild_aggregates(client, keyspace, directory)
+            print("Aggregates rebuilt")
+        return 0
+    finally:
+        await client.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Course snapshots")
+    parser.add_argument("command", choices=["snapshot", "restore", "rebuild"])
+    parser.add_argument("--student", help="the student's keyspace instead of the shared one")
+    parser.add_argument("--redis-url", default=os.getenv("REDIS_URL", "redis://redis:6379/0"))
+    parser.add_argument("--directory", default=SNAPSHOT_DIR)
+    args = parser.parse_args()
+    keyspace = store.student_keyspace(args.student) if args.student else DEFAULT_KEYSPACE
+    raise SystemExit(asyncio.run(run_command(args.command, args.redis_url, keyspace, args.directory)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""Structured JSON logging that keeps I/O off the request path.
+
+Records are put on a queue by a QueueHandler (a cheap, non-blocking
+append) and written to stdout as one JSON object per line by a
+QueueListener thread. Extra fields are passed as ``extra={"fields": {...}}``.
+"""
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+
+import redis.asyncio
+
+import metrics
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Share of INFO/DEBUG records kept (warnings and errors are always kept).
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+# Request payloads may hold personal data and are large: off unless enabled.
+LOG_PAYLOADS = os.getenv("LOG_PAYLOADS", "").lower() in ("1", "true", "yes")
+
+logger = logging.getLogger("grades")
+request_logger = logging.getLogger("grades.request")
+
+# Counters of the request being served, see RequestStats
+request_stats = contextvars.ContextVar("request_stats", default=None)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep every WARNING and above, and a ``rate`` share of the rest."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or self.rate >= 1 or random.random() < self.rate
+
+
+class RequestStats:
+    """Redis round-trips and payload sizes of one request."""
+    __slots__ = ("redis_calls", "request_bytes", "response_bytes")
+
+    def __init__(self):
+        self.redis_calls = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+
+
+def count_redis_call():
+    stats = request_stats.get()
+    if stats is not None:
+        stats.redis_calls += 1
+
+
+class CountingConnection(redis.asyncio.Connection):
+    """Redis connection that counts its round-trips towards the current request."""
+
+    async def send_packed_command(self, command, check_health=True):
+        count_redis_call()
+        await super().send_packed_command(command, check_health)
+
+
+def configure_logging(level=LOG_LEVEL, sample_rate=LOG_SAMPLE_RATE, stream=None):
+    """Route the "grades" loggers through a queue; returns the started listener.
+
+    The caller stops the listener on shutdown, which flushes pending records.
+    """
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(JsonFormatter())
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(sample_rate))
+    logger.handlers[:] = [queue_handler]
+    logger.setLevel(level)
+    logger.propagate = False
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def log_payload(message, payload):
+    """Log a request payload at DEBUG, only when LOG_PAYLOADS is enabled."""
+    if LOG_PAYLOADS and logger.isEnabledFor(logging.DEBUG):
+        logger.debug(message, extra={"fields": {"payload": payload}})
+
+
+def route_template(scope):
+    """Return the matched route of a request with placeholders, e.g. /students/{student_id}/courses.
+
+    Taken from the route itself, so values in the path never matter. Routes
+    included under a prefix carry it in their path, except where FastAPI
+    includes routers lazily: the prefix is then on the included router the
+    request went through. None if no route matched.
+    """
+    route = scope.get("route")
+    if route is None:
+        return None
+    included = scope.get("fastapi", {}).get("included_router")
+    prefix = getattr(getattr(included, "include_context", None), "prefix", "")
+    return prefix + route.path
+
+
+class RequestLogMiddleware:
+    """Log one record per HTTP request: route, status, latency, Redis calls and sizes.
+
+    The same measurements feed the request metrics (see metrics.py), which
+    are never sampled. A plain ASGI middleware, so it adds no extra task
+    per request. Server errors are logged at ERROR and are therefore never
+    sampled out.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        status = 500
+        start = time.perf_counter()
+
+        async def receive_counted():
+            message = await receive()
+            stats.request_bytes += len(message.get("body", b""))
+            return message
+
+        async def send_counted(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                stats.response_bytes += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive_counted, send_counted)
+        finally:
+            latency = time.perf_counter() - start
+            request_stats.reset(token)
+            route = route_template(scope)
+            metrics.observe_request(
+                scope["method"], route or "unmatched", status, latency, stats.request_bytes, stats.response_bytes
+            )
+            level = logging.ERROR if status >= 500 else logging.INFO
+            if request_logger.isEnabledFor(level):
+                request_logger.log(level, "request", extra={"fields": {
+                    "method": scope["method"],
+                    "route": route or scope["path"],
+                    "status": status,
+                    "latency_ms": round(latency * 1000, 3),
+                    "redis_calls": stats.redis_calls,
+                    "request_bytes": stats.request_bytes,
+                    "response_bytes": stats.response_bytes,
+                }})
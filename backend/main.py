@@ -1,14 +1,43 @@
+import asyncio
+import base64
+import binascii
+import csv
+import io
 import json
-from fastapi import FastAPI, HTTPException
+import re
+from contextlib import asynccontextmanager
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi import HTTPException
 import uuid
-import redis
-from dataclasses import dataclass, asdict
-from typing import List
+from dataclasses import dataclass, asdict, field
+from typing import List, Literal, Optional
+import events
+import logs
+import metrics
+import simulation
+import store
+from storage import open_storage
+from store import COURSE_FIELDS, DEFAULT_KEYSPACE, Keyspace
 
-app = FastAPI()
-r = redis.Redis(host="redis", port=6379, db=0)
+# The configured backend (see storage.py), created by the lifespan hook so
+# its connections belong to the server's event loop.
+storage = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global storage
+    log_listener = logs.configure_logging()
+    storage = open_storage()
+    storage.start()
+    yield
+    await storage.close()
+    log_listener.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 # Enable CORS
@@ -17,8 +46,13 @@ app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor"],
 )
 
+app.add_middleware(metrics.ProfileMiddleware)
+# Added last, so it is outermost and the logged latency covers every other middleware
+app.add_middleware(logs.RequestLogMiddleware)
+
 @dataclass
 class Course:
     course_name: str
@@ -30,87 +64,402 @@ class Course:
     def to_dict(self):
         return asdict(self)
 
-@app.post("/courses/")
-def create_course(course: Course):
-    new_course = json.dumps(course.to_dict())
+@dataclass
+class CourseUpdate(Course):
+    id: str
+
+    def to_dict(self):
+        course = asdict(self)
+        del course["id"]
+        return course
+
+@dataclass
+class GradeOverride:
+    id: str
+    course_grade: int
+
+@dataclass
+class Scenario:
+    overrides: List[GradeOverride] = field(default_factory=list)
+    new_courses: List[Course] = field(default_factory=list)
+
+@dataclass
+class TargetQuery:
+    target: float
+    # Either the id of a stored course or a hypothetical new course
+    id: Optional[str] = None
+    course: Optional[Course] = None
+    group: Literal["total", "year", "semester", "year_semester"] = "total"
+    overrides: List[GradeOverride] = field(default_factory=list)
+    new_courses: List[Course] = field(default_factory=list)
+
+# Student ids become part of Redis key names, so they are kept to a safe alphabet.
+STUDENT_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+def course_keyspace(request: Request):
+    """Return the keyspace of the student in the path, or the shared one.
+
+    Every route below is served both at its own path, on the shared
+    keyspace, and under /students/{student_id}, on that student's keyspace.
+    """
+    student_id = request.path_params.get("student_id")
+    if student_id is None:
+        return DEFAULT_KEYSPACE
+    if not STUDENT_ID_PATTERN.fullmatch(student_id):
+        raise HTTPException(status_code=422, detail="Invalid student id")
+    return store.student_keyspace(student_id)
+
+router = APIRouter()
+
+@router.post("/courses/")
+async def create_course(course: Course, keyspace: Keyspace = Depends(course_keyspace)):
+    new_course = course.to_dict()
     item_id = str(uuid.uuid4())
 
-    # Log the received data
-    print("Received data for new course:")
-    print(new_course)
+    logs.log_payload("Received data for new course", new_course)
 
     try:
-        # Attempt to add the course to Redis
-        r.set(item_id, new_course)
-        return {"id": item_id}
+        # Attempt to add the course with its index entries and aggregates
+        await storage.create_courses(keyspace, [(item_id, new_course)])
+        return {"id": item_id, **new_course}
     except Exception as e:
-        # Log any errors
-        print(f"Error occurred while adding course: {e}")
+        logs.logger.exception("Error occurred while adding course")
         raise HTTPException(status_code=500, detail=f"Error occurred while adding course: {e}")
     
     
-@app.put("/courses/{item_id}")
-async def update_course(item_id: str, course: Course):
+@router.post("/courses/batch")
+async def create_courses(courses: List[Course], keyspace: Keyspace = Depends(course_keyspace)):
+    items = [(str(uuid.uuid4()), course.to_dict()) for course in courses]
     try:
-        print("Received item_id:", item_id)
-        print("Received course data:", course)
+        await storage.create_courses(keyspace, items)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error occurred while adding courses: {e}")
+    return {"results": [{"id": item_id, "status": "created"} for item_id, _ in items]}
 
-        new_course = json.dumps(course.to_dict())
-        r.set(item_id, new_course)
+@router.put("/courses/batch")
+async def update_courses(courses: List[CourseUpdate], keyspace: Keyspace = Depends(course_keyspace)):
+    items = [(course.id, course.to_dict()) for course in courses]
+    try:
+        statuses = await storage.update_courses(keyspace, items)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error occurred while updating courses: {e}")
+    return {"results": [{"id": item_id, "status": status} for (item_id, _), status in zip(items, statuses)]}
+
+@router.delete("/courses/batch")
+async def delete_courses(item_ids: List[str], keyspace: Keyspace = Depends(course_keyspace)):
+    try:
+        deleted = await storage.delete_courses(keyspace, item_ids)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to delete courses: {e}")
+    return {"results": [
+        {"id": item_id, "status": "deleted" if was_deleted else "not_found"}
+        for item_id, was_deleted in zip(item_ids, deleted)
+    ]}
+
+@router.put("/courses/{item_id}")
+async def update_course(item_id: str, course: Course, keyspace: Keyspace = Depends(course_keyspace)):
+    try:
+        logs.log_payload("Received course update", {"id": item_id, **course.to_dict()})
+
+        await storage.update_courses(keyspace, [(item_id, course.to_dict())])
 
         return {"update": "success"}
     except Exception as e:
-        print("An error occurred during course update:", e)
+        logs.logger.exception("An error occurred during course update")
         return {"update": "failed", "error": str(e)}
 
 
 
-@app.delete("/courses/{item_id}")
-async def delete_course(item_id: str):
+@router.delete("/courses/{item_id}")
+async def delete_course(item_id: str, keyspace: Keyspace = Depends(course_keyspace)):
     try:
-        if r.exists(item_id):
-            r.delete(item_id)
-            return {"message": "Course deleted successfully"}
-        else:
-            raise HTTPException(status_code=404, detail="Course not found")
+        deleted = (await storage.delete_courses(keyspace, [item_id]))[0]
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to delete course: {str(e)}")
+    if not deleted:
+        raise HTTPException(status_code=404, detail="Course not found")
+    return {"message": "Course deleted successfully"}
     
 
 
-@app.get("/courses/{item_id}")
-async def get_course(item_id: str):
-    course = r.get(item_id)
-    return {"course": json.loads(course)}
+async def check_etag(request, response, keyspace):
+    """Tag the response with the data version, or return a 304 if the client has it.
+
+    The version changes on every write, so one weak ETag is valid for every
+    read URL at once.
+    """
+    etag = f'W/"{await storage.get_version(keyspace)}"'
+    client_etags = [tag.strip().removeprefix("W/") for tag in request.headers.get("if-none-match", "").split(",")]
+    hit = etag.removeprefix("W/") in client_etags or "*" in client_etags
+    if "if-none-match" in request.headers:
+        metrics.cache_lookup("etag", hit)
+    if hit:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return None
+
+def encode_cursor(item_id):
+    return base64.urlsafe_b64encode(item_id.encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        return base64.b64decode(cursor.encode(), altchars=b"-_", validate=True).decode()
+    except (binascii.Error, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def course_filter(min_grade, max_grade, name_prefix):
+    if min_grade is None and max_grade is None and not name_prefix:
+        return None
 
-@app.get("/courses")
-async def get_all_courses():
-    courses = r.keys()
+    def matches(course):
+        grade = course["course_grade"]
+        return ((min_grade is None or grade >= min_grade)
+                and (max_grade is None or grade <= max_grade)
+                and (not name_prefix or course["course_name"].startswith(name_prefix)))
+    return matches
+
+@router.get("/courses")
+async def get_all_courses(
+    request: Request,
+    response: Response,
+    course_year: Optional[int] = None,
+    course_semester: Optional[str] = None,
+    min_grade: Optional[int] = None,
+    max_grade: Optional[int] = None,
+    name_prefix: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    keyspace: Keyspace = Depends(course_keyspace),
+):
+    # Year and semester select an index; the remaining filters are applied
+    # to the courses read from it. With a limit, the id to resume from is
+    # returned in the X-Next-Cursor header.
+    not_modified = await check_etag(request, response, keyspace)
+    if not_modified:
+        return not_modified
+    predicate = course_filter(min_grade, max_grade, name_prefix)
     res = []
-    for key in courses:
-        course_data = json.loads(r.get(key))
-        course_data["id"] = key
+    if limit is None and cursor is None:
+        async for chunk in storage.iter_course_chunks(keyspace, course_year, course_semester):
+            for item_id, course_data in chunk:
+                if predicate is None or predicate(course_data):
+                    course_data["id"] = item_id
+                    res.append(course_data)
+        return res
+
+    after = decode_cursor(cursor) if cursor else None
+    page, last_id = await storage.get_course_page(
+        keyspace, course_year, course_semester, limit or store.SCAN_CHUNK_SIZE, after, predicate
+    )
+    for item_id, course_data in page:
+        course_data["id"] = item_id
         res.append(course_data)
+    if last_id is not None:
+        response.headers["X-Next-Cursor"] = encode_cursor(last_id)
     return res
 
-@app.get("/courses/average-year")
-async def get_average_year():
-    courses = r.keys()
-    year_semester_grades = {}
-    for key in courses:
-        course_data = json.loads(r.get(key))
-        year = course_data["course_year"]
-        semester = course_data["course_semester"]
-        grade = course_data["course_grade"]
-        year_semester = f"{year}_{semester}"
-        if year_semester not in year_semester_grades:
-            year_semester_grades[year_semester] = {"grades": [], "count": 0}
-        year_semester_grades[year_semester]["grades"].append(grade)
-        year_semester_grades[year_semester]["count"] += 1
+async def export_ndjson(keyspace, course_year, course_semester):
+    async for chunk in storage.iter_course_chunks(keyspace, course_year, course_semester):
+        yield "".join(json.dumps({**course_data, "id": item_id}) + "\n" for item_id, course_data in chunk)
+
+async def export_csv(keyspace, course_year, course_semester):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(("id",) + COURSE_FIELDS)
+    async for chunk in storage.iter_course_chunks(keyspace, course_year, course_semester):
+        writer.writerows((item_id,) + tuple(course_data[field] for field in COURSE_FIELDS) for item_id, course_data in chunk)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+@router.get("/courses/export")
+async def export_courses(request: Request, response: Response, format: Literal["ndjson", "csv"] = "ndjson", course_year: Optional[int] = None, course_semester: Optional[str] = None, keyspace: Keyspace = Depends(course_keyspace)):
+    # Courses are written out one index page at a time, so memory use does
+    # not grow with the number of stored courses.
+    not_modified = await check_etag(request, response, keyspace)
+    if not_modified:
+        return not_modified
+    if format == "csv":
+        return StreamingResponse(export_csv(keyspace, course_year, course_semester), media_type="text/csv",
+                                 headers={"Content-Disposition": "attachment; filename=courses.csv", **response.headers})
+    return StreamingResponse(export_ndjson(keyspace, course_year, course_semester), media_type="application/x-ndjson", headers=response.headers)
+
+@router.get("/courses/average-year")
+async def get_average_year(request: Request, response: Response, keyspace: Keyspace = Depends(course_keyspace)):
+    not_modified = await check_etag(request, response, keyspace)
+    if not_modified:
+        return not_modified
+    return await average_year(keyspace)
 
+async def average_year(keyspace):
+    # Plain (unweighted) mean grade per year and semester
+    year_semester_sums = (await storage.read_aggregate_sums(keyspace))["year_semester"]
     average_grades = {}
-    for year_semester, data in year_semester_grades.items():
-        average_grade = sum(data["grades"]) / data["count"]
-        average_grades[year_semester] = average_grade
+    for year_semester, sums in year_semester_sums.items():
+        if sums["count"] > 0:
+            average_grades[year_semester] = sums["grades"] / sums["count"]
     return average_grades
 
+@router.get("/courses/{item_id}")
+async def get_course(item_id: str, keyspace: Keyspace = Depends(course_keyspace)):
+    course = await storage.get_course(keyspace, item_id)
+    if course is None:
+        raise HTTPException(status_code=404, detail="Course not found")
+    return {"course": course}
+
+
+def split_list(values):
+    # Repeated items count once, e.g. a course listed twice in ids
+    return list(dict.fromkeys(item for value in values for item in value.split(",") if item))
+
+def parse_groups(group_by):
+    groups = split_list(group_by) if group_by is not None else store.AGGREGATE_GROUPS
+    unknown = set(groups) - set(store.AGGREGATE_GROUPS)
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Unknown group_by values: {', '.join(sorted(unknown))}")
+    return groups
+
+@router.get("/averages")
+async def get_averages(request: Request, response: Response, group_by: Optional[List[str]] = Query(None), ids: Optional[List[str]] = Query(None), keyspace: Keyspace = Depends(course_keyspace)):
+    # group_by picks the groups to return (total is always included);
+    # ids restricts the averages to the listed courses.
+    not_modified = await check_etag(request, response, keyspace)
+    if not_modified:
+        return not_modified
+    return await storage.get_averages(keyspace, parse_groups(group_by), split_list(ids) if ids is not None else None)
+
+@router.get("/averages/total")
+async def get_total_average(keyspace: Keyspace = Depends(course_keyspace)):
+    return await storage.get_group_average(keyspace, "total", "all") or store.empty_average()
+
+@router.get("/averages/check")
+async def check_averages(keyspace: Keyspace = Depends(course_keyspace)):
+    drift = await storage.check_aggregates(keyspace)
+    return {"consistent": not drift, "drift": drift}
+
+@router.post("/averages/rebuild")
+async def rebuild_averages(keyspace: Keyspace = Depends(course_keyspace)):
+    return await storage.rebuild_aggregates(keyspace)
+
+@router.get("/averages/year/{year}")
+async def get_year_average(year: int, keyspace: Keyspace = Depends(course_keyspace)):
+    return await group_average_or_404(keyspace, "year", str(year))
+
+@router.get("/averages/semester/{semester}")
+async def get_semester_average(semester: str, keyspace: Keyspace = Depends(course_keyspace)):
+    return await group_average_or_404(keyspace, "semester", semester)
+
+@router.get("/averages/year/{year}/semester/{semester}")
+async def get_year_semester_average(year: int, semester: str, keyspace: Keyspace = Depends(course_keyspace)):
+    return await group_average_or_404(keyspace, "year_semester", f"{year}_{semester}")
+
+async def group_average_or_404(keyspace, group, key):
+    average = await storage.get_group_average(keyspace, group, key)
+    if average is None:
+        raise HTTPException(status_code=404, detail=f"No courses for {group} {key}")
+    return average
+
+async def scenario_sums(keyspace, overrides, new_courses):
+    grades = {override.id: override.course_grade for override in overrides}
+    if len(grades) != len(overrides):
+        raise HTTPException(status_code=422, detail="A scenario may not override the same course twice")
+    try:
+        return await simulation.apply_scenario(storage, keyspace, grades, [course.to_dict() for course in new_courses])
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@router.post("/simulations")
+async def simulate(scenario: Scenario, keyspace: Keyspace = Depends(course_keyspace)):
+    # Nothing is written: the scenario is applied to a copy of the aggregates
+    sums = await scenario_sums(keyspace, scenario.overrides, scenario.new_courses)
+    return store.format_averages(sums)
+
+@router.post("/simulations/target")
+async def solve_target(query: TargetQuery, keyspace: Keyspace = Depends(course_keyspace)):
+    if (query.id is None) == (query.course is None):
+        raise HTTPException(status_code=422, detail="Give exactly one of id or course")
+    sums = await scenario_sums(keyspace, query.overrides, query.new_courses)
+    if query.id is not None:
+        stored_course = await storage.get_course(keyspace, query.id)
+        if stored_course is None:
+            raise HTTPException(status_code=404, detail="Course not found")
+        grade = next((override.course_grade for override in query.overrides if override.id == query.id), None)
+        if grade is not None:
+            stored_course = {**stored_course, "course_grade": grade}
+        course = stored_course
+    else:
+        stored_course = None
+        course = query.course.to_dict()
+    try:
+        return simulation.solve_min_grade(sums, course, query.group, query.target, stored_course)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+async def event_stream(keyspace):
+    async with storage.subscribe(keyspace) as queue:
+        # Sent once subscribed, so every later write reaches the client as an
+        # event; it tells whether the client's copy is current.
+        version = await storage.get_version(keyspace)
+        yield events.format_event("version", json.dumps({"version": version}))
+        while True:
+            try:
+                data = await asyncio.wait_for(queue.get(), events.EVENT_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            if data is events.RESET:
+                yield events.format_event("reset", "{}")
+            else:
+                yield events.format_event("change", data)
+
+@router.get("/events")
+async def stream_events(keyspace: Keyspace = Depends(course_keyspace)):
+    # Server-Sent Events: a "version" event, then a "change" event per write
+    # (see store.change_event). After a "reset" event, or a version gap,
+    # events were missed and the client should fetch the data again.
+    return StreamingResponse(event_stream(keyspace), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+app.include_router(router)
+app.include_router(router, prefix="/students/{student_id}")
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+# Cohort statistics span the courses of every student (the shared,
+# unprefixed collection is not part of the cohort).
+@app.get("/cohort/averages")
+async def get_cohort_averages(group_by: Optional[List[str]] = Query(None)):
+    return await storage.get_averages(store.COHORT_KEYSPACE, parse_groups(group_by))
+
+@app.get("/cohort/average-year")
+async def get_cohort_average_year():
+    return await average_year(store.COHORT_KEYSPACE)
+
+@app.get("/cohort/courses/{course_name}/distribution")
+async def get_course_distribution(course_name: str):
+    distribution = await storage.grade_distribution(course_name)
+    if distribution is None:
+        raise HTTPException(status_code=404, detail="No student has this course")
+    return distribution
+
+@app.post("/cohort/rebuild")
+async def rebuild_cohort():
+    return await storage.rebuild_cohort()
+
+@app.get("/students/{student_id}/rank")
+async def get_student_rank(keyspace: Keyspace = Depends(course_keyspace)):
+    rank = await storage.average_rank(keyspace)
+    if rank is None:
+        raise HTTPException(status_code=404, detail="The student has no courses")
+    return rank
@@ -0,0 +1,183 @@
+"""In-process metrics rendered in the Prometheus text exposition format.
+
+Each worker process keeps its own counters; with several workers every
+scrape of /metrics reports the worker that served it (see the ``pid``
+line), so scrape each worker or run one worker per scrape target.
+"""
+import bisect
+import cProfile
+import io
+import os
+import pstats
+import time
+from urllib.parse import parse_qs
+
+import redis.asyncio
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+REDIS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+# Lets a request ask for its own cProfile report with ?profile=1. The
+# profiler sees every coroutine running meanwhile, so keep it off in
+# production.
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "").lower() in ("1", "true", "yes")
+PROFILE_LINES = 40
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}" if pairs else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.label_names = name, help, labels
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield f"{self.name}{_labels(self.label_names, labels)} {value}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.label_names = name, help, labels
+        self.buckets = buckets
+        # labels -> [count per bucket (+Inf last), sum]
+        self.values = {}
+
+    def observe(self, value, *labels):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        for labels, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{_labels(self.label_names, labels, [('le', bound)])} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.label_names, labels)} {total}"
+            yield f"{self.name}_count{_labels(self.label_names, labels)} {cumulative}"
+
+
+HTTP_REQUESTS = Counter("http_requests_total", "HTTP requests served.", ("method", "route", "status"))
+HTTP_LATENCY = Histogram("http_request_duration_seconds", "Time to serve an HTTP request.", ("method", "route"))
+HTTP_REQUEST_SIZE = Histogram("http_request_size_bytes", "Request body sizes.", ("route",), SIZE_BUCKETS)
+HTTP_RESPONSE_SIZE = Histogram("http_response_size_bytes", "Response body sizes.", ("route",), SIZE_BUCKETS)
+REDIS_COMMANDS = Counter("redis_commands_total", "Redis commands sent, pipelined ones included.", ("command",))
+REDIS_LATENCY = Histogram(
+    "redis_call_duration_seconds", "Time of a Redis call: one command, or one whole pipeline.", ("command",), REDIS_BUCKETS
+)
+CACHE_REQUESTS = Counter("cache_requests_total", "Cache lookups by outcome.", ("cache", "result"))
+
+METRICS = (HTTP_REQUESTS, HTTP_LATENCY, HTTP_REQUEST_SIZE, HTTP_RESPONSE_SIZE, REDIS_COMMANDS, REDIS_LATENCY, CACHE_REQUESTS)
+
+
+def render():
+    lines = [f"# pid {os.getpid()}"]
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+def observe_request(method, route, status, seconds, request_bytes, response_bytes):
+    HTTP_REQUESTS.inc(method, route, str(status))
+    HTTP_LATENCY.observe(seconds, method, route)
+    HTTP_REQUEST_SIZE.observe(request_bytes, route)
+    HTTP_RESPONSE_SIZE.observe(response_bytes, route)
+
+
+def cache_lookup(cache, hit):
+    CACHE_REQUESTS.inc(cache, "hit" if hit else "miss")
+
+
+def _command_name(args):
+    name = args[0]
+    return (name.decode() if isinstance(name, bytes) else str(name)).upper()
+
+
+class InstrumentedPipeline(redis.asyncio.client.Pipeline):
+    async def immediate_execute_command(self, *args, **options):
+        # Commands run while WATCHing, before MULTI
+        start = time.perf_counter()
+        try:
+            return await super().immediate_execute_command(*args, **options)
+        finally:
+            command = _command_name(args)
+            REDIS_COMMANDS.inc(command)
+            REDIS_LATENCY.observe(time.perf_counter() - start, command)
+
+    async def execute(self, raise_on_error=True):
+        for args, _ in self.command_stack:
+            REDIS_COMMANDS.inc(_command_name(args))
+        start = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            REDIS_LATENCY.observe(time.perf_counter() - start, "MULTI" if self.is_transaction else "PIPELINE")
+
+
+class InstrumentedRedis(redis.asyncio.Redis):
+    """Redis client that counts and times every command and pipeline."""
+
+    async def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            command = _command_name(args)
+            REDIS_COMMANDS.inc(command)
+            REDIS_LATENCY.observe(time.perf_counter() - start, command)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class ProfileMiddleware:
+    """With PROFILING_ENABLED, answer ``?profile=1`` requests with a cProfile report.
+
+    The request runs normally under the profiler; its response is
+    discarded and replaced by the stats sorted by cumulative time.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not (PROFILING_ENABLED and scope["type"] == "http"
+                and parse_qs(scope["query_string"].decode()).get("profile") == ["1"]):
+            await self.app(scope, receive, send)
+            return
+
+        async def discard(message):
+            pass
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await self.app(scope, receive, discard)
+        finally:
+            profiler.disable()
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(PROFILE_LINES)
+        body = report.getvalue().encode()
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"text/plain; charset=utf-8"), (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
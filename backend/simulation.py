@@ -0,0 +1,59 @@
+import copy
+import math
+
+import store
+
+# Tolerance used when rounding the exact required grade up to an integer.
+GRADE_EPSILON = 1e-9
+
+
+async def apply_scenario(storage, keyspace, overrides, new_courses):
+    """Return aggregate sums as they would be after a hypothetical scenario.
+
+    ``overrides`` maps stored course ids to a new grade and ``new_courses``
+    lists courses that are not stored. Only the running aggregates and the
+    overridden courses are read from ``storage``; nothing is written.
+    Raises LookupError naming the ids that do not exist.
+    """
+    sums = await storage.read_aggregate_sums(keyspace)
+    stored = dict(await storage.get_courses(keyspace, list(overrides)))
+    missing = [item_id for item_id in overrides if item_id not in stored]
+    if missing:
+        raise LookupError(f"Courses not found: {', '.join(missing)}")
+
+    for item_id, grade in overrides.items():
+        store.add_to_sums(sums, stored[item_id], -1)
+        store.add_to_sums(sums, {**stored[item_id], "course_grade": grade})
+    for course in new_courses:
+        store.add_to_sums(sums, course)
+    return sums
+
+
+def solve_min_grade(sums, course, group, target, stored_course=None):
+    """Return the lowest integer grade in ``course`` reaching ``target``.
+
+    The weighted average of ``group`` is (W + credit * grade) / (C + credit),
+    where W and C are the group's sums without the course (``stored_course``
+    is its currently stored version, if any). Solving for the grade gives the
+    answer in closed form.
+    """
+    sums = copy.deepcopy(sums)
+    if stored_course is not None:
+        store.add_to_sums(sums, stored_course, -1)
+    key = store.aggregate_keys(course)[group]
+    group_sums = sums[group].get(key, dict.fromkeys(store.AGGREGATE_METRICS, 0.0))
+    credit = course["course_credit"]
+    if credit <= 0:
+        raise ValueError("The course must have a positive credit to change an average")
+
+    exact = (target * (group_sums["credits"] + credit) - group_sums["weighted"]) / credit
+    min_grade = max(0, math.ceil(exact - GRADE_EPSILON))
+    achievable = min_grade <= 100
+    return {
+        "group": group,
+        "key": key,
+        "target": target,
+        "exact_grade": exact,
+        "min_grade": min_grade if achievable else None,
+        "achievable": achievable,
+    }
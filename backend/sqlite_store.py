@@ -0,0 +1,472 @@
+"""Courses in an embedded SQLite database, behind the same interface as RedisStorage.
+
+For running without a Redis server (STORAGE_BACKEND=sqlite): everything
+lives in one database file, in WAL mode so that readers never block the
+writer, and several worker processes can share it. Courses are rows of one
+table keyed by (keyspace, id), with indexes per year, per semester and per
+year + semester that list ids in the same order as the Redis sorted sets.
+Nothing is precomputed: aggregates, cohort histograms and ranks are
+GROUP BY queries over those indexes, so they can never drift.
+
+The data version and a log of the changes made by recent writes are kept
+in tables written in each write's own transaction, so a write costs as
+much as the rows it changes. /events streams poll the log and build the
+change events from it, so they see the writes of every process.
+
+Queries run on one connection in a dedicated thread, keeping the event
+loop free while SQLite works.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+
+import analytics
+import events
+import store
+from store import AGGREGATE_GROUPS, AGGREGATE_METRICS, COHORT_KEYSPACE, COURSE_FIELDS, SCAN_CHUNK_SIZE
+
+SQLITE_PATH = os.getenv("SQLITE_PATH", "grades.db")
+# Seconds a write waits for another process's write to the file to finish
+SQLITE_BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", "5"))
+# Seconds between reads of the change log while a stream follows a keyspace
+EVENT_POLL_INTERVAL = float(os.getenv("EVENT_POLL_INTERVAL", "0.5"))
+# Change events kept per keyspace; a stream further behind gets a reset event
+EVENT_LOG_SIZE = int(os.getenv("EVENT_LOG_SIZE", "1000"))
+
+logger = logging.getLogger("grades.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS courses (
+    keyspace TEXT NOT NULL,
+    id TEXT NOT NULL,
+    course_name TEXT NOT NULL,
+    course_grade INTEGER NOT NULL,
+    course_credit REAL NOT NULL,
+    course_year INTEGER NOT NULL,
+    course_semester TEXT NOT NULL,
+    PRIMARY KEY (keyspace, id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS courses_by_year ON courses (keyspace, course_year, id);
+CREATE INDEX IF NOT EXISTS courses_by_semester ON courses (keyspace, course_semester, id);
+CREATE INDEX IF NOT EXISTS courses_by_year_semester ON courses (keyspace, course_year, course_semester, id);
+CREATE INDEX IF NOT EXISTS courses_by_name ON courses (course_name, course_grade);
+CREATE TABLE IF NOT EXISTS versions (
+    keyspace TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS change_events (
+    keyspace TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    changes TEXT NOT NULL,
+    PRIMARY KEY (keyspace, version)
+) WITHOUT ROWID;
+"""
+
+COURSE_COLUMNS = ", ".join(COURSE_FIELDS)
+SUMS = "SUM(course_grade * course_credit), SUM(course_credit), SUM(course_grade), COUNT(*)"
+# (group, key) expressions of each aggregate group, see store.aggregate_keys
+GROUP_KEYS = {
+    "total": ("'all'", None),
+    "year": ("CAST(course_year AS TEXT)", "course_year"),
+    "semester": ("course_semester", "course_semester"),
+    "year_semester": ("course_year || '_' || course_semester", "course_year, course_semester"),
+}
+
+# Every student's keyspace, which is what the cohort spans
+STUDENTS = store.student_keyspace("*").prefix
+
+
+def _scope(keyspace):
+    """Return the WHERE condition selecting the courses of ``keyspace``, and its parameter."""
+    if keyspace == COHORT_KEYSPACE:
+        return "keyspace GLOB ?", STUDENTS
+    return "keyspace = ?", keyspace.prefix
+
+
+def _sums(row):
+    return dict(zip(AGGREGATE_METRICS, (float(value or 0) for value in row)))
+
+
+def _course(row):
+    return dict(zip(COURSE_FIELDS, row))
+
+
+def connect(path=SQLITE_PATH):
+    db = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+    db.execute("PRAGMA journal_mode = WAL")
+    # Durable at every checkpoint rather than every commit; safe from
+    # corruption either way in WAL mode
+    db.execute("PRAGMA synchronous = NORMAL")
+    db.executescript(SCHEMA)
+    return db
+
+
+@contextmanager
+def _transaction(db):
+    # IMMEDIATE takes the write lock up front, so reads made inside the
+    # transaction cannot be invalidated by another process's write
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
+
+class SQLiteStorage:
+    """Courses in a SQLite database file; see the module docstring."""
+
+    def __init__(self, path=SQLITE_PATH):
+        self.db = connect(path)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self.feed = ChangeLog(self)
+
+    def start(self):
+        pass
+
+    async def close(self):
+        await self.feed.close()
+        await self._run(self.db.close)
+        self.executor.shutdown()
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    # Reads
+
+    def _get_version(self, keyspace):
+        row = self.db.execute("SELECT version FROM versions WHERE keyspace = ?", (keyspace.prefix,)).fetchone()
+        return row[0] if row else 0
+
+    async def get_version(self, keyspace):
+        return await self._run(self._get_version, keyspace)
+
+    def _get_courses(self, keyspace, item_ids):
+        rows = self.db.execute(
+            f"SELECT id, {COURSE_COLUMNS} FROM courses WHERE keyspace = ? AND id IN (SELECT value FROM json_each(?))",
+            (keyspace.prefix, json.dumps(item_ids)),
+        )
+        found = {row[0]: _course(row[1:]) for row in rows}
+        return [(item_id, found[item_id]) for item_id in item_ids if item_id in found]
+
+    async def get_courses(self, keyspace, item_ids):
+        if not item_ids:
+            return []
+        return await self._run(self._get_courses, keyspace, item_ids)
+
+    async def get_course(self, keyspace, item_id):
+        courses = await self.get_courses(keyspace, [item_id])
+        return courses[0][1] if courses else None
+
+    def _read_chunk(self, keyspace, course_year, course_semester, chunk_size, after):
+        conditions, params = ["keyspace = ?"], [keyspace.prefix]
+        for column, value in (("course_year", course_year), ("course_semester", course_semester)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if after is not None:
+            conditions.append("id > ?")
+            params.append(after)
+        rows = self.db.execute(
+            f"SELECT id, {COURSE_COLUMNS} FROM courses WHERE {' AND '.join(conditions)} ORDER BY id LIMIT ?",
+            (*params, chunk_size),
+        )
+        return [(row[0], _course(row[1:])) for row in rows]
+
+    async def iter_course_chunks(self, keyspace, course_year=None, course_semester=None, chunk_size=SCAN_CHUNK_SIZE, after=None):
+        """Yield lists of (id, course_data) pairs in id order, one query per list."""
+        while True:
+            chunk = await self._run(self._read_chunk, keyspace, course_year, course_semester, chunk_size, after)
+            if chunk:
+                yield chunk
+            if len(chunk) < chunk_size:
+                return
+            after = chunk[-1][0]
+
+    async def get_course_page(self, keyspace, course_year=None, course_semester=None, limit=SCAN_CHUNK_SIZE, after=None, predicate=None):
+        items = []
+        async for chunk in self.iter_course_chunks(keyspace, course_year, course_semester, limit, after):
+            for item_id, course in chunk:
+                if predicate is None or predicate(course):
+                    items.append((item_id, course))
+                    if len(items) == limit:
+                        return items, item_id
+        return items, None
+
+    # Aggregates
+
+    def _read_sums(self, keyspace, item_ids=None):
+        """Return {group: {key: sums}} with one GROUP BY per aggregate group, in one statement."""
+        condition, param = _scope(keyspace)
+        params = [param]
+        if item_ids is not None:
+            condition += " AND id IN (SELECT value FROM json_each(?))"
+            params.append(json.dumps(item_ids))
+        selects = [
+            f"SELECT '{group}', {key}, {SUMS} FROM courses WHERE {condition}"
+            + (f" GROUP BY {group_by}" if group_by else "")
+            for group, (key, group_by) in GROUP_KEYS.items()
+        ]
+        sums = {group: {} for group in AGGREGATE_GROUPS}
+        for group, key, *row in self.db.execute(" UNION ALL ".join(selects), params * len(selects)):
+            group_sums = _sums(row)
+            if group_sums["count"] > 0:
+                sums[group][key] = group_sums
+        return sums
+
+    async def read_aggregate_sums(self, keyspace):
+        return await self._run(self._read_sums, keyspace)
+
+    def _group_sums(self, keyspace, group, key):
+        condition, param = _scope(keyspace)
+        params = [param]
+        if group == "year_semester":
+            year, semester = key.split("_", 1)
+            condition += " AND course_year = ? AND course_semester = ?"
+            params += [year, semester]
+        elif group != "total":
+            condition += f" AND {GROUP_KEYS[group][1]} = ?"
+            params.append(key)
+        return _sums(self.db.execute(f"SELECT {SUMS} FROM courses WHERE {condition}", params).fetchone())
+
+    async def get_group_average(self, keyspace, group, key):
+        sums = await self._run(self._group_sums, keyspace, group, key)
+        return store.format_averages({"total": {"all": sums}}, ("total",))["total"] if sums["count"] > 0 else None
+
+    async def get_averages(self, keyspace, groups=AGGREGATE_GROUPS, item_ids=None):
+        return store.format_averages(await self._run(self._read_sums, keyspace, item_ids), groups)
+
+    async def check_aggregates(self, keyspace):
+        # Aggregates are computed from the courses on every read
+        return []
+
+    async def rebuild_aggregates(self, keyspace):
+        return await self.get_averages(keyspace)
+
+    # Cohort
+
+    def _grade_counts(self, course_name):
+        return dict(self.db.execute(
+            "SELECT MIN(MAX(course_grade, 0), ?) AS grade_bin, COUNT(*) FROM courses"
+            " WHERE course_name = ? AND keyspace GLOB ? GROUP BY grade_bin",
+            (store.MAX_HISTOGRAM_GRADE, course_name, STUDENTS),
+        ).fetchall())
+
+    async def grade_distribution(self, course_name):
+        return analytics.describe_distribution(course_name, await self._run(self._grade_counts, course_name))
+
+    def _average_bins(self, keyspace):
+        """Return the keyspace's average bin (or None) and {bin: students} over the cohort."""
+        bins, student_bin = {}, None
+        for prefix, *row in self.db.execute(f"SELECT keyspace, {SUMS} FROM courses WHERE keyspace GLOB ? GROUP BY keyspace", (STUDENTS,)):
+            average_bin = store.average_bin(_sums(row))
+            if average_bin is not None:
+                bins[average_bin] = bins.get(average_bin, 0) + 1
+            if prefix == keyspace.prefix:
+                student_bin = average_bin
+        return student_bin, bins
+
+    async def average_rank(self, keyspace):
+        student_bin, bins = await self._run(self._average_bins, keyspace)
+        average = await self.get_group_average(keyspace, "total", "all")
+        if student_bin is None or average is None:
+            return None
+        return analytics.percentile_rank(average, student_bin, bins)
+
+    async def rebuild_cohort(self):
+        return await self.get_averages(COHORT_KEYSPACE)
+
+    # Writes
+
+    def _commit(self, keyspace, changes):
+        """Increment the version and log the write's changes, inside its transaction.
+
+        The averages of the change event are left to whoever reads the log
+        (see ChangeLog._read), so no write reads beyond the rows it changes.
+        """
+        self.db.execute(
+            "INSERT INTO versions VALUES (?, 1) ON CONFLICT (keyspace) DO UPDATE SET version = version + 1",
+            (keyspace.prefix,),
+        )
+        version = self._get_version(keyspace)
+        if store.CHANGE_EVENTS:
+            self.db.execute("INSERT INTO change_events VALUES (?, ?, ?)", (keyspace.prefix, version, json.dumps(changes)))
+            self.db.execute("DELETE FROM change_events WHERE keyspace = ? AND version <= ?",
+                            (keyspace.prefix, version - EVENT_LOG_SIZE))
+        return version
+
+    def _upsert(self, keyspace, items):
+        self.db.executemany(
+            f"INSERT INTO courses (keyspace, id, {COURSE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)"
+            f" ON CONFLICT (keyspace, id) DO UPDATE SET "
+            + ", ".join(f"{field} = excluded.{field}" for field in COURSE_FIELDS),
+            [(keyspace.prefix, item_id, *(course[field] for field in COURSE_FIELDS)) for item_id, course in items],
+        )
+
+    def _create(self, keyspace, items):
+        with _transaction(self.db):
+            self._upsert(keyspace, items)
+            self._commit(keyspace, [(item_id, None, course) for item_id, course in items])
+
+    async def create_courses(self, keyspace, items):
+        """Store (id, course) pairs with fresh ids in one transaction."""
+        if not store.unique_ids([item_id for item_id, _ in items]):
+            return
+        await self._run(self._create, keyspace, items)
+        self.feed.wake()
+
+    def _update(self, keyspace, items):
+        with _transaction(self.db):
+            old_courses = dict(self._get_courses(keyspace, [item_id for item_id, _ in items]))
+            self._upsert(keyspace, items)
+            self._commit(keyspace, [(item_id, old_courses.get(item_id), course) for item_id, course in items])
+        return ["updated" if item_id in old_courses else "created" for item_id, _ in items]
+
+    async def update_courses(self, keyspace, items):
+        """Replace (or create) courses in one transaction; returns "updated" or "created" per item."""
+        if not store.unique_ids([item_id for item_id, _ in items]):
+            return []
+        statuses = await self._run(self._update, keyspace, items)
+        self.feed.wake()
+        return statuses
+
+    def _delete(self, keyspace, item_ids):
+        with _transaction(self.db):
+            old_courses = dict(self._get_courses(keyspace, item_ids))
+            if old_courses:
+                self.db.executemany("DELETE FROM courses WHERE keyspace = ? AND id = ?",
+                                    [(keyspace.prefix, item_id) for item_id in old_courses])
+                self._commit(keyspace, [(item_id, old_courses[item_id], None) for item_id in item_ids if item_id in old_courses])
+        return [item_id in old_courses for item_id in item_ids]
+
+    async def delete_courses(self, keyspace, item_ids):
+        """Delete courses in one transaction; returns True per id that existed."""
+        if not store.unique_ids(item_ids):
+            return []
+        deleted = await self._run(self._delete, keyspace, item_ids)
+        self.feed.wake()
+        return deleted
+
+    def subscribe(self, keyspace):
+        """Async context manager yielding a queue of the keyspace's change events (see events.py)."""
+        return self.feed.subscribe(keyspace)
+
+
+class ChangeLog:
+    """Change events of the followed keyspaces, read from the change_events table.
+
+    One task per process polls the log of every keyspace a stream follows
+    and hands new events to the streams' queues; writes of this process
+    wake it at once. Like events.ChangeFeed, the task is bound to the event
+    loop of the first subscriber and recreated if it changes.
+    """
+
+    def __init__(self, storage, queue_size=events.EVENT_QUEUE_SIZE):
+        self.storage = storage
+        self.queue_size = queue_size
+        self.loop = None
+        self.wakeup = None
+        self.poller = None
+        # keyspace prefix -> queues of the streams following it
+        self.queues = {}
+        # keyspace prefix -> version of the last event handed out
+        self.versions = {}
+
+    def _bind(self):
+        loop = asyncio.get_running_loop()
+        if self.wakeup is not None and self.loop is loop:
+            return
+        self.loop, self.wakeup = loop, asyncio.Event()
+        self.poller = asyncio.create_task(self._poll(self.wakeup))
+        self.queues, self.versions = {}, {}
+
+    def wake(self):
+        if self.wakeup is not None and self.loop is asyncio.get_running_loop():
+            self.wakeup.set()
+
+    def _read(self, prefix, after):
+        """Return the (version, event JSON) pairs of the writes after version ``after``.
+
+        The log and the current sums are read in one transaction, so the
+        sums are those the last logged write left behind. The averages of
+        each earlier event follow by undoing the changes made after it.
+        """
+        db = self.storage.db
+        db.execute("BEGIN")
+        try:
+            rows = db.execute(
+                "SELECT version, changes FROM change_events WHERE keyspace = ? AND version > ? ORDER BY version",
+                (prefix, after),
+            ).fetchall()
+            sums = self.storage._read_sums(store.Keyspace(prefix)) if rows else None
+        finally:
+            db.execute("COMMIT")
+        built = []
+        for version, changes in reversed(rows):
+            changes = json.loads(changes)
+            built.append((version, json.dumps(store.change_event(version, changes, sums))))
+            for item_id, old, new in changes:
+                if new is not None:
+                    store.add_to_sums(sums, new, -1)
+                if old is not None:
+                    store.add_to_sums(sums, old)
+        return built[::-1]
+
+    async def _poll(self, wakeup):
+        while self.wakeup is wakeup:
+            for prefix in list(self.queues):
+                # Unsubscribed while the poller read another keyspace
+                after = self.versions.get(prefix)
+                if after is None:
+                    continue
+                try:
+                    rows = await self.storage._run(self._read, prefix, after)
+                except Exception:
+                    logger.exception("Change log read failed")
+                    continue
+                queues = self.queues.get(prefix, ())
+                # Pruned from the log before this process read them
+                if rows and rows[0][0] != after + 1:
+                    for queue in queues:
+                        events.deliver(queue, events.RESET)
+                for version, data in rows:
+                    for queue in queues:
+                        events.deliver(queue, data)
+                if rows and prefix in self.versions:
+                    self.versions[prefix] = rows[-1][0]
+            try:
+                await asyncio.wait_for(wakeup.wait(), EVENT_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            wakeup.clear()
+
+    @asynccontextmanager
+    async def subscribe(self, keyspace):
+        """Yield a queue receiving the events of ``keyspace`` (RESET after an overflow)."""
+        self._bind()
+        prefix = keyspace.prefix
+        queue = asyncio.Queue(self.queue_size)
+        if prefix not in self.queues:
+            self.versions[prefix] = await self.storage.get_version(keyspace)
+        queues = self.queues.setdefault(prefix, set())
+        queues.add(queue)
+        try:
+            yield queue
+        finally:
+            queues.discard(queue)
+            if not queues and self.queues.get(prefix) is queues:
+                del self.queues[prefix]
+                del self.versions[prefix]
+
+    async def close(self):
+        poller = self.poller
+        self.loop = self.wakeup = self.poller = None
+        self.queues, self.versions = {}, {}
+        if poller is not None:
+            poller.cancel()
+            await asyncio.wait([poller], timeout=EVENT_POLL_INTERVAL * 2)
@@ -0,0 +1,139 @@
+"""The storage backends behind the API.
+
+The routes in main.py only talk to a storage object. Two backends
+implement it with the same methods and results:
+
+* RedisStorage (this module): the courses, indexes, running aggregates,
+  journal and change events of store.py, shared by any number of servers.
+* SQLiteStorage (sqlite_store.py): an embedded database file, for running
+  without a Redis server.
+
+STORAGE_BACKEND selects one. Every method takes the Keyspace of the
+collection it works on; test_storage.py holds the tests both pass.
+"""
+import asyncio
+import os
+
+import redis.asyncio as redis
+
+import analytics
+import columns
+import events
+import journal
+import logs
+import metrics
+import store
+from store import AGGREGATE_GROUPS, SCAN_CHUNK_SIZE
+
+# "redis" or "sqlite"
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "redis")
+
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+# Upper bound on concurrent Redis connections; requests beyond it wait for a free one.
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+
+# In-memory columnar copies of the stored courses, loaded on first use from
+# the latest snapshot and the journal since.
+COLUMN_STORES = columns.ColumnStores(loader=journal.load_column_store)
+store.WRITE_LISTENERS.append(COLUMN_STORES.apply)
+
+
+class RedisStorage:
+    """Courses in Redis, through the functions of store.py and the modules around it."""
+
+    def __init__(self, client, connection_pool=None):
+        self.client = client
+        self.connection_pool = connection_pool
+        # Change events of every followed keyspace, read over one pub/sub connection
+        self.feed = events.ChangeFeed()
+        self.snapshots = None
+
+    def start(self):
+        """Start the background work; called once the server's event loop runs."""
+        if journal.SNAPSHOT_INTERVAL > 0:
+            self.snapshots = asyncio.create_task(journal.snapshot_periodically(self.client))
+
+    async def close(self):
+        if self.snapshots is not None:
+            self.snapshots.cancel()
+        await self.feed.close()
+        await self.client.aclose()
+        if self.connection_pool is not None:
+            await self.connection_pool.disconnect()
+
+    async def get_version(self, keyspace):
+        return await store.get_version(self.client, keyspace)
+
+    async def get_course(self, keyspace, item_id):
+        return await store.get_course(self.client, keyspace, item_id)
+
+    async def get_courses(self, keyspace, item_ids):
+        return await store.get_courses(self.client, keyspace, item_ids)
+
+    async def create_courses(self, keyspace, items):
+        await store.create_courses(self.client, keyspace, items)
+
+    async def update_courses(self, keyspace, items):
+        return await store.update_courses(self.client, keyspace, items)
+
+    async def delete_courses(self, keyspace, item_ids):
+        return await store.delete_courses(self.client, keyspace, item_ids)
+
+    def iter_course_chunks(self, keyspace, course_year=None, course_semester=None, chunk_size=SCAN_CHUNK_SIZE, after=None):
+        index = keyspace.index_for(course_year, course_semester)
+        return store.iter_course_chunks(self.client, keyspace, index, chunk_size, after)
+
+    async def get_course_page(self, keyspace, course_year=None, course_semester=None, limit=SCAN_CHUNK_SIZE, after=None, predicate=None):
+        index = keyspace.index_for(course_year, course_semester)
+        return await store.get_course_page(self.client, keyspace, index, limit, after, predicate)
+
+    async def read_aggregate_sums(self, keyspace):
+        return await store.read_aggregate_sums(self.client, keyspace)
+
+    async def get_group_average(self, keyspace, group, key):
+        return await store.get_group_average(self.client, keyspace, group, key)
+
+    async def get_averages(self, keyspace, groups=AGGREGATE_GROUPS, item_ids=None):
+        if item_ids is None:
+            return await store.get_averages(self.client, keyspace, groups)
+        column_store = await COLUMN_STORES.get(self.client, keyspace)
+        return store.format_averages(column_store.group_sums(column_store.select(item_ids)), groups)
+
+    async def check_aggregates(self, keyspace):
+        return await store.check_aggregates(self.client, keyspace)
+
+    async def rebuild_aggregates(self, keyspace):
+        return await journal.rebuild_aggregates(self.client, keyspace)
+
+    async def grade_distribution(self, course_name):
+        return await analytics.grade_distribution(self.client, course_name)
+
+    async def average_rank(self, keyspace):
+        return await analytics.average_rank(self.client, keyspace)
+
+    async def rebuild_cohort(self):
+        return await analytics.rebuild_cohort(self.client)
+
+    def subscribe(self, keyspace):
+        """Async context manager yielding a queue of the keyspace's change events (see events.py)."""
+        return self.feed.subscribe(self.client, keyspace.events)
+
+
+def open_storage(backend=STORAGE_BACKEND):
+    """Create the configured backend; the caller starts it in the server's event loop."""
+    if backend == "sqlite":
+        import sqlite_store
+
+        return sqlite_store.SQLiteStorage()
+    if backend != "redis":
+        raise ValueError(f"Unknown storage backend {backend!r}")
+    pool = redis.BlockingConnectionPool(
+        host=REDIS_HOST,
+        port=REDIS_PORT,
+        db=0,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        connection_class=logs.CountingConnection,
+        **store.CLIENT_OPTIONS,
+    )
+    return RedisStorage(metrics.InstrumentedRedis(connection_pool=pool), pool)
@@ -0,0 +1,751 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+from dataclasses import dataclass
+from typing import Optional
+
+from redis.exceptions import WatchError
+
+from codec import CLIENT_OPTIONS, CODECS, decode_course, detect_codec, encode_course
+
+# Number of ids fetched per index page and per MGET.
+SCAN_CHUNK_SIZE = int(os.getenv("SCAN_CHUNK_SIZE", "1000"))
+
+# Keys of courses written before keyspaces existed: a bare uuid4 course id
+LEGACY_KEY_PATTERN = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+COURSE_FIELDS = ("course_name", "course_grade", "course_credit", "course_year", "course_semester")
+
+# Running sums kept per aggregate group: sum of grade * credit, sum of
+# credits, sum of grades and number of courses.
+AGGREGATE_GROUPS = ("total", "year", "semester", "year_semester")
+AGGREGATE_METRICS = ("weighted", "credits", "grades", "count")
+
+# Student weighted averages are counted in bins of 1 / AVERAGE_BINS_PER_POINT
+# grade points (0.0 to 100.0) for cohort percentile ranks.
+AVERAGE_BINS_PER_POINT = 10
+AVERAGE_BINS = 100 * AVERAGE_BINS_PER_POINT + 1
+
+# Cohort grade histograms have one bin per grade from 0 to MAX_HISTOGRAM_GRADE;
+# grades outside that range are counted in the first or last bin.
+MAX_HISTOGRAM_GRADE = 100
+
+# Publish a change event (see change_event) on the keyspace's channel after
+# every write, for clients following changes over /events.
+CHANGE_EVENTS = os.getenv("CHANGE_EVENTS", "true").lower() in ("1", "true", "yes")
+
+# Append the courses written by every write to the keyspace's journal
+# stream (see journal.py), in the write's own transaction.
+JOURNAL = os.getenv("JOURNAL", "true").lower() in ("1", "true", "yes")
+
+# Allowed difference between stored and recomputed sums before a group is
+# reported as drifted (HINCRBYFLOAT accumulates rounding error).
+AGGREGATE_TOLERANCE = 1e-6
+
+
+@dataclass(frozen=True)
+class Keyspace:
+    """Redis key layout for one collection of courses.
+
+    Every course lives under ``<prefix>:course:<id>``. The ids are kept in
+    sorted sets (all scores 0, so members are ordered lexicographically and
+    can be paged with ZRANGEBYLEX): one for all courses and one per year,
+    per semester and per year + semester. Running weighted-average sums
+    live in one hash per aggregate group under ``<prefix>:averages:<group>``,
+    and ``<prefix>:version`` is incremented by every write. Change events
+    are published on the ``<prefix>:events`` channel, and the courses each
+    write leaves behind are appended to the ``<prefix>:journal`` stream.
+
+    Writes to a keyspace with a ``cohort`` also update the cohort's
+    aggregates and per-course grade histograms in the same transaction.
+    """
+    prefix: str = "grades"
+    cohort: Optional["Keyspace"] = None
+
+    def course(self, item_id):
+        return f"{self.prefix}:course:{item_id}"
+
+    @property
+    def index(self):
+        return f"{self.prefix}:courses"
+
+    def by_year(self, year):
+        return f"{self.prefix}:courses:year:{year}"
+
+    def by_semester(self, semester):
+        return f"{self.prefix}:courses:semester:{semester}"
+
+    def by_year_semester(self, year, semester):
+        return f"{self.prefix}:courses:year:{year}:semester:{semester}"
+
+    def averages(self, group):
+        return f"{self.prefix}:averages:{group}"
+
+    @property
+    def version(self):
+        return f"{self.prefix}:version"
+
+    @property
+    def events(self):
+        return f"{self.prefix}:events"
+
+    @property
+    def journal(self):
+        return f"{self.prefix}:journal"
+
+    def histogram(self, course_name):
+        """Hash of grade -> number of courses named ``course_name`` with that grade."""
+        return f"{self.prefix}:histogram:{course_name}"
+
+    @property
+    def average_bin(self):
+        return f"{self.prefix}:average_bin"
+
+    @property
+    def average_bins(self):
+        """Hash of average bin -> number of students whose average falls in it."""
+        return f"{self.prefix}:average_bins"
+
+    @property
+    def students(self):
+        """Set of the prefixes of every student keyspace written to."""
+        return f"{self.prefix}:students"
+
+    def index_for(self, year=None, semester=None):
+        """Return the narrowest index holding the courses matching the filters."""
+        if year is not None and semester is not None:
+            return self.by_year_semester(year, semester)
+        if year is not None:
+            return self.by_year(year)
+        if semester is not None:
+            return self.by_semester(semester)
+        return self.index
+
+    def indexes(self, course):
+        return (
+            self.index,
+            self.by_year(course["course_year"]),
+            self.by_semester(course["course_semester"]),
+            self.by_year_semester(course["course_year"], course["course_semester"]),
+        )
+
+
+DEFAULT_KEYSPACE = Keyspace()
+
+# Statistics over the courses of every student; it holds no courses itself.
+COHORT_KEYSPACE = Keyspace(f"{DEFAULT_KEYSPACE.prefix}:cohort")
+
+
+def student_keyspace(student_id):
+    """Return the keyspace holding one student's courses, indexes and aggregates."""
+    return Keyspace(f"{DEFAULT_KEYSPACE.prefix}:student:{student_id}", cohort=COHORT_KEYSPACE)
+
+
+def aggregate_keys(course):
+    """Return the key of every aggregate group the course contributes to."""
+    year, semester = course["course_year"], course["course_semester"]
+    return {
+        "total": "all",
+        "year": str(year),
+        "semester": semester,
+        "year_semester": f"{year}_{semester}",
+    }
+
+
+def _write_course(pipe, keyspace, item_id, course, sign):
+    """Queue the commands adding (sign=1) or removing (sign=-1) a course.
+
+    The course document, its index entries and its share of the running
+    aggregates are always changed together.
+    """
+    if sign > 0:
+        pipe.set(keyspace.course(item_id), encode_course(course))
+        for index in keyspace.indexes(course):
+            pipe.zadd(index, {item_id: 0})
+    else:
+        pipe.delete(keyspace.course(item_id))
+        for index in keyspace.indexes(course):
+            pipe.zrem(index, item_id)
+
+    _write_aggregates(pipe, keyspace, course, sign)
+    if keyspace.cohort is not None:
+        _write_aggregates(pipe, keyspace.cohort, course, sign)
+        pipe.hincrby(keyspace.cohort.histogram(course["course_name"]), grade_bin(course["course_grade"]), sign)
+
+
+def _write_aggregates(pipe, keyspace, course, sign):
+    grade, credit = course["course_grade"], course["course_credit"]
+    for group, key in aggregate_keys(course).items():
+        name = keyspace.averages(group)
+        pipe.hincrbyfloat(name, f"{key}:weighted", sign * grade * credit)
+        pipe.hincrbyfloat(name, f"{key}:credits", sign * credit)
+        pipe.hincrby(name, f"{key}:grades", sign * grade)
+        pipe.hincrby(name, f"{key}:count", sign)
+
+
+async def get_version(client, keyspace):
+    """Return the data version, which every write to ``keyspace`` increments."""
+    return int(await client.get(keyspace.version) or 0)
+
+
+async def get_course(client, keyspace, item_id):
+    value = await client.get(keyspace.course(item_id))
+    return decode_course(value) if value is not None else None
+
+
+# Callables invoked as listener(keyspace, version, changes) after every
+# committed write, where version is the new data version and changes lists
+# (id, old_course, new_course) with None for a missing side.
+WRITE_LISTENERS = []
+
+
+def _notify(keyspace, version, changes):
+    for listener in WRITE_LISTENERS:
+        listener(keyspace, version, changes)
+
+
+def journal_entry(written):
+    """Encode (id, course) pairs, course None when deleted, as a journal stream entry."""
+    return {"courses": json.dumps(written, separators=(",", ":"))}
+
+
+def read_journal_entry(fields):
+    return json.loads(fields["courses"])
+
+
+def _queue_commit(pipe, keyspace, written):
+    """Queue the journal entry and version increment that end every write transaction.
+
+    ``written`` lists the (id, course) pairs the write leaves behind, course
+    None for a deleted one. With CHANGE_EVENTS the new aggregates are read
+    in the same transaction, so the published event shows exactly the
+    state the write produced.
+    """
+    if JOURNAL and written:
+        pipe.xadd(keyspace.journal, journal_entry(written))
+    if keyspace.cohort is not None:
+        # Also students without credits, who have no average bin
+        pipe.sadd(keyspace.cohort.students, keyspace.prefix)
+    pipe.incr(keyspace.version)
+    if CHANGE_EVENTS:
+        for group in AGGREGATE_GROUPS:
+            pipe.hgetall(keyspace.averages(group))
+
+
+async def _committed(client, keyspace, results, changes):
+    """Follow up a transaction ended by _queue_commit: cohort bin, listeners, event."""
+    aggregates = results[-len(AGGREGATE_GROUPS):] if CHANGE_EVENTS else []
+    version = results[-1 - len(aggregates)]
+    await update_average_bin(client, keyspace)
+    _notify(keyspace, version, changes)
+    if aggregates:
+        sums = {group: _group_sums(values) for group, values in zip(AGGREGATE_GROUPS, aggregates)}
+        await client.publish(keyspace.events, json.dumps(change_event(version, changes, sums)))
+    return version
+
+
+def change_event(version, changes, sums):
+    """Return the event published after a write.
+
+    ``changes`` lists the course written (null when deleted) per id, and
+    ``averages`` has the shape of GET /averages after the write. Versions
+    increase by one per write, so a gap means events were missed.
+    """
+    return {
+        "version": version,
+        "changes": [
+            {
+                "id": item_id,
+                "action": "deleted" if new is None else "created" if old is None else "updated",
+                "course": new,
+            }
+            for item_id, old, new in changes
+        ],
+        "averages": format_averages(sums),
+    }
+
+
+async def watched_transaction(client, keys, queue):
+    """Run queue(pipe) under WATCH ``keys`` and execute it, retrying on conflicts.
+
+    Returns queue's return value together with the MULTI/EXEC results.
+    """
+    async with client.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                await pipe.watch(*keys)
+                value = await queue(pipe)
+                return value, await pipe.execute()
+            except WatchError:
+                continue
+
+
+def unique_ids(item_ids):
+    if len(set(item_ids)) != len(item_ids):
+        raise ValueError("A batch may not contain the same course id twice")
+    return item_ids
+
+
+async def create_courses(client, keyspace, items):
+    """Store, index and aggregate (id, course) pairs with fresh ids in one MULTI/EXEC."""
+    if not unique_ids([item_id for item_id, _ in items]):
+        return
+    pipe = client.pipeline(transaction=True)
+    for item_id, course in items:
+        _write_course(pipe, keyspace, item_id, course, 1)
+    _queue_commit(pipe, keyspace, items)
+    results = await pipe.execute()
+    await _committed(client, keyspace, results, [(item_id, None, course) for item_id, course in items])
+
+
+async def update_courses(client, keyspace, items):
+    """Replace (or create) courses, moving them between indexes and aggregates atomically.
+
+    All (id, course) pairs are written in one MULTI/EXEC after a single MGET
+    of their previous values. Returns "updated" or "created" per item.
+    """
+    keys = [keyspace.course(item_id) for item_id in unique_ids([item_id for item_id, _ in items])]
+    if not keys:
+        return []
+
+    async def write(pipe):
+        old_courses = [decode_course(value) if value is not None else None for value in await pipe.mget(keys)]
+        pipe.multi()
+        for (item_id, course), old_course in zip(items, old_courses):
+            if old_course is not None:
+                _write_course(pipe, keyspace, item_id, old_course, -1)
+            _write_course(pipe, keyspace, item_id, course, 1)
+        _queue_commit(pipe, keyspace, items)
+        return old_courses
+
+    old_courses, results = await watched_transaction(client, keys, write)
+    await _committed(client, keyspace, results, [(item_id, old, new) for (item_id, new), old in zip(items, old_courses)])
+    return ["updated" if old_course is not None else "created" for old_course in old_courses]
+
+
+async def delete_courses(client, keyspace, item_ids):
+    """Delete courses with their index entries and aggregate shares atomically.
+
+    Returns True per id that existed and False per id that did not.
+    """
+    keys = [keyspace.course(item_id) for item_id in unique_ids(item_ids)]
+    if not keys:
+        return []
+
+    async def write(pipe):
+        old_courses = [decode_course(value) if value is not None else None for value in await pipe.mget(keys)]
+        pipe.multi()
+        for item_id, old_course in zip(item_ids, old_courses):
+            if old_course is not None:
+                _write_course(pipe, keyspace, item_id, old_course, -1)
+        deleted = [(item_id, None) for item_id, old_course in zip(item_ids, old_courses) if old_course is not None]
+        if deleted:
+            _queue_commit(pipe, keyspace, deleted)
+        return old_courses
+
+    old_courses, results = await watched_transaction(client, keys, write)
+    changes = [(item_id, old, None) for item_id, old in zip(item_ids, old_courses) if old is not None]
+    if changes:
+        await _committed(client, keyspace, results, changes)
+    return [old_course is not None for old_course in old_courses]
+
+
+def grade_bin(grade):
+    """Return the cohort histogram bin of a course grade."""
+    return min(max(grade, 0), MAX_HISTOGRAM_GRADE)
+
+
+def average_bin(sums):
+    """Return the cohort histogram bin of a student's total sums, or None without credits."""
+    if sums["count"] <= 0 or sums["credits"] <= 0:
+        return None
+    average = sums["weighted"] / sums["credits"]
+    return min(max(round(average * AVERAGE_BINS_PER_POINT), 0), AVERAGE_BINS - 1)
+
+
+async def update_average_bin(client, keyspace):
+    """Move the student of ``keyspace`` to the cohort bin of their current average.
+
+    Runs after each write, under WATCH of the student's total sums and
+    current bin, so concurrent writes of one student are counted once.
+    """
+    cohort = keyspace.cohort
+    if cohort is None:
+        return
+    total = keyspace.averages("total")
+
+    async def write(pipe):
+        values = await pipe.hmget(total, [f"all:{metric}" for metric in AGGREGATE_METRICS])
+        old_bin = await pipe.get(keyspace.average_bin)
+        old_bin = int(old_bin) if old_bin is not None else None
+        new_bin = average_bin(_parse_sums(values))
+        pipe.multi()
+        if old_bin == new_bin:
+            return
+        if old_bin is not None:
+            pipe.hincrby(cohort.average_bins, old_bin, -1)
+        if new_bin is not None:
+            pipe.hincrby(cohort.average_bins, new_bin, 1)
+            pipe.set(keyspace.average_bin, new_bin)
+        else:
+            pipe.delete(keyspace.average_bin)
+
+    await watched_transaction(client, [total, keyspace.average_bin], write)
+
+
+async def create_course(client, keyspace, item_id, course):
+    await create_courses(client, keyspace, [(item_id, course)])
+
+
+async def update_course(client, keyspace, item_id, course):
+    await update_courses(client, keyspace, [(item_id, course)])
+
+
+async def delete_course(client, keyspace, item_id):
+    """Delete one course; returns False if it did not exist."""
+    return (await delete_courses(client, keyspace, [item_id]))[0]
+
+
+def _id_page(pipe, index, after, chunk_size):
+    start = f"({after}" if after is not None else "-"
+    pipe.zrangebylex(index, start, "+", start=0, num=chunk_size)
+
+
+async def iter_course_chunks(client, keyspace, index=None, chunk_size=SCAN_CHUNK_SIZE, after=None):
+    """Yield lists of (id, course_data) pairs, one list per index page.
+
+    Only the courses listed in ``index`` (all courses by default) are read,
+    in id order, starting after the id ``after`` when it is given.
+    Each round-trip sends the MGET for the current page together with the
+    ZRANGEBYLEX for the next one in a single pipeline, so listing N courses
+    costs about N / chunk_size round-trips instead of one GET per course.
+    """
+    index = index or keyspace.index
+    pipe = client.pipeline(transaction=False)
+    _id_page(pipe, index, after, chunk_size)
+    ids = (await pipe.execute())[0]
+    while ids:
+        pipe = client.pipeline(transaction=False)
+        pipe.mget([keyspace.course(item_id) for item_id in ids])
+        if len(ids) == chunk_size:
+            _id_page(pipe, index, ids[-1], chunk_size)
+        results = await pipe.execute()
+
+        yield [
+            (item_id, decode_course(value))
+            for item_id, value in zip(ids, results[0])
+            if value is not None
+        ]
+        ids = results[1] if len(results) > 1 else []
+
+
+async def iter_courses(client, keyspace, index=None, chunk_size=SCAN_CHUNK_SIZE):
+    """Yield (id, course_data) pairs for every course in ``index``."""
+    async for chunk in iter_course_chunks(client, keyspace, index, chunk_size):
+        for item in chunk:
+            yield item
+
+
+async def get_course_page(client, keyspace, index=None, limit=SCAN_CHUNK_SIZE, after=None, predicate=None):
+    """Return up to ``limit`` (id, course_data) pairs matching ``predicate``.
+
+    Courses are read from ``index`` in id order starting after ``after``.
+    The second value returned is the id to resume from, or None once the
+    index is exhausted.
+    """
+    items = []
+    async for chunk in iter_course_chunks(client, keyspace, index, limit, after):
+        for item_id, course in chunk:
+            if predicate is None or predicate(course):
+                items.append((item_id, course))
+                if len(items) == limit:
+                    return items, item_id
+    return items, None
+
+
+def _parse_legacy_course(value):
+    try:
+        data = json.loads(value)
+    except (TypeError, ValueError):
+        return None
+    if isinstance(data, dict) and all(field in data for field in COURSE_FIELDS):
+        return data
+    return None
+
+
+async def migrate_legacy_courses(client, keyspace, chunk_size=SCAN_CHUNK_SIZE):
+    """Move courses stored as bare ``<uuid>`` keys into ``keyspace``.
+
+    Keys are discovered with SCAN and those named like a uuid fetched with
+    one MGET per page; other keys, and values that are not course JSON
+    documents, are left untouched. Returns the number of courses migrated.
+    """
+    migrated = 0
+    cursor = None
+    while cursor != 0:
+        cursor, keys = await client.scan(cursor=cursor or 0, count=chunk_size)
+        keys = [key for key in keys if LEGACY_KEY_PATTERN.fullmatch(key)]
+        if not keys:
+            continue
+        pipe = client.pipeline(transaction=True)
+        changes = []
+        for key, value in zip(keys, await client.mget(keys)):
+            course = _parse_legacy_course(value)
+            if course is None:
+                continue
+            _write_course(pipe, keyspace, key, course, 1)
+            pipe.delete(key)
+            changes.append((key, None, course))
+        if not changes:
+            continue
+        _queue_commit(pipe, keyspace, [(key, course) for key, _, course in changes])
+        results = await pipe.execute()
+        await _committed(client, keyspace, results, changes)
+        migrated += len(changes)
+    return migrated
+
+
+def _stats(sums):
+    credits = sums["credits"]
+    return {
+        "average": sums["weighted"] / credits if credits > 0 else 0,
+        "credits": credits,
+        "count": int(sums["count"]),
+    }
+
+
+def empty_average():
+    return _stats(dict.fromkeys(AGGREGATE_METRICS, 0.0))
+
+
+def _parse_sums(values):
+    return {
+        metric: float(value) if value is not None else 0.0
+        for metric, value in zip(AGGREGATE_METRICS, values)
+    }
+
+
+async def get_group_average(client, keyspace, group, key):
+    """Return the weighted average of one group, or None if it has no courses.
+
+    Reads a fixed number of hash fields, so the cost does not depend on the
+    number of stored courses.
+    """
+    fields = [f"{key}:{metric}" for metric in AGGREGATE_METRICS]
+    sums = _parse_sums(await client.hmget(keyspace.averages(group), fields))
+    return _stats(sums) if sums["count"] > 0 else None
+
+
+def _group_sums(hash_values):
+    groups = {}
+    for field, value in hash_values.items():
+        key, metric = field.rsplit(":", 1)
+        groups.setdefault(key, dict.fromkeys(AGGREGATE_METRICS, 0.0))[metric] = float(value)
+    return {key: sums for key, sums in groups.items() if sums["count"] > 0}
+
+
+async def read_aggregate_sums(client, keyspace):
+    """Return {group: {key: sums}} for every non-empty aggregate group."""
+    pipe = client.pipeline(transaction=False)
+    for group in AGGREGATE_GROUPS:
+        pipe.hgetall(keyspace.averages(group))
+    return {
+        group: _group_sums(values)
+        for group, values in zip(AGGREGATE_GROUPS, await pipe.execute())
+    }
+
+
+def add_to_sums(sums, course, sign=1):
+    """Add (sign=1) or remove (sign=-1) a course's share of in-memory aggregate sums."""
+    grade, credit = course["course_grade"], course["course_credit"]
+    for group, key in aggregate_keys(course).items():
+        group_sums = sums[group].setdefault(key, dict.fromkeys(AGGREGATE_METRICS, 0.0))
+        group_sums["weighted"] += sign * grade * credit
+        group_sums["credits"] += sign * credit
+        group_sums["grades"] += sign * grade
+        group_sums["count"] += sign
+
+
+def compute_aggregate_sums(courses):
+    """Compute the aggregate sums from scratch for an iterable of courses."""
+    result = {group: {} for group in AGGREGATE_GROUPS}
+    for course in courses:
+        add_to_sums(result, course)
+    return result
+
+
+async def get_courses(client, keyspace, item_ids):
+    """Return the (id, course_data) pairs of the given ids that exist, with one MGET."""
+    if not item_ids:
+        return []
+    values = await client.mget([keyspace.course(item_id) for item_id in item_ids])
+    return [(item_id, decode_course(value)) for item_id, value in zip(item_ids, values) if value is not None]
+
+
+def format_averages(sums, groups=AGGREGATE_GROUPS):
+    """Turn aggregate sums into {"total": stats, <group>: {key: stats}, ...}."""
+    averages = {
+        group: {key: _stats(group_sums) for key, group_sums in sorted(sums[group].items()) if group_sums["count"] > 0}
+        for group in groups if group != "total"
+    }
+    total = sums["total"].get("all")
+    averages["total"] = _stats(total) if total and total["count"] > 0 else empty_average()
+    return averages
+
+
+async def get_averages(client, keyspace, groups=AGGREGATE_GROUPS, item_ids=None):
+    """Return the weighted averages and credit totals of the requested groups.
+
+    Without ``item_ids`` the running aggregates are read. With ``item_ids``
+    the listed courses are fetched with one MGET and summed in a single pass.
+    """
+    if item_ids is None:
+        sums = await read_aggregate_sums(client, keyspace)
+    else:
+        courses = await get_courses(client, keyspace, item_ids)
+        sums = compute_aggregate_sums(course for _, course in courses)
+    return format_averages(sums, groups)
+
+
+async def check_aggregates(client, keyspace):
+    """Compare the stored aggregates with a full recomputation.
+
+    Returns a list of {"group", "key", "stored", "actual"} entries for every
+    group whose sums differ; an empty list means the aggregates are consistent.
+    """
+    stored = await read_aggregate_sums(client, keyspace)
+    actual = await sum_courses(client, keyspace)
+    empty = dict.fromkeys(AGGREGATE_METRICS, 0.0)
+    drift = []
+    for group in AGGREGATE_GROUPS:
+        for key in sorted(set(stored[group]) | set(actual[group])):
+            stored_sums = stored[group].get(key, empty)
+            actual_sums = actual[group].get(key, empty)
+            if any(abs(stored_sums[m] - actual_sums[m]) > AGGREGATE_TOLERANCE for m in AGGREGATE_METRICS):
+                drift.append({"group": group, "key": key, "stored": stored_sums, "actual": actual_sums})
+    return drift
+
+
+async def sum_courses(client, keyspace):
+    """Return compute_aggregate_sums of every stored course."""
+    return compute_aggregate_sums([course async for _, course in iter_courses(client, keyspace)])
+
+
+async def rebuild_aggregates(client, keyspace, compute_sums=sum_courses):
+    """Replace the stored aggregates with sums recomputed from every course.
+
+    ``compute_sums(client, keyspace)`` returns the sums as
+    compute_aggregate_sums does. It runs under WATCH on the keyspace
+    version, which every write increments, and runs again if a write
+    commits before the aggregates are replaced, so none is lost.
+    """
+    async def write(pipe):
+        actual = await compute_sums(client, keyspace)
+        pipe.multi()
+        for group in AGGREGATE_GROUPS:
+            name = keyspace.averages(group)
+            pipe.delete(name)
+            mapping = {
+                f"{key}:{metric}": value
+                for key, sums in actual[group].items()
+                for metric, value in sums.items()
+            }
+            if mapping:
+                pipe.hset(name, mapping=mapping)
+        _queue_commit(pipe, keyspace, [])
+
+    _, results = await watched_transaction(client, [keyspace.version], write)
+    await _committed(client, keyspace, results, [])
+    return await get_averages(client, keyspace)
+
+
+async def restore_courses(client, keyspace, items, chunk_size=SCAN_CHUNK_SIZE):
+    """Write (id, course) pairs into an empty keyspace, e.g. from a snapshot.
+
+    Courses are stored, indexed and aggregated one MULTI/EXEC per chunk,
+    without journal entries or change events. Returns the number written.
+    """
+    if await client.zcard(keyspace.index):
+        raise ValueError(f"{keyspace.prefix} already holds courses")
+    for start in range(0, len(items), chunk_size):
+        pipe = client.pipeline(transaction=True)
+        for item_id, course in items[start:start + chunk_size]:
+            _write_course(pipe, keyspace, item_id, course, 1)
+        await pipe.execute()
+    if keyspace.cohort is not None:
+        await client.sadd(keyspace.cohort.students, keyspace.prefix)
+    await client.incr(keyspace.version)
+    await update_average_bin(client, keyspace)
+    return len(items)
+
+
+async def recode_courses(client, keyspace, codec, chunk_size=SCAN_CHUNK_SIZE):
+    """Rewrite every stored course with ``codec``; returns how many changed.
+
+    Works one index page at a time: the page's keys are WATCHed, read with
+    one MGET and rewritten in one MULTI/EXEC, so concurrent updates are
+    never overwritten with stale data.
+    """
+    recoded = 0
+    after = None
+    while True:
+        ids = await client.zrangebylex(keyspace.index, f"({after}" if after else "-", "+", start=0, num=chunk_size)
+        if not ids:
+            return recoded
+        keys = [keyspace.course(item_id) for item_id in ids]
+
+        async def write(pipe):
+            values = await pipe.mget(keys)
+            pipe.multi()
+            changed = 0
+            for key, value in zip(keys, values):
+                if value is not None and detect_codec(value) is not codec:
+                    encoded = codec.encode(decode_course(value))
+                    # Courses the codec cannot hold stay in their format
+                    if detect_codec(encoded) is not detect_codec(value):
+                        pipe.set(key, encoded)
+                        changed += 1
+            return changed
+
+        recoded += await client.transaction(write, *keys, value_from_callable=True)
+        after = ids[-1]
+
+
+async def run_command(command, redis_url, codec=None):
+    import redis.asyncio as redis
+
+    client = redis.Redis.from_url(redis_url, **CLIENT_OPTIONS)
+    try:
+        if command == "migrate":
+            print(f"Migrated {await migrate_legacy_courses(client, DEFAULT_KEYSPACE)} courses")
+        elif command == "check":
+            drift = await check_aggregates(client, DEFAULT_KEYSPACE)
+            for entry in drift:
+                print(json.dumps(entry))
+            print("Aggregates are consistent" if not drift else f"{len(drift)} aggregate groups drifted")
+            return 1 if drift else 0
+        elif command == "rebuild":
+            await rebuild_aggregates(client, DEFAULT_KEYSPACE)
+            print("Aggregates rebuilt")
+        elif command == "recode":
+            recoded = await recode_courses(client, DEFAULT_KEYSPACE, CODECS[codec])
+            print(f"Re-encoded {recoded} courses as {codec}")
+        return 0
+    finally:
+        await client.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Course store maintenance")
+    parser.add_argument("command", choices=["migrate", "check", "rebuild", "recode"])
+    parser.add_argument("--redis-url", default=os.getenv("REDIS_URL", "redis://redis:6379/0"))
+    parser.add_argument("--codec", choices=sorted(CODECS), default=os.getenv("COURSE_CODEC", "json"),
+                        help="target encoding for the recode command")
+    args = parser.parse_args()
+    raise SystemExit(asyncio.run(run_command(args.command, args.redis_url, args.codec)))
+
+
+if __name__ == "__main__":
+    main()
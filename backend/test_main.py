@@ -1,11 +1,42 @@
+import asyncio
+import io
 import json
+import logging
+import os
+import fakeredis
+import pytest
 from fastapi.testclient import TestClient
 from main import app
+import analytics
+import columns
+import events
+import journal
+import logs
+import main
+import metrics
+import storage
+import codec
+import store
+from store import DEFAULT_KEYSPACE, iter_course_chunks
 from pydantic import BaseModel
 from unittest.mock import patch
 
 client = TestClient(app)
 
+def fake_redis():
+    return fakeredis.FakeAsyncRedis(**store.CLIENT_OPTIONS)
+
+def fake_storage():
+    return storage.RedisStorage(fake_redis())
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+@pytest.fixture(autouse=True)
+def clear_column_stores():
+    # Every test gets a fresh fake Redis, so loaded column stores must not leak
+    storage.COLUMN_STORES.clear()
+
 class Course(BaseModel):
     course_name: str
     course_grade: int
@@ -28,9 +59,8 @@ class CourseInDB(BaseModel):
     course_year: int
     course_semester: str
 
-@patch("main.r")
-def test_create_course(mock_redis):
-    mock_redis.set.return_value = True
+@patch("main.storage", new_callable=fake_storage)
+def test_create_course(backend):
     sample_course = {
         "course_name": "EASS",
         "course_grade": 95,
@@ -43,8 +73,9 @@ def test_create_course(mock_redis):
     assert response.json()["course_name"] == sample_course["course_name"]
     # Add more assertions for other fields if needed
 
-@patch("main.r")
-def test_get_course(mock_redis):
+@patch("main.storage", new_callable=fake_storage)
+def test_get_course(backend):
+    redis_client = backend.client
     sample_course = {
         "course_name": "EASS",
         "course_grade": 95,
@@ -52,14 +83,14 @@ def test_get_course(mock_redis):
         "course_year": 2024,
         "course_semester": "Semester A"
     }
-    mock_redis.get.return_value = json.dumps(sample_course)
+    run(store.create_course(redis_client, DEFAULT_KEYSPACE, "1", sample_course))
     response = client.get("/courses/1")
     assert response.status_code == 200
     # Ignore the 'id' key before comparison
     assert {k: v for k, v in response.json()['course'].items() if k != 'id'} == sample_course
 
-@patch("main.r")
-def test_update_course(mock_redis):
+@patch("main.storage", new_callable=fake_storage)
+def test_update_course(backend):
     sample_course = {
         "course_name": "EASS - Updated",
         "course_grade": 100,
@@ -67,18 +98,26 @@ def test_update_course(mock_redis):
         "course_year": 2023,
         "course_semester": "Semester B"
     }
-    mock_redis.set.return_value = True
     response = client.put("/courses/1", json=sample_course)
     assert response.status_code == 200
 
-@patch("main.r")
-def test_delete_course(mock_redis):
-    mock_redis.delete.return_value = True
+@patch("main.storage", new_callable=fake_storage)
+def test_delete_course(backend):
+    redis_client = backend.client
+    sample_course = {
+        "course_name": "EASS",
+        "course_grade": 95,
+        "course_credit": 3.5,
+        "course_year": 2024,
+        "course_semester": "Semester A"
+    }
+    run(store.create_course(redis_client, DEFAULT_KEYSPACE, "1", sample_course))
     response = client.delete("/courses/1")
     assert response.status_code == 200
 
-@patch("main.r")
-def test_get_all_courses(mock_redis):
+@patch("main.storage", new_callable=fake_storage)
+def test_get_all_courses(backend):
+    redis_client = backend.client
     sample_courses = [
         {
             "course_name": "Deep Learning",
@@ -95,8 +134,8 @@ def test_get_all_courses(mock_redis):
             "course_semester": "Semester B"
         }
     ]
-    mock_redis.keys.return_value = ["course_id_1", "course_id_2"]
-    mock_redis.get.side_effect = [json.dumps(course) for course in sample_courses]
+    run(store.create_course(redis_client, DEFAULT_KEYSPACE, "course_id_1", sample_courses[0]))
+    run(store.create_course(redis_client, DEFAULT_KEYSPACE, "course_id_2", sample_courses[1]))
     response = client.get("/courses")
     assert response.status_code == 200
     sorted_response = sorted(response.json(), key=lambda x: x['course_year'])
@@ -105,7 +144,92 @@ def test_get_all_courses(mock_redis):
         course.pop('id', None)
     assert sorted_response == sorted_sample_courses
 
-@patch("main.r")
+def test_iter_course_chunks_reads_every_course():
+    async def read_chunks(redis_client):
+        return [chunk async for chunk in iter_course_chunks(redis_client, DEFAULT_KEYSPACE, chunk_size=10)]
+
+    redis_client = fake_redis()
+    sample_course = {
+        "course_name": "EASS",
+        "course_grade": 95,
+        "course_credit": 3.5,
+        "course_year": 2024,
+        "course_semester": "Semester A"
+    }
+    for i in range(25):
+        run(store.create_course(redis_client, DEFAULT_KEYSPACE, f"course_id_{i:02}", sample_course))
+    chunks = run(read_chunks(redis_client))
+    assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+    assert [item_id for chunk in chunks for item_id, _ in chunk] == [f"course_id_{i:02}" for i in range(25)]
+
+@patch("main.storage", new_callable=fake_storage)
+def test_get_all_courses_filtered_by_year_and_semester(backend):
+    redis_client = backend.client
+    run(redis_client.set("unrelated", "not a course"))
+    for year in (2023, 2024):
+        for semester in ("Semester A", "Semester B"):
+            response = client.post("/courses/", json={
+                "course_name": f"{year} {semester}",
+                "course_grade": 90,
+                "course_credit": 3.0,
+                "course_year": year,
+                "course_semester": semester
+            })
+            assert response.status_code == 200
+    response = client.get("/courses", params={"course_year": 2024, "course_semester": "Semester B"})
+    assert response.status_code == 200
+    assert [course["course_name"] for course in response.json()] == ["2024 Semester B"]
+    assert len(client.get("/courses", params={"course_year": 2023}).json()) == 2
+    assert len(client.get("/courses").json()) == 4
+
+@patch("main.storage", new_callable=fake_storage)
+def test_update_and_delete_keep_indexes_in_sync(backend):
+    redis_client = backend.client
+    course = {
+        "course_name": "EASS",
+        "course_grade": 95,
+        "course_credit": 3.5,
+        "course_year": 2024,
+        "course_semester": "Semester A"
+    }
+    item_id = client.post("/courses/", json=course).json()["id"]
+    client.put(f"/courses/{item_id}", json={**course, "course_semester": "Semester B"})
+    assert client.get("/courses", params={"course_semester": "Semester A"}).json() == []
+    assert len(client.get("/courses", params={"course_semester": "Semester B"}).json()) == 1
+
+    assert client.delete(f"/courses/{item_id}").status_code == 200
+    assert client.delete(f"/courses/{item_id}").status_code == 404
+    assert client.get(f"/courses/{item_id}").status_code == 404
+    assert run(redis_client.keys("grades:course*")) == []
+
+def test_migrate_legacy_courses():
+    redis_client = fake_redis()
+    course = {
+        "course_name": "EASS",
+        "course_grade": 95,
+        "course_credit": 3.5,
+        "course_year": 2024,
+        "course_semester": "Semester A"
+    }
+    legacy_id = "0b6f1a52-3c8e-4d2a-9f61-7e5d4c3b2a10"
+    run(redis_client.set(legacy_id, json.dumps(course)))
+    run(redis_client.set("unrelated", "not a course"))
+    run(redis_client.set("not-a-uuid", json.dumps(course)))
+    assert run(store.migrate_legacy_courses(redis_client, DEFAULT_KEYSPACE)) == 1
+    assert run(store.get_course(redis_client, DEFAULT_KEYSPACE, legacy_id)) == course
+    assert run(redis_client.get("unrelated")) == "not a course"
+    assert run(redis_client.get("not-a-uuid")) == json.dumps(course)
+    assert not run(redis_client.exists(legacy_id))
+
+    # Nothing left to migrate: no commit, so the version (the ETag) stays
+    version = run(store.get_version(redis_client, DEFAULT_KEYSPACE))
+    run(redis_client.set("1c2d3e4f-5a6b-4c7d-8e9f-0a1b2c3d4e5f", "not a course"))
+    assert run(store.migrate_legacy_courses(redis_client, DEFAULT_KEYSPACE)) == 0
+    assert run(store.get_version(redis_client, DEFAULT_KEYSPACE)) == version
+
+# Patches main.storage only because main.r is gone; /average/{year} does
+# not exist, so the mock is never called and the test still expects a 404
+@patch("main.storage")
 def test_get_average_year(mock_redis):
     mock_redis.keys.return_value = ["course_id_1", "course_id_2"]
 
@@ -130,4 +254,712 @@ def test_get_average_year(mock_redis):
         mock_redis.get.return_value = json.dumps(sample_courses[i])
 
     response = client.get("/average/2022")
-    assert response.status_code == 404
\ No newline at end of file
+    assert response.status_code == 404
+
+@patch("main.storage", new_callable=fake_storage)
+def test_aggregates_follow_writes(backend):
+    course = {
+        "course_name": "Deep Learning",
+        "course_grade": 80,
+        "course_credit": 4.0,
+        "course_year": 2022,
+        "course_semester": "Semester A"
+    }
+    first_id = client.post("/courses/", json=course).json()["id"]
+    client.post("/courses/", json={**course, "course_name": "Data Science", "course_grade": 100, "course_credit": 1.0})
+    assert client.get("/averages/total").json() == {"average": 84.0, "credits": 5.0, "count": 2}
+    assert client.get("/courses/average-year").json() == {"2022_Semester A": 90.0}
+
+    client.put(f"/courses/{first_id}", json={**course, "course_year": 2023})
+    assert client.get("/averages/year/2022").json() == {"average": 100.0, "credits": 1.0, "count": 1}
+    assert client.get("/averages/year/2023/semester/Semester A").json()["average"] == 80.0
+    assert client.get("/averages/semester/Semester A").json()["count"] == 2
+
+    client.delete(f"/courses/{first_id}")
+    assert client.get("/averages/year/2023").status_code == 404
+    averages = client.get("/averages").json()
+    assert averages["total"] == {"average": 100.0, "credits": 1.0, "count": 1}
+    assert list(averages["year_semester"]) == ["2022_Semester A"]
+    assert client.get("/averages/check").json() == {"consistent": True, "drift": []}
+
+@patch("main.storage", new_callable=fake_storage)
+def test_rebuild_repairs_drifted_aggregates(backend):
+    redis_client = backend.client
+    course = {
+        "course_name": "EASS",
+        "course_grade": 95,
+        "course_credit": 3.5,
+        "course_year": 2024,
+        "course_semester": "Semester A"
+    }
+    client.post("/courses/", json=course)
+    run(redis_client.hset(DEFAULT_KEYSPACE.averages("total"), "all:weighted", 1))
+    check = client.get("/averages/check").json()
+    assert not check["consistent"]
+    assert [(entry["group"], entry["key"]) for entry in check["drift"]] == [("total", "all")]
+
+    assert client.post("/averages/rebuild").json()["total"]["average"] == 95.0
+    assert client.get("/averages/check").json()["consistent"]
+
+def test_rebuild_retries_when_a_write_commits_meanwhile():
+    async def scenario(redis_client):
+        course = {"course_name": "EASS", "course_grade": 90, "course_credit": 2.0, "course_year": 2024, "course_semester": "Semester A"}
+        await store.create_course(redis_client, DEFAULT_KEYSPACE, "a", course)
+        calls = []
+
+        async def compute_sums(client, keyspace):
+            sums = await store.sum_courses(client, keyspace)
+            if not calls:
+                # Lands between the computation and the MULTI/EXEC
+                await store.create_course(client, keyspace, "b", {**course, "course_grade": 60})
+            calls.append(sums)
+            return sums
+
+        rebuilt = await store.rebuild_aggregates(redis_client, DEFAULT_KEYSPACE, compute_sums)
+        return len(calls), rebuilt, await store.check_aggregates(redis_client, DEFAULT_KEYSPACE)
+
+    calls, rebuilt, drift = run(scenario(fake_redis()))
+    assert calls == 2
+    assert rebuilt["total"]["average"] == 75.0
+    assert drift == []
+
+@patch("main.storage", new_callable=fake_storage)
+def test_batch_create_update_delete(backend):
+    courses = [
+        {
+            "course_name": f"Course {i}",
+            "course_grade": 80 + i,
+            "course_credit": 2.0,
+            "course_year": 2024,
+            "course_semester": "Semester A"
+        }
+        for i in range(3)
+    ]
+    response = client.post("/courses/batch", json=courses)
+    assert response.status_code == 200
+    ids = [result["id"] for result in response.json()["results"]]
+    assert len(ids) == 3
+    assert client.get("/averages/total").json()["count"] == 3
+
+    response = client.put("/courses/batch", json=[
+        {**courses[0], "id": ids[0], "course_grade": 100},
+        {**courses[1], "id": "new-id"}
+    ])
+    assert [result["status"] for result in response.json()["results"]] == ["updated", "created"]
+    assert client.get(f"/courses/{ids[0]}").json()["course"]["course_grade"] == 100
+
+    response = client.request("DELETE", "/courses/batch", json=[ids[0], "missing-id"])
+    assert response.json()["results"] == [
+        {"id": ids[0], "status": "deleted"},
+        {"id": "missing-id", "status": "not_found"}
+    ]
+    assert client.get("/averages/total").json()["count"] == 3
+    assert client.get("/averages/check").json()["consistent"]
+
+@patch("main.storage", new_callable=fake_storage)
+def test_batch_rejects_invalid_or_duplicate_items(backend):
+    course = {
+        "course_name": "EASS",
+        "course_grade": 95,
+        "course_credit": 3.5,
+        "course_year": 2024,
+        "course_semester": "Semester A"
+    }
+    response = client.post("/courses/batch", json=[course, {**course, "course_grade": "high"}])
+    assert response.status_code == 422
+    assert client.get("/courses").json() == []
+
+    response = client.request("DELETE", "/courses/batch", json=["same-id", "same-id"])
+    assert response.status_code == 422
+
+@patch("main.storage", new_callable=fake_storage)
+def test_export_courses_as_ndjson_and_csv(backend):
+    courses = [
+        {
+            "course_name": f"Course, {i}",
+            "course_grade": 80 + i,
+            "course_credit": 2.5,
+            "course_year": 2024,
+            "course_semester": "Semester A"
+        }
+        for i in range(3)
+    ]
+    ids = [result["id"] for result in client.post("/courses/batch", json=courses).json()["results"]]
+
+    response = client.get("/courses/export")
+    assert response.headers["content-type"] == "application/x-ndjson"
+    exported = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(course.pop("id") for course in exported) == sorted(ids)
+    assert sorted(exported, key=lambda course: course["course_grade"]) == courses
+
+    response = client.get("/courses/export", params={"format": "csv"})
+    rows = response.text.splitlines()
+    assert rows[0] == "id,course_name,course_grade,course_credit,course_year,course_semester"
+    assert len(rows) == 4
+    assert '"Course, 0",80,2.5,2024,Semester A' in response.text
+
+    assert client.get("/courses/export", params={"format": "xml"}).status_code == 422
+
+@patch("main.storage", new_callable=fake_storage)
+def test_get_all_courses_paginated_with_cursor(backend):
+    courses = [
+        {
+            "course_name": f"{'Math' if i % 2 else 'Physics'} {i}",
+            "course_grade": 60 + i * 5,
+            "course_credit": 3.0,
+            "course_year": 2024,
+            "course_semester": "Semester A"
+        }
+        for i in range(7)
+    ]
+    client.post("/courses/batch", json=courses)
+
+    names, cursor, pages = [], None, 0
+    while True:
+        params = {"limit": 2, "name_prefix": "Math", "min_grade": 65}
+        if cursor:
+            params["cursor"] = cursor
+        response = client.get("/courses", params=params)
+        assert response.status_code == 200
+        assert len(response.json()) <= 2
+        names += [course["course_name"] for course in response.json()]
+        pages += 1
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+    assert sorted(names) == ["Math 1", "Math 3", "Math 5"]
+    assert pages == 2
+
+    assert [course["course_grade"] for course in client.get("/courses", params={"max_grade": 65}).json()] in ([60, 65], [65, 60])
+    assert client.get("/courses", params={"cursor": "%%%"}).status_code == 400
+    assert client.get("/courses", params={"limit": 0}).status_code == 422
+
+@patch("main.storage", new_callable=fake_storage)
+def test_averages_grouped_and_restricted_to_ids(backend):
+    courses = [
+        {"course_name": "A", "course_grade": 90, "course_credit": 2.0, "course_year": 2023, "course_semester": "Semester A"},
+        {"course_name": "B", "course_grade": 60, "course_credit": 1.0, "course_year": 2023, "course_semester": "Semester B"},
+        {"course_name": "C", "course_grade": 75, "course_credit": 3.0, "course_year": 2024, "course_semester": "Semester A"},
+    ]
+    ids = [result["id"] for result in client.post("/courses/batch", json=courses).json()["results"]]
+
+    response = client.get("/averages", params={"group_by": "year,semester"})
+    assert response.status_code == 200
+    averages = response.json()
+    assert set(averages) == {"total", "year", "semester"}
+    assert averages["total"] == {"average": 77.5, "credits": 6.0, "count": 3}
+    assert averages["year"]["2023"] == {"average": 80.0, "credits": 3.0, "count": 2}
+    assert averages["semester"]["Semester A"]["average"] == 81.0
+
+    response = client.get("/averages", params={"ids": f"{ids[0]},{ids[1]},missing", "group_by": "year_semester"})
+    averages = response.json()
+    assert averages["total"] == {"average": 80.0, "credits": 3.0, "count": 2}
+    assert list(averages["year_semester"]) == ["2023_Semester A", "2023_Semester B"]
+
+    assert client.get("/averages", params={"group_by": "total"}).json().keys() == {"total"}
+    assert client.get("/averages", params={"ids": "missing"}).json()["total"]["count"] == 0
+    assert client.get("/averages", params={"group_by": "course"}).status_code == 422
+
+@patch("main.storage", new_callable=fake_storage)
+def test_simulation_applies_scenario_without_writing(backend):
+    courses = [
+        {"course_name": "A", "course_grade": 90, "course_credit": 2.0, "course_year": 2023, "course_semester": "Semester A"},
+        {"course_name": "B", "course_grade": 60, "course_credit": 1.0, "course_year": 2023, "course_semester": "Semester B"},
+    ]
+    ids = [result["id"] for result in client.post("/courses/batch", json=courses).json()["results"]]
+
+    response = client.post("/simulations", json={
+        "overrides": [{"id": ids[1], "course_grade": 90}],
+        "new_courses": [{"course_name": "C", "course_grade": 100, "course_credit": 3.0, "course_year": 2024, "course_semester": "Semester A"}]
+    })
+    assert response.status_code == 200
+    averages = response.json()
+    assert averages["total"] == {"average": 95.0, "credits": 6.0, "count": 3}
+    assert averages["year"]["2023"]["average"] == 90.0
+    assert averages["year"]["2024"]["average"] == 100.0
+    assert client.get("/averages/total").json() == {"average": 80.0, "credits": 3.0, "count": 2}
+
+    response = client.post("/simulations", json={"overrides": [{"id": "missing", "course_grade": 90}]})
+    assert response.status_code == 404
+
+@patch("main.storage", new_callable=fake_storage)
+def test_target_solver_in_closed_form(backend):
+    courses = [
+        {"course_name": "A", "course_grade": 90, "course_credit": 2.0, "course_year": 2023, "course_semester": "Semester A"},
+        {"course_name": "B", "course_grade": 60, "course_credit": 1.0, "course_year": 2023, "course_semester": "Semester B"},
+    ]
+    ids = [result["id"] for result in client.post("/courses/batch", json=courses).json()["results"]]
+
+    # (180 + g) / 3 >= 85  =>  g >= 75
+    response = client.post("/simulations/target", json={"id": ids[1], "target": 85})
+    assert response.json()["min_grade"] == 75
+    assert response.json()["achievable"]
+
+    # A new 2-credit course: (240 + 2g) / 5 >= 84.5  =>  g >= 91.25
+    new_course = {"course_name": "C", "course_grade": 0, "course_credit": 2.0, "course_year": 2024, "course_semester": "Semester A"}
+    response = client.post("/simulations/target", json={"course": new_course, "target": 84.5})
+    assert response.json()["min_grade"] == 92
+
+    response = client.post("/simulations/target", json={"id": ids[1], "target": 99, "group": "year"})
+    assert response.json()["achievable"] is False
+    assert response.json()["min_grade"] is None
+
+    response = client.post("/simulations/target", json={"id": ids[0], "target": 10, "group": "semester"})
+    assert response.json()["min_grade"] == 10
+
+    assert client.post("/simulations/target", json={"target": 85}).status_code == 422
+
+@patch("main.storage", new_callable=fake_storage)
+def test_conditional_get_with_etag(backend):
+    course = {
+        "course_name": "EASS",
+        "course_grade": 95,
+        "course_credit": 3.5,
+        "course_year": 2024,
+        "course_semester": "Semester A"
+    }
+    item_id = client.post("/courses/", json=course).json()["id"]
+
+    for path in ("/courses", "/courses/average-year", "/averages", "/courses/export"):
+        response = client.get(path)
+        assert response.status_code == 200
+        etag = response.headers["ETag"]
+        response = client.get(path, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.content == b""
+
+    client.put(f"/courses/{item_id}", json={**course, "course_grade": 90})
+    response = client.get("/courses", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.json()[0]["course_grade"] == 90
+
+    # Deleting a course that does not exist changes nothing
+    etag = response.headers["ETag"]
+    client.delete("/courses/missing")
+    assert client.get("/courses", headers={"If-None-Match": etag}).status_code == 304
+
+def test_packed_codec_round_trip():
+    courses = [
+        {"course_name": "EASS", "course_grade": 95, "course_credit": 3.5, "course_year": 2024, "course_semester": "Semester A"},
+        {"course_name": "מבוא למדעי המחשב", "course_grade": 0, "course_credit": 0.1, "course_year": 1999, "course_semester": "Summer"},
+    ]
+    for course in courses:
+        packed = codec.CODECS["packed"].encode(course)
+        assert len(packed) < len(codec.CODECS["json"].encode(course).encode())
+        assert codec.decode_course(packed) == course
+        assert codec.decode_course(packed.decode("utf-8", "surrogateescape")) == course
+        assert codec.decode_course(codec.CODECS["json"].encode(course)) == course
+
+def test_packed_codec_falls_back_to_json_out_of_range():
+    course = {"course_name": "EASS", "course_grade": 95, "course_credit": 3.5, "course_year": 2024, "course_semester": "Semester A"}
+    for changes in ({"course_year": 70000}, {"course_grade": 40000}, {"course_grade": -40000},
+                    {"course_semester": "x" * 256}, {"course_semester": "ש" * 128}):
+        out_of_range = {**course, **changes}
+        encoded = codec.CODECS["packed"].encode(out_of_range)
+        assert codec.detect_codec(encoded) is codec.CODECS["json"]
+        assert codec.decode_course(encoded) == out_of_range
+    assert codec.detect_codec(codec.CODECS["packed"].encode({**course, "course_semester": "x" * 255})) is codec.CODECS["packed"]
+
+@patch("main.storage", new_callable=fake_storage)
+def test_packed_codec_stores_out_of_range_courses(backend):
+    redis_client = backend.client
+    course = {"course_name": "EASS", "course_grade": 40000, "course_credit": 3.5, "course_year": 70000, "course_semester": "x" * 300}
+    with patch("codec.COURSE_CODEC", codec.CODECS["packed"]):
+        response = client.post("/courses/", json=course)
+        assert response.status_code == 200
+        item_id = response.json()["id"]
+        assert client.get(f"/courses/{item_id}").json()["course"] == course
+    # Left as JSON rather than rewritten on every recode
+    assert run(store.recode_courses(redis_client, DEFAULT_KEYSPACE, codec.CODECS["packed"])) == 0
+
+@patch("main.storage", new_callable=fake_storage)
+def test_mixed_codecs_are_readable_and_recoded(backend):
+    redis_client = backend.client
+    course = {
+        "course_name": "EASS",
+        "course_grade": 95,
+        "course_credit": 3.5,
+        "course_year": 2024,
+        "course_semester": "Semester A"
+    }
+    json_id = client.post("/courses/", json=course).json()["id"]
+    with patch("codec.COURSE_CODEC", codec.CODECS["packed"]):
+        packed_id = client.post("/courses/", json={**course, "course_grade": 85}).json()["id"]
+    assert run(redis_client.get(DEFAULT_KEYSPACE.course(json_id))).startswith("{")
+    assert not run(redis_client.get(DEFAULT_KEYSPACE.course(packed_id))).startswith("{")
+
+    assert sorted(c["course_grade"] for c in client.get("/courses").json()) == [85, 95]
+    assert client.get(f"/courses/{packed_id}").json()["course"] == {**course, "course_grade": 85}
+    assert client.delete(f"/courses/{packed_id}").status_code == 200
+    assert client.get("/averages/check").json()["consistent"]
+
+    assert run(store.recode_courses(redis_client, DEFAULT_KEYSPACE, codec.CODECS["packed"])) == 1
+    assert run(store.recode_courses(redis_client, DEFAULT_KEYSPACE, codec.CODECS["packed"])) == 0
+    assert client.get(f"/courses/{json_id}").json()["course"] == course
+
+def test_column_store_matches_dict_aggregates():
+    courses = [
+        {"course_name": str(i), "course_grade": 50 + i % 50, "course_credit": 1.0 + i % 4, "course_year": 2020 + i % 3, "course_semester": ["Semester A", "Semester B", "Summer"][i % 3 - 1]}
+        for i in range(3000)
+    ]
+    column_store = columns.ColumnStore(capacity=4)
+    for i, course in enumerate(courses):
+        column_store.put(str(i), course)
+    for i in range(0, 3000, 7):
+        column_store.remove(str(i))
+    column_store.put("5", {**courses[5], "course_grade": 100})
+    remaining = [course for i, course in enumerate(courses) if i % 7]
+    remaining[[i for i in range(3000) if i % 7].index(5)] = {**courses[5], "course_grade": 100}
+
+    def rounded(sums):
+        return {group: {key: {m: round(v, 6) for m, v in s.items()} for key, s in keys.items()} for group, keys in sums.items()}
+
+    assert rounded(column_store.group_sums()) == rounded(store.compute_aggregate_sums(remaining))
+    rows = column_store.select(["1", "2", "7", "missing"])
+    assert rounded(column_store.group_sums(rows)) == rounded(store.compute_aggregate_sums(courses[1:3]))
+
+@patch("main.storage", new_callable=fake_storage)
+def test_averages_by_ids_follow_writes_through_column_store(backend):
+    redis_client = backend.client
+    course = {"course_name": "A", "course_grade": 90, "course_credit": 2.0, "course_year": 2023, "course_semester": "Semester A"}
+    first = client.post("/courses/", json=course).json()["id"]
+    second = client.post("/courses/", json={**course, "course_grade": 60}).json()["id"]
+    params = {"ids": f"{first},{second}"}
+    assert client.get("/averages", params=params).json()["total"]["average"] == 75.0
+    loaded = storage.COLUMN_STORES.stores[DEFAULT_KEYSPACE]
+
+    # Writes through the API are applied to the loaded store in place
+    client.put(f"/courses/{second}", json={**course, "course_grade": 70})
+    assert client.get("/averages", params=params).json()["total"]["average"] == 80.0
+    client.delete(f"/courses/{first}")
+    assert client.get("/averages", params=params).json()["total"] == {"average": 70.0, "credits": 2.0, "count": 1}
+    assert storage.COLUMN_STORES.stores[DEFAULT_KEYSPACE] is loaded
+
+    # A write the app did not see (made by another process) makes it reload
+    run(redis_client.set(DEFAULT_KEYSPACE.course(second), codec.encode_course({**course, "course_grade": 40})))
+    run(redis_client.incr(DEFAULT_KEYSPACE.version))
+    assert client.get("/averages", params=params).json()["total"]["average"] == 40.0
+    assert storage.COLUMN_STORES.stores[DEFAULT_KEYSPACE] is not loaded
+
+@patch("main.storage", new_callable=fake_storage)
+def test_students_are_isolated(backend):
+    redis_client = backend.client
+    course = {"course_name": "A", "course_grade": 90, "course_credit": 2.0, "course_year": 2023, "course_semester": "Semester A"}
+    alice = client.post("/students/alice/courses/", json=course).json()["id"]
+    client.post("/students/bob/courses/batch", json=[{**course, "course_grade": 60}, {**course, "course_grade": 70}])
+    client.post("/courses/", json={**course, "course_grade": 100})
+
+    assert [c["id"] for c in client.get("/students/alice/courses").json()] == [alice]
+    assert len(client.get("/students/bob/courses").json()) == 2
+    assert client.get("/students/alice/averages/total").json()["average"] == 90.0
+    assert client.get("/students/bob/averages/total").json() == {"average": 65.0, "credits": 4.0, "count": 2}
+    assert client.get("/averages/total").json()["average"] == 100.0
+    assert client.get("/students/bob/averages", params={"ids": alice}).json()["total"]["count"] == 0
+
+    # A student's courses are not reachable from another student or the shared routes
+    assert client.get(f"/students/bob/courses/{alice}").status_code == 404
+    assert client.get(f"/courses/{alice}").status_code == 404
+    assert client.delete(f"/students/bob/courses/{alice}").status_code == 404
+    assert run(redis_client.exists(store.student_keyspace("alice").course(alice))) == 1
+
+    # Each student has their own data version
+    etag = client.get("/students/alice/courses").headers["ETag"]
+    client.post("/students/bob/courses/", json=course)
+    assert client.get("/students/alice/courses", headers={"If-None-Match": etag}).status_code == 304
+
+    assert client.get("/students/a:b/courses").status_code == 422
+    assert client.get("/students/bob/averages/check").json()["consistent"]
+
+@patch("main.storage", new_callable=fake_storage)
+def test_cohort_statistics_follow_student_writes(backend):
+    redis_client = backend.client
+    course = {"course_name": "Algorithms", "course_grade": 90, "course_credit": 2.0, "course_year": 2023, "course_semester": "Semester A"}
+    for student, grades in {"alice": [90, 80], "bob": [70], "carol": [60, 100]}.items():
+        client.post(f"/students/{student}/courses/batch", json=[{**course, "course_grade": grade} for grade in grades])
+    client.post("/courses/", json={**course, "course_grade": 0})
+
+    distribution = client.get("/cohort/courses/Algorithms/distribution").json()
+    assert distribution["count"] == 5
+    assert distribution["mean"] == 80.0
+    assert distribution["percentiles"]["50"] == 80
+    assert distribution["histogram"][100] == 1 and sum(distribution["histogram"]) == 5
+    assert client.get("/cohort/courses/Calculus/distribution").status_code == 404
+
+    # Averages: alice 85, bob 70, carol 80
+    rank = client.get("/students/alice/rank").json()
+    assert rank["average"] == 85.0 and rank["students"] == 3
+    assert rank["percentile"] == 100 * 2.5 / 3
+    assert client.get("/students/bob/rank").json()["percentile"] == 100 * 0.5 / 3
+    assert client.get("/students/dave/rank").status_code == 404
+
+    assert client.get("/cohort/averages", params={"group_by": "year"}).json()["total"]["average"] == 80.0
+    assert client.get("/cohort/average-year").json() == {"2023_Semester A": 80.0}
+
+    # Writes move the student between bins and out of the histograms
+    bob_id = client.get("/students/bob/courses").json()[0]["id"]
+    client.put(f"/students/bob/courses/{bob_id}", json={**course, "course_grade": 95})
+    assert client.get("/students/bob/rank").json()["percentile"] == 100 * 2.5 / 3
+    client.delete(f"/students/bob/courses/{bob_id}")
+    assert client.get("/students/alice/rank").json()["students"] == 2
+    assert client.get("/cohort/courses/Algorithms/distribution").json()["count"] == 4
+
+    before = {
+        "averages": client.get("/cohort/averages").json(),
+        "distribution": client.get("/cohort/courses/Algorithms/distribution").json(),
+        "rank": client.get("/students/carol/rank").json(),
+    }
+    run(redis_client.delete(store.COHORT_KEYSPACE.average_bins, store.COHORT_KEYSPACE.histogram("Algorithms")))
+    assert client.post("/cohort/rebuild").json() == before["averages"]
+    assert client.get("/cohort/courses/Algorithms/distribution").json() == before["distribution"]
+    assert client.get("/students/carol/rank").json() == before["rank"]
+
+@patch("main.storage", new_callable=fake_storage)
+def test_distribution_counts_out_of_range_grades_in_edge_bins(backend):
+    redis_client = backend.client
+    course = {"course_name": "Algorithms", "course_grade": 120, "course_credit": 2.0, "course_year": 2023, "course_semester": "Semester A"}
+    client.post("/students/alice/courses/", json=course)
+    client.post("/students/bob/courses/", json={**course, "course_grade": -5})
+    client.post("/students/carol/courses/", json={**course, "course_grade": 50})
+
+    distribution = client.get("/cohort/courses/Algorithms/distribution").json()
+    assert distribution["count"] == 3 == client.get("/cohort/averages").json()["total"]["count"]
+    assert distribution["histogram"][0] == distribution["histogram"][100] == 1
+    assert distribution["percentiles"]["90"] == 100
+    assert client.get("/students/alice/rank").json()["students"] == 3
+
+    # Fields written before grades were clamped are counted, not dropped
+    run(redis_client.hset(store.COHORT_KEYSPACE.histogram("Algorithms"), mapping={120: 2, -5: 1}))
+    assert client.get("/cohort/courses/Algorithms/distribution").json()["histogram"][100] == 3
+    assert client.post("/cohort/rebuild").status_code == 200
+    assert client.get("/cohort/courses/Algorithms/distribution").json() == distribution
+
+def test_cohort_spans_students_without_credits_and_rebuilds_under_writes():
+    async def scenario(redis_client):
+        zoe, alice = store.student_keyspace("zoe"), store.student_keyspace("alice")
+        course = {"course_name": "Algorithms", "course_grade": 90, "course_credit": 2.0, "course_year": 2023, "course_semester": "Semester A"}
+        # No credits, so no average bin, but zoe is still a student
+        await store.create_course(redis_client, zoe, "a", {**course, "course_credit": 0.0})
+        journaled = await journal.journaled_keyspaces(redis_client)
+
+        iter_courses = analytics.iter_courses
+        reads = []
+
+        async def iter_during_a_write(client, keyspace):
+            if not reads:
+                # Lands while the rebuild reads the courses
+                await store.create_course(client, alice, "b", course)
+            reads.append(keyspace.prefix)
+            async for item in iter_courses(client, keyspace):
+                yield item
+
+        with patch("analytics.iter_courses", iter_during_a_write):
+            rebuilt = await analytics.rebuild_cohort(redis_client)
+        return journaled, reads, rebuilt
+
+    journaled, reads, rebuilt = run(scenario(fake_redis()))
+    assert journaled == [store.student_keyspace("zoe")]
+    assert reads == ["grades:student:zoe", "grades:student:alice", "grades:student:zoe"]
+    assert rebuilt["total"] == {"average": 90.0, "credits": 2.0, "count": 2}
+
+def test_snapshot_and_journal_replay(tmp_path):
+    async def scenario(redis_client):
+        keyspace = store.student_keyspace("alice")
+        course = {"course_name": "EASS", "course_grade": 90, "course_credit": 2.0, "course_year": 2024, "course_semester": "Semester A"}
+        await store.create_courses(redis_client, keyspace, [("a", course), ("b", {**course, "course_year": 2023}), ("c", course)])
+        await journal.take_snapshot(redis_client, keyspace, tmp_path)
+        trimmed = await redis_client.xlen(keyspace.journal)
+        await store.update_course(redis_client, keyspace, "a", {**course, "course_grade": 60, "course_semester": "Semester B"})
+        await store.delete_course(redis_client, keyspace, "b")
+        await store.create_course(redis_client, keyspace, "d", {**course, "course_name": "Databases"})
+        journaled = await journal.journaled_keyspaces(redis_client)
+
+        replayed = await journal.load_column_store(redis_client, keyspace, tmp_path)
+        scanned = await columns.ColumnStore.load(redis_client, keyspace)
+        expected = await store.get_averages(redis_client, keyspace)
+        await redis_client.delete(keyspace.averages("year"))
+        rebuilt = await journal.rebuild_aggregates(redis_client, keyspace, tmp_path)
+
+        # Lose everything but the journal, then restore
+        courses = dict(await store.get_courses(redis_client, keyspace, ["a", "c", "d"]))
+        keys = [key async for key in redis_client.scan_iter(f"{keyspace.prefix}:*") if key != keyspace.journal]
+        await redis_client.delete(*keys)
+        restored = await journal.restore(redis_client, keyspace, tmp_path)
+        return {
+            "trimmed": trimmed,
+            "journaled": journaled,
+            "replayed": replayed,
+            "scanned": scanned,
+            "expected": expected,
+            "rebuilt": rebuilt,
+            "restored": restored,
+            "courses": courses,
+            "courses_after": dict(await store.get_courses(redis_client, keyspace, ["a", "c", "d"])),
+            "averages_after": await store.get_averages(redis_client, keyspace),
+        }
+
+    result = run(scenario(fake_redis()))
+    assert result["trimmed"] == 0
+    assert result["journaled"] == [store.student_keyspace("alice")]
+    assert sorted(result["replayed"].ids) == ["a", "c", "d"]
+    assert result["replayed"].group_sums() == result["scanned"].group_sums()
+    assert result["rebuilt"] == result["expected"]
+    assert result["restored"] == 3
+    assert result["courses_after"] == result["courses"]
+    assert result["averages_after"] == result["expected"]
+
+def test_snapshots_hold_any_grade_and_fail_per_keyspace(tmp_path):
+    async def scenario(redis_client):
+        alice = store.student_keyspace("alice")
+        course = {"course_name": "EASS", "course_grade": 40000, "course_credit": 2.0, "course_year": 2024, "course_semester": "Semester A"}
+        await store.create_course(redis_client, DEFAULT_KEYSPACE, "a", course)
+        await store.create_course(redis_client, alice, "b", {**course, "course_grade": 90})
+        await journal.take_snapshot(redis_client, DEFAULT_KEYSPACE, tmp_path)
+        snapshot = journal.read_snapshot(DEFAULT_KEYSPACE, tmp_path)
+
+        # The shared keyspace comes first; failing it still snapshots alice
+        take_snapshot = journal.take_snapshot
+
+        async def fail_shared(client, keyspace, directory):
+            if keyspace == DEFAULT_KEYSPACE:
+                raise OverflowError("cannot snapshot")
+            return await take_snapshot(client, keyspace, directory)
+
+        await store.create_course(redis_client, DEFAULT_KEYSPACE, "c", course)
+        with patch("journal.take_snapshot", fail_shared):
+            task = asyncio.create_task(journal.snapshot_periodically(redis_client, 0.01, tmp_path))
+
+            async def snapshotted():
+                while not os.path.exists(journal.snapshot_path(alice, tmp_path)):
+                    await asyncio.sleep(0.01)
+
+            await asyncio.wait_for(snapshotted(), 5)
+            task.cancel()
+        return snapshot, await redis_client.xlen(alice.journal)
+
+    snapshot, alice_journal = run(scenario(fake_redis()))
+    assert snapshot["course_grade"].tolist() == [40000]
+    assert alice_journal == 0
+
+def test_writes_publish_change_events():
+    async def follow(redis_client):
+        feed = events.ChangeFeed()
+        keyspace = store.student_keyspace("alice")
+        course = {"course_name": "EASS", "course_grade": 90, "course_credit": 2.0, "course_year": 2024, "course_semester": "Semester A"}
+        async with feed.subscribe(redis_client, keyspace.events) as queue:
+            await store.create_courses(redis_client, keyspace, [("a", course), ("b", {**course, "course_grade": 70})])
+            await store.update_course(redis_client, keyspace, "a", {**course, "course_grade": 80})
+            await store.delete_courses(redis_client, keyspace, ["b", "missing"])
+            # Other keyspaces are published on their own channels
+            await store.create_course(redis_client, DEFAULT_KEYSPACE, "c", course)
+            received = [json.loads(await asyncio.wait_for(queue.get(), 5)) for _ in range(3)]
+            averages = await store.get_averages(redis_client, keyspace)
+        await feed.close()
+        return received, averages
+
+    (created, updated, deleted), averages = run(follow(fake_redis()))
+    assert [event["version"] for event in (created, updated, deleted)] == [1, 2, 3]
+    assert [change["action"] for change in created["changes"]] == ["created", "created"]
+    assert created["averages"]["total"] == {"average": 80.0, "credits": 4.0, "count": 2}
+    assert updated["changes"] == [{"id": "a", "action": "updated", "course": {**created["changes"][0]["course"], "course_grade": 80}}]
+    assert deleted["changes"] == [{"id": "b", "action": "deleted", "course": None}]
+    assert deleted["averages"] == averages
+
+@patch("main.storage", new_callable=fake_storage)
+def test_event_stream_sends_version_then_changes(backend):
+    redis_client = backend.client
+    async def stream():
+        keyspace = store.student_keyspace("alice")
+        await store.create_course(redis_client, keyspace, "a", {"course_name": "EASS", "course_grade": 90, "course_credit": 2.0, "course_year": 2024, "course_semester": "Semester A"})
+        messages = main.event_stream(keyspace)
+        first = await anext(messages)
+        await store.delete_course(redis_client, keyspace, "a")
+        second = await asyncio.wait_for(anext(messages), 5)
+        await messages.aclose()
+        await main.storage.feed.close()
+        return first, second
+
+    first, second = run(stream())
+    assert first == 'event: version\ndata: {"version": 1}\n\n'
+    event, data = second.split("\n")[:2]
+    assert event == "event: change"
+    assert json.loads(data.removeprefix("data: "))["changes"] == [{"id": "a", "action": "deleted", "course": None}]
+    assert client.get("/students/a:b/events").status_code == 422
+
+@patch("main.storage", new_callable=fake_storage)
+def test_requests_are_logged_as_json_records(backend):
+    stream = io.StringIO()
+    listener = logs.configure_logging(level="DEBUG", stream=stream)
+    try:
+        course = {"course_name": "EASS", "course_grade": 95, "course_credit": 3.5, "course_year": 2024, "course_semester": "Semester A"}
+        item_id = client.post("/students/alice/courses/", json=course).json()["id"]
+        client.get(f"/students/alice/courses/{item_id}")
+        # Path parameter values that equal a literal segment or hold escapes
+        client.get("/students/courses/courses/")
+        client.get("/students/courses/courses/a%20b")
+    finally:
+        listener.stop()
+        logs.logger.handlers.clear()
+        logs.logger.propagate = True
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+
+    # Payloads are not logged unless LOG_PAYLOADS is set
+    assert [record["message"] for record in records] == ["request"] * 4
+    create, read, listed, escaped = records
+    assert create["route"] == "/students/{student_id}/courses/"
+    assert create["method"] == "POST" and create["status"] == 200
+    assert create["request_bytes"] > 0
+    assert read["route"] == "/students/{student_id}/courses/{item_id}"
+    assert read["response_bytes"] > 0 and read["latency_ms"] >= 0
+    assert isinstance(read["redis_calls"], int)
+    assert listed["route"] == "/students/{student_id}/courses/"
+    assert escaped["route"] == "/students/{student_id}/courses/{item_id}"
+
+def test_request_log_middleware_is_outermost():
+    # The last middleware added is the first to see a request
+    assert [middleware.cls for middleware in app.user_middleware[:2]] == [logs.RequestLogMiddleware, metrics.ProfileMiddleware]
+
+def test_log_sampling_keeps_warnings():
+    sampler = logs.SamplingFilter(0.0)
+    assert not sampler.filter(logging.makeLogRecord({"levelno": logging.INFO}))
+    assert sampler.filter(logging.makeLogRecord({"levelno": logging.ERROR}))
+
+@patch("main.storage", new_callable=fake_storage)
+def test_metrics_endpoint_reports_routes_and_caches(backend):
+    course = {"course_name": "EASS", "course_grade": 95, "course_credit": 3.5, "course_year": 2024, "course_semester": "Semester A"}
+    item_id = client.post("/courses/", json=course).json()["id"]
+    etag = client.get("/averages").headers["ETag"]
+    client.get("/averages", headers={"If-None-Match": etag})
+    client.get("/averages", params={"ids": item_id})
+    client.get("/averages", params={"ids": item_id})
+
+    response = client.get("/metrics")
+    assert response.headers["content-type"].startswith("text/plain")
+    lines = response.text.splitlines()
+    assert "# TYPE http_request_duration_seconds histogram" in lines
+    assert any(line.startswith('http_requests_total{method="POST",route="/courses/",status="200"}') for line in lines)
+    assert any(line.startswith('http_request_duration_seconds_bucket{method="GET",route="/averages",le="+Inf"}') for line in lines)
+    assert any(line.startswith('cache_requests_total{cache="etag",result="hit"}') for line in lines)
+    assert any(line.startswith('cache_requests_total{cache="column_store",result="hit"}') for line in lines)
+
+def test_instrumented_redis_counts_commands_and_pipelines():
+    redis_client = metrics.InstrumentedRedis(connection_pool=fake_redis().connection_pool)
+    before = dict(metrics.REDIS_COMMANDS.values)
+    course = {"course_name": "EASS", "course_grade": 95, "course_credit": 3.5, "course_year": 2024, "course_semester": "Semester A"}
+    run(store.create_course(redis_client, DEFAULT_KEYSPACE, "a", course))
+    run(store.update_course(redis_client, DEFAULT_KEYSPACE, "a", {**course, "course_grade": 90}))
+    assert run(store.get_course(redis_client, DEFAULT_KEYSPACE, "a"))["course_grade"] == 90
+
+    def added(command):
+        return metrics.REDIS_COMMANDS.values.get((command,), 0) - before.get((command,), 0)
+
+    assert added("SET") == 2 and added("WATCH") == 1 and added("MGET") == 1 and added("GET") == 1
+    assert metrics.REDIS_LATENCY.values[("MULTI",)][1] > 0
+
+@patch("main.storage", new_callable=fake_storage)
+def test_profile_mode_is_opt_in(backend):
+    assert client.get("/averages", params={"profile": "1"}).json()["total"]["count"] == 0
+    with patch("metrics.PROFILING_ENABLED", True):
+        response = client.get("/averages", params={"profile": "1"})
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "cumulative" in response.text and "get_averages" in response.text
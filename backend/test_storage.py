@@ -0,0 +1,303 @@
+"""Conformance tests every storage backend passes, through its methods and through the API."""
+import asyncio
+import json
+import threading
+from unittest.mock import patch
+
+import fakeredis
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+import sqlite_store
+import storage
+import store
+from store import COHORT_KEYSPACE, DEFAULT_KEYSPACE, student_keyspace
+
+client = TestClient(main.app)
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+@pytest.fixture(params=["redis", "sqlite"])
+def backend(request, tmp_path):
+    storage.COLUMN_STORES.clear()
+    if request.param == "redis":
+        backend = storage.RedisStorage(fakeredis.FakeAsyncRedis(**store.CLIENT_OPTIONS))
+    else:
+        backend = sqlite_store.SQLiteStorage(str(tmp_path / "grades.db"))
+    yield backend
+    run(backend.close())
+
+
+def course(name="Algorithms", grade=90, credit=2.0, year=2024, semester="Semester A"):
+    return {"course_name": name, "course_grade": grade, "course_credit": credit,
+            "course_year": year, "course_semester": semester}
+
+
+def transcript():
+    # Ids out of order, so reads have to sort them
+    return [
+        (f"c{i:02}", course(f"Course {i % 4}", 50 + i, 1.0 + i % 3, 2022 + i % 3, "Semester A" if i % 2 else "Semester B"))
+        for i in (7, 3, 11, 0, 9, 5, 1, 10, 2, 8, 6, 4)
+    ]
+
+
+def test_write_and_read_courses(backend):
+    async def scenario():
+        keyspace = student_keyspace("alice")
+        versions = [await backend.get_version(keyspace)]
+        await backend.create_courses(keyspace, [("a", course()), ("b", course(grade=70))])
+        versions.append(await backend.get_version(keyspace))
+        statuses = await backend.update_courses(keyspace, [("a", course(grade=80)), ("c", course(name="Databases"))])
+        versions.append(await backend.get_version(keyspace))
+        deleted = await backend.delete_courses(keyspace, ["b", "missing"])
+        versions.append(await backend.get_version(keyspace))
+        # Deleting nothing is not a write
+        await backend.delete_courses(keyspace, ["missing"])
+        versions.append(await backend.get_version(keyspace))
+        with pytest.raises(ValueError):
+            await backend.update_courses(keyspace, [("a", course()), ("a", course())])
+        return {
+            "versions": versions,
+            "statuses": statuses,
+            "deleted": deleted,
+            "a": await backend.get_course(keyspace, "a"),
+            "b": await backend.get_course(keyspace, "b"),
+            "courses": await backend.get_courses(keyspace, ["c", "missing", "a"]),
+            "shared": await backend.get_course(DEFAULT_KEYSPACE, "a"),
+        }
+
+    result = run(scenario())
+    assert result["versions"] == [0, 1, 2, 3, 3]
+    assert result["statuses"] == ["updated", "created"]
+    assert result["deleted"] == [True, False]
+    assert result["a"] == course(grade=80)
+    assert result["b"] is None
+    assert result["courses"] == [("c", course(name="Databases")), ("a", course(grade=80))]
+    assert result["shared"] is None
+
+
+def test_chunks_and_pages_follow_id_order_and_filters(backend):
+    items = transcript()
+    expected = sorted(items)
+
+    async def scenario():
+        await backend.create_courses(DEFAULT_KEYSPACE, items)
+        chunks = [chunk async for chunk in backend.iter_course_chunks(DEFAULT_KEYSPACE, chunk_size=5)]
+        by_year = [item async for chunk in backend.iter_course_chunks(DEFAULT_KEYSPACE, course_year=2023, chunk_size=2) for item in chunk]
+        by_both = [item async for chunk in backend.iter_course_chunks(DEFAULT_KEYSPACE, 2024, "Semester B") for item in chunk]
+        after = [item async for chunk in backend.iter_course_chunks(DEFAULT_KEYSPACE, after="c05") for item in chunk]
+        pages, cursor = [], None
+        while True:
+            page, cursor = await backend.get_course_page(
+                DEFAULT_KEYSPACE, course_semester="Semester A", limit=2, after=cursor,
+                predicate=lambda course: course["course_grade"] >= 53,
+            )
+            pages.append(page)
+            if cursor is None:
+                return chunks, by_year, by_both, after, pages
+
+    chunks, by_year, by_both, after, pages = run(scenario())
+    assert [len(chunk) for chunk in chunks] == [5, 5, 2]
+    assert [item for chunk in chunks for item in chunk] == expected
+    assert by_year == [item for item in expected if item[1]["course_year"] == 2023]
+    assert by_both == [item for item in expected if item[1]["course_year"] == 2024 and item[1]["course_semester"] == "Semester B"]
+    assert after == [item for item in expected if item[0] > "c05"]
+    assert [item_id for page in pages for item_id, _ in page] == ["c03", "c05", "c07", "c09", "c11"]
+    assert [len(page) for page in pages] == [2, 2, 1]
+
+
+def test_aggregates_match_a_recomputation(backend):
+    items = transcript()
+    expected = store.compute_aggregate_sums(course for _, course in items)
+
+    async def scenario():
+        await backend.create_courses(DEFAULT_KEYSPACE, items)
+        return {
+            "sums": await backend.read_aggregate_sums(DEFAULT_KEYSPACE),
+            "averages": await backend.get_averages(DEFAULT_KEYSPACE),
+            "year_only": await backend.get_averages(DEFAULT_KEYSPACE, ["year"]),
+            "selected": await backend.get_averages(DEFAULT_KEYSPACE, item_ids=["c01", "c02", "missing"]),
+            "groups": [
+                await backend.get_group_average(DEFAULT_KEYSPACE, group, key)
+                for group, key in (("total", "all"), ("year", "2023"), ("semester", "Semester B"), ("year_semester", "2024_Semester A"))
+            ],
+            "empty": await backend.get_group_average(DEFAULT_KEYSPACE, "year", "1999"),
+            "drift": await backend.check_aggregates(DEFAULT_KEYSPACE),
+            "rebuilt": await backend.rebuild_aggregates(DEFAULT_KEYSPACE),
+        }
+
+    result = run(scenario())
+    assert result["sums"] == expected
+    assert result["averages"] == store.format_averages(expected)
+    assert result["year_only"] == store.format_averages(expected, ["year"])
+    assert result["selected"] == store.format_averages(store.compute_aggregate_sums([dict(items)["c01"], dict(items)["c02"]]))
+    assert result["groups"] == [
+        result["averages"]["total"],
+        result["averages"]["year"]["2023"],
+        result["averages"]["semester"]["Semester B"],
+        result["averages"]["year_semester"]["2024_Semester A"],
+    ]
+    assert result["empty"] is None
+    assert result["drift"] == []
+    assert result["rebuilt"] == result["averages"]
+
+
+def test_cohort_statistics_span_every_student(backend):
+    async def scenario():
+        await backend.create_courses(student_keyspace("alice"), [("a", course(grade=90)), ("b", course("Databases", 70))])
+        await backend.create_courses(student_keyspace("bob"), [("a", course(grade=60))])
+        await backend.create_courses(student_keyspace("carol"), [("a", course(grade=80)), ("b", course("Databases", 80))])
+        # The shared collection is not part of the cohort
+        await backend.create_courses(DEFAULT_KEYSPACE, [("a", course(grade=10))])
+        await backend.delete_courses(student_keyspace("carol"), ["b"])
+        return {
+            "averages": await backend.get_averages(COHORT_KEYSPACE, ["semester"]),
+            "distribution": await backend.grade_distribution("Algorithms"),
+            "databases": await backend.grade_distribution("Databases"),
+            "unknown": await backend.grade_distribution("Unknown"),
+            "ranks": [await backend.average_rank(student_keyspace(name)) for name in ("alice", "bob", "carol", "dave")],
+            "rebuilt": await backend.rebuild_cohort(),
+        }
+
+    result = run(scenario())
+    assert result["averages"]["total"] == {"average": 75.0, "credits": 8.0, "count": 4}
+    assert result["averages"]["semester"] == {"Semester A": result["averages"]["total"]}
+    assert result["distribution"]["count"] == 3
+    assert result["distribution"]["mean"] == pytest.approx(230 / 3)
+    assert result["distribution"]["percentiles"] == {"10": 60, "25": 60, "50": 80, "75": 90, "90": 90}
+    assert result["databases"]["histogram"][70] == 1 and result["databases"]["count"] == 1
+    assert result["unknown"] is None
+    alice, bob, carol, dave = result["ranks"]
+    # Alice and Carol share the 80.0 bin, above Bob
+    assert (alice["average"], alice["percentile"], alice["students"]) == (80.0, pytest.approx(200 / 3), 3)
+    assert (bob["average"], bob["percentile"]) == (60.0, pytest.approx(100 / 6))
+    assert carol["percentile"] == alice["percentile"]
+    assert dave is None
+    assert result["rebuilt"] == run(backend.get_averages(COHORT_KEYSPACE))
+
+
+def test_subscribers_receive_every_write(backend):
+    async def follow():
+        keyspace = student_keyspace("alice")
+        async with backend.subscribe(keyspace) as queue:
+            await backend.create_courses(keyspace, [("a", course()), ("b", course(grade=70))])
+            await backend.update_courses(keyspace, [("a", course(grade=80))])
+            await backend.delete_courses(keyspace, ["b", "missing"])
+            await backend.create_courses(DEFAULT_KEYSPACE, [("c", course())])
+            received = [json.loads(await asyncio.wait_for(queue.get(), 5)) for _ in range(3)]
+            averages = await backend.get_averages(keyspace)
+        # The feed belongs to this event loop
+        await backend.feed.close()
+        return received, averages, queue.empty()
+
+    (created, updated, deleted), averages, drained = run(follow())
+    assert [event["version"] for event in (created, updated, deleted)] == [1, 2, 3]
+    assert created["changes"] == [
+        {"id": "a", "action": "created", "course": course()},
+        {"id": "b", "action": "created", "course": course(grade=70)},
+    ]
+    assert created["averages"]["total"] == {"average": 80.0, "credits": 4.0, "count": 2}
+    assert updated["changes"] == [{"id": "a", "action": "updated", "course": course(grade=80)}]
+    assert deleted["changes"] == [{"id": "b", "action": "deleted", "course": None}]
+    assert deleted["averages"] == averages
+    assert drained
+
+
+def test_empty_batches_change_nothing(backend):
+    async def scenario():
+        await backend.create_courses(DEFAULT_KEYSPACE, [("a", course())])
+        version = await backend.get_version(DEFAULT_KEYSPACE)
+        await backend.create_courses(DEFAULT_KEYSPACE, [])
+        results = [await backend.update_courses(DEFAULT_KEYSPACE, []), await backend.delete_courses(DEFAULT_KEYSPACE, [])]
+        return version, await backend.get_version(DEFAULT_KEYSPACE), results
+
+    version, after, results = run(scenario())
+    # The version is the ETag of every read: an empty batch keeps them valid
+    assert after == version == 1
+    assert results == [[], []]
+
+
+def test_api_serves_the_same_responses(backend):
+    with patch("main.storage", backend):
+        created = client.post("/students/alice/courses/batch", json=[course(), course("Databases", 70, 3.0, 2023, "Semester B")]).json()
+        first, second = [result["id"] for result in created["results"]]
+        client.post("/students/bob/courses/", json=course(grade=60))
+
+        listed = client.get("/students/alice/courses", params={"course_year": 2023})
+        assert [item["id"] for item in listed.json()] == [second]
+        assert client.get("/students/alice/courses", headers={"If-None-Match": listed.headers["ETag"]}).status_code == 304
+        page = client.get("/students/alice/courses", params={"limit": 1})
+        assert page.json()[0]["id"] == min(first, second)
+        assert client.get(f"/students/alice/courses/{first}").json() == {"course": course()}
+
+        assert client.get("/students/alice/averages/total").json() == {"average": 78.0, "credits": 5.0, "count": 2}
+        assert client.get("/students/alice/averages/year/2023").json()["average"] == 70.0
+        assert client.get("/students/alice/averages/year/1999").status_code == 404
+        assert client.get("/students/alice/averages", params={"ids": first}).json()["total"]["average"] == 90.0
+        assert client.get("/students/alice/averages", params={"ids": f"{first},{second},{first}"}).json()["total"] == {"average": 78.0, "credits": 5.0, "count": 2}
+        assert client.get("/students/alice/courses/average-year").json() == {"2023_Semester B": 70.0, "2024_Semester A": 90.0}
+        simulated = client.post("/students/alice/simulations", json={"overrides": [{"id": second, "course_grade": 100}]})
+        assert simulated.json()["total"]["average"] == 96.0
+        assert client.get("/students/alice/averages/total").json()["average"] == 78.0
+
+        assert client.get("/students/alice/rank").json()["percentile"] == 75.0
+        assert client.get("/cohort/averages").json()["total"]["count"] == 3
+        assert client.get("/cohort/courses/Algorithms/distribution").json()["count"] == 2
+        assert client.get("/students/alice/averages/check").json() == {"consistent": True, "drift": []}
+
+        assert client.put(f"/students/alice/courses/{second}", json=course(grade=80)).json() == {"update": "success"}
+        assert client.delete(f"/students/alice/courses/{first}").status_code == 200
+        assert client.delete(f"/students/alice/courses/{first}").status_code == 404
+        exported = client.get("/students/alice/courses/export").text.splitlines()
+        assert [json.loads(line) for line in exported] == [{**course(grade=80), "id": second}]
+
+
+def test_sqlite_writes_do_not_aggregate_the_keyspace(tmp_path):
+    backend = sqlite_store.SQLiteStorage(str(tmp_path / "grades.db"))
+    statements = []
+
+    async def scenario():
+        await backend.create_courses(DEFAULT_KEYSPACE, transcript())
+        backend.db.set_trace_callback(statements.append)
+        await backend.create_courses(DEFAULT_KEYSPACE, [("new", course())])
+        await backend.update_courses(DEFAULT_KEYSPACE, [("c01", course(grade=40))])
+        await backend.delete_courses(DEFAULT_KEYSPACE, ["c02"])
+        backend.db.set_trace_callback(None)
+        await backend.close()
+
+    run(scenario())
+    assert statements and not [statement for statement in statements if "SUM(" in statement]
+
+
+def test_sqlite_streams_outlive_another_unsubscribing(tmp_path):
+    backend = sqlite_store.SQLiteStorage(str(tmp_path / "grades.db"))
+    alice, bob = student_keyspace("alice"), student_keyspace("bob")
+    reading, left = threading.Event(), threading.Event()
+    read = backend.feed._read
+
+    def read_slowly(prefix, after):
+        # Hold the poller on alice's log until bob's stream has gone
+        if prefix == alice.prefix and bob.prefix in backend.feed.queues and not left.is_set():
+            reading.set()
+            left.wait(5)
+        return read(prefix, after)
+
+    async def scenario():
+        with patch.object(backend.feed, "_read", read_slowly):
+            async with backend.subscribe(alice) as queue:
+                async with backend.subscribe(bob):
+                    await asyncio.to_thread(reading.wait, 5)
+                left.set()
+                await backend.create_courses(alice, [("a", course())])
+                event = json.loads(await asyncio.wait_for(queue.get(), 5))
+                polling = not backend.feed.poller.done()
+        await backend.close()
+        return event, polling
+
+    event, polling = run(scenario())
+    assert polling
+    assert event["changes"] == [{"id": "a", "action": "created", "course": course()}]
@@ -0,0 +1,39 @@
+import io
+
+import pytest
+
+pytest.importorskip("streamlit")
+
+import ui
+
+
+class Upload(io.BytesIO):
+    # What st.file_uploader returns, as far as the importer uses it
+    def __init__(self, name, data):
+        super().__init__(data)
+        self.name = name
+        self.size = len(data)
+
+
+def transcript(*rows):
+    return Upload("transcript.csv", "\n".join([",".join(ui.COURSE_FIELDS), *rows]).encode())
+
+
+def test_rows_longer_than_the_header_are_reported():
+    uploaded = transcript("EASS,90,3,2024,A", "Databases,80,3,2024,A,extra", "Algorithms,70,2,2023,B")
+    results = [ui.validate_courses(chunk) for chunk, _ in ui.iter_transcript_chunks(uploaded)]
+    courses = [row for valid, _ in results for row in valid["row"]]
+    errors = [error for _, chunk_errors in results for error in chunk_errors]
+    assert courses == [2, 4]
+    assert errors == [(3, "row has more cells than the header")]
+
+
+def test_infinite_grades_and_credits_are_rejected():
+    uploaded = transcript("EASS,90,inf,2024,A", "Databases,inf,3,2024,A", "Algorithms,70,2,2023,B")
+    (chunk, _), = ui.iter_transcript_chunks(uploaded)
+    valid, errors = ui.validate_courses(chunk)
+    assert valid["row"].tolist() == [4]
+    assert errors == [
+        (2, "course credit is not a number of at least 0"),
+        (3, "course grade is not a whole number from 0 to 100"),
+    ]
@@ -1,24 +1,61 @@
+import io
 import json
 import streamlit as st
 import requests
 from requests.exceptions import RequestException
 import time
 from datetime import datetime
+import numpy as np
 import pandas as pd
 import matplotlib
-import matplotlib.pyplot as plt
-import redis
+from matplotlib.figure import Figure
 import base64
-from collections import defaultdict
+import threading
+from collections import defaultdict, deque
 
 
 
 # Backend URL
 BACKEND_URL = "http://backend:8080"
 
+# Number of courses shown per page in the course table
+COURSES_PAGE_SIZE = 50
+
+# Rows parsed per chunk of an imported transcript, and courses per batch
+# request; only one chunk of the file is held in memory at a time
+IMPORT_CHUNK_ROWS = 5000
+IMPORT_BATCH_SIZE = 500
+# Bad rows listed on the page (all of them can be downloaded)
+IMPORT_ERRORS_SHOWN = 200
+# Stands in for the cells of a transcript row longer than the header, so
+# the row is reported as skipped instead of ending the import
+EXTRA_CELLS_ROW = "\x00extra cells"
+SEMESTERS = ["Semester A", "Semester B", "Semester C"]
+COURSE_FIELDS = ["course_name", "course_grade", "course_credit", "course_year", "course_semester"]
+
+# Seconds a fetched snapshot is reused before the backend is asked whether
+# it changed (a conditional request that costs little when nothing did)
+SNAPSHOT_TTL = 5
+
+# While the backend's change events are followed (see ChangeListener),
+# snapshots are patched with the changes instead. The last CHANGE_LOG_SIZE
+# events are kept for that; a snapshot older than them is fetched again.
+CHANGE_LOG_SIZE = 200
+# Seconds to wait for the event of this session's own write, the read
+# timeout of the event stream (the backend sends keepalives every 15 s),
+# the pause before reconnecting, and how long a listener nobody uses lives
+CHANGE_WAIT = 1.0
+CHANGE_READ_TIMEOUT = 45
+CHANGE_RETRY = 5
+CHANGE_LISTENER_IDLE = 600
+
 current_year = datetime.now().year
 
-r = redis.Redis(host="redis", port=6379, db=0)
+def api_url():
+    # Courses are kept per student when a student id is entered in the
+    # sidebar, otherwise in the shared collection
+    student_id = st.session_state.get("student_id")
+    return f"{BACKEND_URL}/students/{student_id}" if student_id else BACKEND_URL
 
 
 
@@ -49,24 +86,38 @@ def create_course():
         }
 
         try:
-            response = requests.post(f"{BACKEND_URL}/courses/", json=data)
+            response = requests.post(f"{api_url()}/courses/", json=data)
             response.raise_for_status()  # Raise an exception for HTTP errors
+            invalidate_snapshots()
             st.success(f"Successfully added course: {course_name}")
         except requests.exceptions.RequestException as e:
             st.error(f"Failed to add course. Error: {e}")
 
 def view_course():
     st.header("View Course")
-    courses = get_all_courses()
+
+    # Cursors of the pages visited so far; the last one is the page on screen
+    name_prefix = st.text_input("Search by course name")
+    if st.session_state.get("view_search") != name_prefix:
+        st.session_state["view_search"] = name_prefix
+        st.session_state["view_cursors"] = [None]
+    cursors = st.session_state["view_cursors"]
+    courses, next_cursor = get_courses_page(cursors[-1], name_prefix=name_prefix or None)
 
     if not courses:
         st.write("No courses available.")
         return
 
-    # Display data table with all courses
+    # Display data table with the courses of the current page
     df = pd.DataFrame(courses)
     st.dataframe(df)
 
+    col1, col2 = st.columns(2)
+    with col1:
+        st.button("Previous page", disabled=len(cursors) == 1, on_click=cursors.pop)
+    with col2:
+        st.button("Next page", disabled=next_cursor is None, on_click=cursors.append, args=(next_cursor,))
+
     selected_course_name = st.selectbox("Select Course", [""] + [course["course_name"] for course in courses])
     selected_course_data = next((course for course in courses if course["course_name"] == selected_course_name), None)
 
@@ -127,29 +178,21 @@ def simulate_grade_change():
 
             if st.button("Simulate Grade Change"):
                 try:
-                    # Store the previous grade
-                    prev_grade = selected_course_data["course_grade"]
-
-                    # Calculate the previous averages
-                    prev_avg_all_courses, prev_avg_by_semester, prev_avg_by_year = calculate_previous_averages(courses)
-
-                    # Update the grade to the new grade
-                    selected_course_data["course_grade"] = new_grade
+                    # Averages for every candidate grade of the selected course in one call
+                    group_sums = get_group_sums()
+                    curves = simulate_grade_sweep(group_sums, [selected_course_data])
 
-                    # Recalculate the averages with the new grade
-                    updated_avg_all_courses, updated_avg_by_semester, updated_avg_by_year = calculate_updated_averages(courses)
-
-                    # Calculate the differences
-                    diff_avg_all_courses = updated_avg_all_courses - prev_avg_all_courses
-                    diff_avg_by_semester = {key: updated_avg_by_semester[key] - prev_avg_by_semester[key] for key in prev_avg_by_semester}
-                    diff_avg_by_year = {key: updated_avg_by_year[key] - prev_avg_by_year[key] for key in prev_avg_by_year}
+                    # Previous averages come straight from the group sums
+                    aspects = ["Total Average", selected_course_data['course_year'], selected_course_data['course_semester']]
+                    prev_averages = [group_average(group_sums, scope, key) for scope, key in simulated_groups(selected_course_data)]
+                    new_averages = [curves[scope][0, new_grade] for scope in SIMULATED_SCOPES]
 
                     # Create a DataFrame for the results
                     data = {
-                        "Aspect": ["Total Average", selected_course_data['course_year'], selected_course_data['course_semester']],
-                        "Previous Average": [prev_avg_all_courses, prev_avg_by_year[selected_course_data['course_year']], prev_avg_by_semester[selected_course_data['course_semester']]],
-                        "New Average": [updated_avg_all_courses, updated_avg_by_year[selected_course_data['course_year']], updated_avg_by_semester[selected_course_data['course_semester']]],
-                        "Difference": [diff_avg_all_courses, diff_avg_by_year[selected_course_data['course_year']], diff_avg_by_semester[selected_course_data['course_semester']]]
+                        "Aspect": aspects,
+                        "Previous Average": prev_averages,
+                        "New Average": new_averages,
+                        "Difference": [new - prev for new, prev in zip(new_averages, prev_averages)]
                     }
                     df = pd.DataFrame(data)
                     
@@ -164,17 +207,71 @@ def simulate_grade_change():
                     # Display the table
                     st.subheader("Grade Change Summary")
                     st.table(df.style.applymap(color_negative_red, subset=['Difference']))
-                    
-                    # Reset the grade back to its original value
-                    selected_course_data["course_grade"] = prev_grade
+
+                    # Display the what-if curve for every possible grade
+                    st.subheader("Averages for Every Possible Grade")
+                    st.line_chart(pd.DataFrame(
+                        {str(aspect): curves[scope][0] for aspect, scope in zip(aspects, SIMULATED_SCOPES)},
+                        index=pd.Index(SIMULATED_GRADES, name="Course Grade")
+                    ))
                     
                 except Exception as e:
                     st.error(f"Failed to simulate grade change. Error: {e}")
+
+            st.subheader("Reach A Target Average")
+            target = st.number_input("Target total average", min_value=0.0, max_value=100.0, step=0.5, value=85.0)
+            if st.button("Find Minimum Grade"):
+                result = solve_target_grade(selected_course_data["id"], target)
+                if result is None:
+                    pass
+                elif result["achievable"]:
+                    st.success(f"A grade of at least {result['min_grade']} in {selected_course_data['course_name']} reaches a total average of {target:.2f}.")
+                else:
+                    st.warning(f"A total average of {target:.2f} cannot be reached by changing {selected_course_data['course_name']} alone.")
         else:
             st.error("No course selected.")
 
 
 
+def import_courses():
+    st.subheader("Import A Transcript")
+    st.write(f"Upload a CSV or Excel (.xlsx) file with the columns {', '.join(COURSE_FIELDS)}. "
+             "Rows with problems are skipped and listed below; the rest are added.")
+    uploaded_file = st.file_uploader("Transcript", type=["csv", "xlsx"])
+    if uploaded_file is None or not st.button("Import Courses"):
+        return
+
+    progress = st.progress(0.0, text="Importing...")
+    imported, bad_rows = 0, []
+    try:
+        for chunk, done in iter_transcript_chunks(uploaded_file):
+            courses, chunk_errors = validate_courses(chunk)
+            bad_rows += chunk_errors
+            for start in range(0, len(courses), IMPORT_BATCH_SIZE):
+                batch = courses.iloc[start:start + IMPORT_BATCH_SIZE]
+                try:
+                    response = requests.post(f"{api_url()}/courses/batch", json=batch[COURSE_FIELDS].to_dict("records"))
+                    response.raise_for_status()
+                    imported += len(batch)
+                except RequestException as e:
+                    bad_rows += [(row, f"Not saved: {e}") for row in batch["row"]]
+            progress.progress(done, text=f"Imported {imported} courses, skipped {len(bad_rows)} rows")
+    except ValueError as e:
+        # Courses of the rows before the damage are saved already
+        st.error(f"Cannot read the rest of the file: {e}")
+    finally:
+        invalidate_snapshots()
+
+    progress.progress(1.0, text=f"Imported {imported} courses, skipped {len(bad_rows)} rows")
+    if imported:
+        st.success(f"Successfully imported {imported} courses")
+    if bad_rows:
+        st.warning(f"{len(bad_rows)} rows were skipped")
+        errors = pd.DataFrame(bad_rows, columns=["row", "problem"])
+        st.dataframe(errors.head(IMPORT_ERRORS_SHOWN), hide_index=True)
+        st.download_button("Download Skipped Rows", errors.to_csv(index=False), file_name="skipped_rows.csv")
+
+
 # VIEW FUNCTION
 
 def print_course(courses, selected_course_name):
@@ -229,8 +326,9 @@ def update_course(courses, selected_course_name):
                 }
 
                 
-                response = requests.put(f"{BACKEND_URL}/courses/{selected_course['id']}", json=data)
+                response = requests.put(f"{api_url()}/courses/{selected_course['id']}", json=data)
                 response.raise_for_status()  # Raise an exception for HTTP errors
+                invalidate_snapshots()
                 st.success("Course updated successfully!")
             except requests.exceptions.RequestException as e:
                 st.error(f"Failed to update course. Error: {e}")
@@ -243,8 +341,9 @@ def delete_course(courses, selected_course_name):
             if selected_course:
                 # Delete the course
                 try:
-                    response = requests.delete(f"{BACKEND_URL}/courses/{selected_course['id']}")
+                    response = requests.delete(f"{api_url()}/courses/{selected_course['id']}")
                     response.raise_for_status()  # Raise an exception for HTTP errors
+                    invalidate_snapshots()
                     st.success("Successfully deleted course.")
                 except requests.exceptions.RequestException as e:
                     st.error(f"Failed to delete course. Error: {e}")
@@ -256,284 +355,533 @@ def delete_course(courses, selected_course_name):
 # AVERAGE CALCULATOR FUNCTIONS:
 
 def calculate_weighted_average_for_all_courses():
-    # Get all courses from the backend
-    courses = get_all_courses()
+    # Get the weighted average of all courses from the backend
+    total = get_averages(group_by=["total"])["total"]
     # Check if courses exist
-    if courses:
-        # Convert courses data to DataFrame
-        df = pd.DataFrame(courses)
-        # Check if course_credit column exists
-        if 'course_credit' in df.columns:
-            # Display table
+    if total["count"]:
+        # Display weighted average and total credits
+        st.write(f"Your weighted average is: {total['average']:.2f}")
+        st.write(f"Your total credits is: {total['credits']:.2f}")
+
+        # The course table is only downloaded when asked for
+        if st.checkbox("Show all course details"):
             st.write("All Course Details:")
-            st.write(df)
-            
-            # Calculate weighted average and total credits
-            total_weighted_score = (df['course_grade'] * df['course_credit']).sum()
-            total_credits = df['course_credit'].sum()
-            weighted_average = total_weighted_score / total_credits if total_credits > 0 else 0
-            
-            # Display weighted average and total credits
-            st.write(f"Your weighted average is: {weighted_average:.2f}")
-            st.write(f"Your total credits is: {total_credits:.2f}")
-        else:
-            st.write("No course credit information available for any course.")
+            st.write(pd.DataFrame(get_all_courses()))
     else:
         st.write("No courses available.")
 
 def calculate_weighted_average_by_semester():
-    # Get all courses from the backend
-    courses = get_all_courses()
+    # Get the semester averages from the backend
+    averages = get_averages(group_by=["semester"])
     # Check if courses exist
-    if courses:
-        # Convert courses data to DataFrame
-        df = pd.DataFrame(courses)
-        # Check if course_credit column exists
-        if 'course_credit' in df.columns:
-            # Group courses by year
-            year_groups = df.groupby('course_year')
-            for year, year_df in year_groups:
-                st.subheader(f"Year: {year}")
-                year_semester_groups = year_df.groupby('course_semester')
-                for semester, semester_df in year_semester_groups:
-                    st.subheader(f"Semester: {semester}")
-                    st.write(semester_df)
-                    total_weighted_score = (semester_df['course_grade'] * semester_df['course_credit']).sum()
-                    total_credits = semester_df['course_credit'].sum()
-                    weighted_average = total_weighted_score / total_credits if total_credits > 0 else 0
-                    st.write(f"Weighted average for {semester}: {weighted_average:.2f}")
-
-                # Calculate and display the yearly summary
-                st.subheader(f"Yearly Summary for {year}")
-                total_year_weighted_score = (year_df['course_grade'] * year_df['course_credit']).sum()
-                total_year_credits = year_df['course_credit'].sum()
-                year_weighted_average = total_year_weighted_score / total_year_credits if total_year_credits > 0 else 0
-                st.write(f"Total weighted average for {year}: {year_weighted_average:.2f}")
-                st.write(f"Total credits for {year}: {total_year_credits:.2f}")
-                
-                # Plot average grade by semester for the current year
-                plot_average_grade_by_semester(year, year_df)
-
-        else:
-            st.write("No course credit information available for any course.")
+    if averages["total"]["count"]:
+        for semester, semester_average in averages["semester"].items():
+            st.subheader(f"Semester: {semester}")
+            st.write(f"Weighted average for {semester}: {semester_average['average']:.2f}")
+            st.write(f"Total credits: {semester_average['credits']:.2f}")
     else:
         st.write("No courses available.")
     
 def calculate_weighted_average_by_year_semester():
-    # Get all courses from the backend
-    courses = get_all_courses()
+    # Get the yearly and semester averages from the backend
+    averages = get_averages(group_by=["year", "year_semester"])
     # Check if courses exist
-    if courses:
-        # Convert courses data to DataFrame
-        df = pd.DataFrame(courses)
-        # Check if course_credit column exists
-        if 'course_credit' in df.columns:
-            # Group courses by year
-            year_groups = df.groupby('course_year')
-            for year, year_df in year_groups:
-                # Display year header
-                st.subheader(f"Year: {year}")
-
-                # Group courses by semester within the year
-                semester_groups = year_df.groupby('course_semester')
-                semester_averages = {}  # Store semester averages for plotting
-                for semester, semester_df in semester_groups:
-                    # Display semester subheader
-                    st.subheader(f"{semester} - {year}")
-
-                    # Display courses for this semester
-                    st.write(semester_df)
-
-                    # Calculate weighted average and total credits for this semester
-                    total_weighted_score = (semester_df['course_grade'] * semester_df['course_credit']).sum()
-                    total_credits = semester_df['course_credit'].sum()
-                    weighted_average = total_weighted_score / total_credits if total_credits > 0 else 0
-
-                    # Display semester summary
-                    st.write(f"Weighted average for {semester}: {weighted_average:.2f}")
-                    st.write(f"Total credits: {total_credits:.2f}")
-
-                    # Store semester average for plotting
-                    semester_averages[semester] = weighted_average
-
-                # Yearly summary
-                yearly_total_weighted_score = (year_df['course_grade'] * year_df['course_credit']).sum()
-                yearly_total_credits = year_df['course_credit'].sum()
-                yearly_weighted_average = yearly_total_weighted_score / yearly_total_credits if yearly_total_credits > 0 else 0
-                st.subheader(f"Year {year} Summary")
-                st.write(f"Yearly weighted average: {yearly_weighted_average:.2f}")
-                st.write(f"Total credits: {yearly_total_credits:.2f}")
-
-
-        else:
-            st.write("No course credit information available for any course.")
+    if averages["total"]["count"]:
+        show_courses = st.checkbox("Show the courses of each semester")
+        # Group semesters by year
+        for year, year_average in sorted(averages["year"].items(), key=lambda item: int(item[0])):
+            # Display year header
+            st.subheader(f"Year: {year}")
+
+            for year_semester, semester_average in averages["year_semester"].items():
+                semester_year, semester = year_semester.split("_", 1)
+                if semester_year != year:
+                    continue
+                # Display semester subheader
+                st.subheader(f"{semester} - {year}")
+
+                # Display courses for this semester
+                if show_courses:
+                    st.write(pd.DataFrame(get_all_courses(course_year=year, course_semester=semester)))
+
+                # Display semester summary
+                st.write(f"Weighted average for {semester}: {semester_average['average']:.2f}")
+                st.write(f"Total credits: {semester_average['credits']:.2f}")
+
+            # Yearly summary
+            st.subheader(f"Year {year} Summary")
+            st.write(f"Yearly weighted average: {year_average['average']:.2f}")
+            st.write(f"Total credits: {year_average['credits']:.2f}")
     else:
         st.write("No courses available.")
 
 def calculate_weighted_average_for_selected_courses():
-    # Get all courses from the backend
+    # Get all courses from the backend to offer them for selection
     courses = get_all_courses()
     # Check if courses exist
     if courses:
-        # Convert courses data to DataFrame
-        df = pd.DataFrame(courses)
         # Display a selection box to choose courses
-        selected_courses = st.multiselect("Select courses", df['course_name'].unique())
+        selected_courses = st.multiselect("Select courses", sorted({course["course_name"] for course in courses}))
         if selected_courses:
-            # Filter DataFrame to include only selected courses
-            selected_df = df[df['course_name'].isin(selected_courses)]
-            if 'course_credit' in selected_df.columns:
-                # Display table of selected courses
-                st.write("Selected Courses:")
-                st.write(selected_df)
-                # Calculate weighted average and total credits for selected courses
-                total_weighted_score = (selected_df['course_grade'] * selected_df['course_credit']).sum()
-                total_credits = selected_df['course_credit'].sum()
-                weighted_average = total_weighted_score / total_credits if total_credits > 0 else 0
-                st.write(f"Weighted average for selected courses: {weighted_average:.2f}")
-            else:
-                st.write("No course credit information available for any selected course.")
+            # Let the backend compute the average of the selected courses only
+            selected_ids = [course["id"] for course in courses if course["course_name"] in selected_courses]
+            total = get_averages(group_by=["total"], ids=selected_ids)["total"]
+            st.write(f"Weighted average for selected courses: {total['average']:.2f}")
+            st.write(f"Total credits for selected courses: {total['credits']:.2f}")
         else:
             st.write("No courses selected.")
     else:
         st.write("No courses available.")
 
 def calculate_weighted_average_by_year():
-    courses = r.keys()
-    year_grades_credits = {}
-    
-    for key in courses:
-        course_data = json.loads(r.get(key))
-        year = course_data["course_year"]
-        grade = course_data["course_grade"]
-        credit = course_data["course_credit"]
-        
-        if year not in year_grades_credits:
-            year_grades_credits[year] = {"total_grade_credit": 0, "total_credits": 0}
-            
-        year_grades_credits[year]["total_grade_credit"] += grade * credit
-        year_grades_credits[year]["total_credits"] += credit
-    
-    average_grades_by_year = {}
-    
-    for year, data in year_grades_credits.items():
-        if data["total_credits"] > 0:
-            average_grade = data["total_grade_credit"] / data["total_credits"]
-            average_grades_by_year[year] = average_grade
-            
-    return average_grades_by_year
+    averages = get_averages(group_by=["year"])
+    return {int(year): year_average["average"] for year, year_average in averages["year"].items()}
 
 
 # SIMULATOR FUNCTIONS:
 
-def calculate_previous_averages(courses):
-    # Convert courses data to DataFrame
-    df = pd.DataFrame(courses)
-    
-    # Calculate previous average for all courses
-    total_weighted_score_all = (df['course_grade'] * df['course_credit']).sum()
-    total_credits_all = df['course_credit'].sum()
-    prev_avg_all_courses = total_weighted_score_all / total_credits_all if total_credits_all > 0 else 0
-    
-    # Group courses by semester
-    semester_groups = df.groupby('course_semester')
-    prev_avg_by_semester = {}
-    for semester, semester_df in semester_groups:
-        total_weighted_score = (semester_df['course_grade'] * semester_df['course_credit']).sum()
-        total_credits = semester_df['course_credit'].sum()
-        prev_avg_by_semester[semester] = total_weighted_score / total_credits if total_credits > 0 else 0
-    
-    # Group courses by year
-    year_groups = df.groupby('course_year')
-    prev_avg_by_year = {}
-    for year, year_df in year_groups:
-        total_weighted_score = (year_df['course_grade'] * year_df['course_credit']).sum()
-        total_credits = year_df['course_credit'].sum()
-        prev_avg_by_year[year] = total_weighted_score / total_credits if total_credits > 0 else 0
-    
-    return prev_avg_all_courses, prev_avg_by_semester, prev_avg_by_year
+# Averages affected by a grade change and every grade a course can get
+SIMULATED_SCOPES = ("total", "year", "semester")
+SIMULATED_GRADES = np.arange(101)
+
+def simulated_groups(course):
+    # (scope, group key) of every average the course contributes to
+    return [("total", "all"), ("year", str(course["course_year"])), ("semester", course["course_semester"])]
+
+def get_group_sums():
+    # Sum of grade x credit and sum of credits per group, from the backend aggregates
+    averages = get_averages(group_by=["year", "semester"])
+    group_sums = {"total": {"all": (averages["total"]["average"] * averages["total"]["credits"], averages["total"]["credits"])}}
+    for scope in ("year", "semester"):
+        group_sums[scope] = {key: (stats["average"] * stats["credits"], stats["credits"]) for key, stats in averages[scope].items()}
+    return group_sums
+
+def group_average(group_sums, scope, key):
+    weighted, credits = group_sums[scope][key]
+    return weighted / credits if credits > 0 else 0
+
+def simulate_grade_sweep(group_sums, courses, grades=SIMULATED_GRADES):
+    # Changing a course from grade g0 to g moves its groups' weighted sum by
+    # credit * (g - g0), so every (course, grade) pair is evaluated at once
+    # by broadcasting. Returns {scope: array of shape (len(courses), len(grades))}.
+    grades = np.asarray(grades, dtype=float)[np.newaxis, :]
+    credit = np.array([course["course_credit"] for course in courses], dtype=float)[:, np.newaxis]
+    current = np.array([course["course_grade"] for course in courses], dtype=float)[:, np.newaxis]
+    delta = credit * (grades - current)
+
+    curves = {}
+    for i, scope in enumerate(SIMULATED_SCOPES):
+        sums = np.array([group_sums[scope][simulated_groups(course)[i][1]] for course in courses], dtype=float)
+        weighted, credits = sums[:, 0:1], sums[:, 1:2]
+        curves[scope] = np.divide(weighted + delta, credits, out=np.zeros_like(delta), where=credits > 0)
+    return curves
+
+
+
+# IMPORT FUNCTIONS:
+
+def iter_transcript_chunks(uploaded_file):
+    # Yield (DataFrame of up to IMPORT_CHUNK_ROWS string cells, fraction of
+    # the file read). A "row" column holds each row's line in the file and
+    # "extra_cells" flags rows with more cells than the header.
+    if uploaded_file.name.lower().endswith(".xlsx"):
+        chunks = iter_xlsx_chunks(uploaded_file)
+    else:
+        # The python parser passes rows with too many cells to on_bad_lines
+        # (the C parser can only skip them or fail)
+        chunks = pd.read_csv(uploaded_file, dtype=str, keep_default_na=False, skipinitialspace=True, chunksize=IMPORT_CHUNK_ROWS,
+                             engine="python", on_bad_lines=lambda cells: [EXTRA_CELLS_ROW])
+    first_row = 2  # Row 1 is the header
+    for chunk in chunks:
+        extra_cells = (chunk.iloc[:, 0] == EXTRA_CELLS_ROW).to_numpy()
+        chunk.columns = [str(column).strip().lower() for column in chunk.columns]
+        missing = [field for field in COURSE_FIELDS if field not in chunk.columns]
+        if missing:
+            raise ValueError(f"missing columns: {', '.join(missing)}")
+        chunk["row"] = np.arange(first_row, first_row + len(chunk))
+        chunk["extra_cells"] = extra_cells
+        first_row += len(chunk)
+        yield chunk, min(uploaded_file.tell() / max(uploaded_file.size, 1), 1.0)
+
+def iter_xlsx_chunks(uploaded_file):
+    # A damaged workbook fails with zipfile, XML or openpyxl errors; they
+    # are raised as ValueError, as a damaged CSV file's are
+    from zipfile import BadZipFile
+    from openpyxl.utils.exceptions import InvalidFileException
 
-def calculate_updated_averages(courses):
-    # Convert courses data to DataFrame
-    df = pd.DataFrame(courses)
-    
-    # Calculate updated average for all courses
-    total_weighted_score_all = (df['course_grade'] * df['course_credit']).sum()
-    total_credits_all = df['course_credit'].sum()
-    updated_avg_all_courses = total_weighted_score_all / total_credits_all if total_credits_all > 0 else 0
-    
-    # Group courses by semester
-    semester_groups = df.groupby('course_semester')
-    updated_avg_by_semester = {}
-    for semester, semester_df in semester_groups:
-        total_weighted_score = (semester_df['course_grade'] * semester_df['course_credit']).sum()
-        total_credits = semester_df['course_credit'].sum()
-        updated_avg_by_semester[semester] = total_weighted_score / total_credits if total_credits > 0 else 0
-    
-    # Group courses by year
-    year_groups = df.groupby('course_year')
-    updated_avg_by_year = {}
-    for year, year_df in year_groups:
-        total_weighted_score = (year_df['course_grade'] * year_df['course_credit']).sum()
-        total_credits = year_df['course_credit'].sum()
-        updated_avg_by_year[year] = total_weighted_score / total_credits if total_credits > 0 else 0
-    
-    return updated_avg_all_courses, updated_avg_by_semester, updated_avg_by_year
+    try:
+        yield from read_xlsx_chunks(uploaded_file)
+    except (BadZipFile, InvalidFileException, SyntaxError, KeyError, EOFError, OSError) as e:
+        raise ValueError(f"not a readable .xlsx workbook ({e})") from e
+
+def read_xlsx_chunks(uploaded_file):
+    # openpyxl's read-only mode streams the rows instead of loading the sheet
+    import openpyxl
 
+    workbook = openpyxl.load_workbook(uploaded_file, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = ["" if cell is None else str(cell) for cell in header]
+        chunk = []
+        for row in rows:
+            cells = ["" if cell is None else str(cell) for cell in row]
+            if any(cells[len(columns):]):
+                cells = [EXTRA_CELLS_ROW]
+            # Short rows are padded, as the CSV parser does
+            chunk.append((cells + [""] * len(columns))[:len(columns)])
+            if len(chunk) == IMPORT_CHUNK_ROWS:
+                yield pd.DataFrame(chunk, columns=columns)
+                chunk = []
+        if chunk:
+            yield pd.DataFrame(chunk, columns=columns)
+    finally:
+        workbook.close()
+
+def validate_courses(chunk):
+    # Check every rule on whole columns at once. Returns the valid courses
+    # (typed, with their "row") and a (row, problem) pair per bad row.
+    names = chunk["course_name"].astype(str).str.strip()
+    grades = pd.to_numeric(chunk["course_grade"], errors="coerce")
+    credits = pd.to_numeric(chunk["course_credit"], errors="coerce")
+    years = pd.to_numeric(chunk["course_year"], errors="coerce")
+    semesters = chunk["course_semester"].astype(str).str.strip()
+    # "A", "b" and "semester c" are accepted as well
+    semesters = semesters.str.replace(r"(?i)^(semester\s*)?([abc])$", lambda m: f"Semester {m.group(2).upper()}", regex=True)
+
+    problems = pd.DataFrame({
+        "course name is empty": names == "",
+        "course grade is not a whole number from 0 to 100": ~(np.isfinite(grades) & grades.between(0, 100) & (grades % 1 == 0)),
+        # An infinite credit would fail the JSON of its whole batch
+        "course credit is not a number of at least 0": ~(np.isfinite(credits) & (credits >= 0)),
+        "course year is not a whole number": ~((years > 0) & (years % 1 == 0)),
+        "course semester is not Semester A, B or C": ~semesters.isin(SEMESTERS),
+    })
+    # A row longer than the header has no cells to check
+    extra_cells = chunk["extra_cells"].to_numpy()
+    problems.loc[extra_cells] = False
+    problems["row has more cells than the header"] = extra_cells
+    bad = problems.any(axis=1)
+    errors = [
+        (row, "; ".join(problems.columns[flags]))
+        for row, flags in zip(chunk["row"][bad], problems[bad].to_numpy())
+    ]
+    valid = pd.DataFrame({
+        "row": chunk["row"],
+        "course_name": names,
+        "course_grade": grades,
+        "course_credit": credits,
+        "course_year": years,
+        "course_semester": semesters,
+    })[~bad].astype({"course_grade": int, "course_credit": float, "course_year": int})
+    return valid, errors
 
 
 # GENERAL FUNCTIONS
 
-def get_all_courses():
+def get_snapshot(key, fetch):
+    # Reuse this session's copy of the data if it is fresh enough. Once it is
+    # older than SNAPSHOT_TTL, fetch(headers) is called with If-None-Match set
+    # to the copy's ETag and returns None when the backend answers 304, so an
+    # unchanged copy is kept without downloading it again. Otherwise fetch
+    # returns (data, etag). Only successful fetches are stored, so errors are
+    # retried next time.
+    #
+    # While the change listener is connected, a snapshot is instead brought
+    # up to date with the change events since its version, and only fetched
+    # again if some of them are missing or it cannot be patched.
+    snapshots = st.session_state.setdefault("snapshots", {})
+    snapshot = snapshots.get(key)
+    if snapshot is not None:
+        listener = get_change_listener()
+        version = etag_version(snapshot["etag"])
+        if listener.connected and version is not None:
+            changes = listener.since(version)
+            data = patch_snapshot(key, snapshot["data"], changes) if changes is not None else STALE
+            if data is not STALE:
+                if changes:
+                    snapshot.update(data=data, etag=f'W/"{changes[-1]["version"]}"')
+                snapshot["fetched_at"] = time.monotonic()
+                return data
+        elif time.monotonic() - snapshot["fetched_at"] < SNAPSHOT_TTL:
+            return snapshot["data"]
+    headers = {"If-None-Match": snapshot["etag"]} if snapshot is not None and snapshot["etag"] else {}
+    result = fetch(headers)
+    if result is None:
+        snapshot["fetched_at"] = time.monotonic()
+        return snapshot["data"]
+    data, etag = result
+    snapshots[key] = {"data": data, "etag": etag, "fetched_at": time.monotonic()}
+    return data
+
+def get_snapshot_etag(key):
+    # Data version of a stored snapshot, or None if the backend sent none
+    snapshot = st.session_state.get("snapshots", {}).get(key)
+    return snapshot["etag"] if snapshot is not None else None
+
+def invalidate_snapshots():
+    # Called after every change so the next render sees fresh data. While
+    # the change listener is connected it is enough to wait for the change's
+    # event, which then patches the snapshots.
+    versions = [etag_version(snapshot["etag"]) for snapshot in st.session_state.get("snapshots", {}).values()]
+    versions = [version for version in versions if version is not None]
+    if not versions or not get_change_listener().wait_past(max(versions), CHANGE_WAIT):
+        clear_snapshots()
+
+def clear_snapshots():
+    st.session_state["snapshots"] = {}
+
+def iter_courses(response):
+    # Parse the NDJSON export line by line as it arrives
+    for line in response.iter_lines():
+        if line:
+            yield json.loads(line)
+
+def fetch_courses(filters, headers):
+    params = {"format": "ndjson", **filters}
+    with requests.get(f"{api_url()}/courses/export", params=params, headers=headers, stream=True) as response:
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        return list(iter_courses(response)), response.headers.get("ETag")
+
+def fetch_averages(ids, headers):
+    params = {"ids": ",".join(ids)} if ids is not None else {}
+    response = requests.get(f"{api_url()}/averages", params=params, headers=headers)
+    if response.status_code == 304:
+        return None
+    response.raise_for_status()
+    return response.json(), response.headers.get("ETag")
+
+def get_averages(group_by=None, ids=None):
+    # Weighted averages and credit totals computed by the backend. Every
+    # group is fetched at once so all views of a render share one request.
+    key = ("averages", tuple(ids) if ids is not None else None)
     try:
-        response = requests.get(f"{BACKEND_URL}/courses")
+        averages = get_snapshot(key, lambda headers: fetch_averages(ids, headers))
+        return {group: stats for group, stats in averages.items() if group_by is None or group == "total" or group in group_by}
+    except RequestException as e:
+        st.error(f"Failed to fetch averages: {e}")
+        return {"total": {"average": 0, "credits": 0, "count": 0}, "year": {}, "semester": {}, "year_semester": {}}
+
+def solve_target_grade(course_id, target, group="total"):
+    # Lowest grade in the course that brings the group average to the target
+    try:
+        response = requests.post(f"{api_url()}/simulations/target", json={"id": course_id, "target": target, "group": group})
         response.raise_for_status()
         return response.json()
+    except RequestException as e:
+        st.error(f"Failed to solve for the target average: {e}")
+        return None
+
+def get_courses_page(cursor=None, **filters):
+    params = {"limit": COURSES_PAGE_SIZE, **{key: value for key, value in filters.items() if value is not None}}
+    if cursor:
+        params["cursor"] = cursor
+
+    def fetch(headers):
+        response = requests.get(f"{api_url()}/courses", params=params, headers=headers)
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        return (response.json(), response.headers.get("X-Next-Cursor")), response.headers.get("ETag")
+
+    try:
+        return get_snapshot(("courses_page", tuple(sorted(params.items()))), fetch)
+    except RequestException as e:
+        st.error(f"Failed to fetch courses: {e}")
+        return [], None
+
+def get_all_courses(**filters):
+    try:
+        return get_snapshot(("courses", tuple(sorted(filters.items()))), lambda headers: fetch_courses(filters, headers))
     except RequestException as e:
         st.error(f"Failed to fetch courses: {e}")
         return []
 
-def plot_average_grade_by_semester():
-    # Get all courses from the backend
-    courses = get_all_courses()
-    # Check if courses exist
-    if courses:
-        # Convert courses data to DataFrame
-        df = pd.DataFrame(courses)
-        # Check if course_credit column exists
-        if 'course_credit' in df.columns:
-            # Create a new column combining year and semester
-            df['year_semester'] = df['course_year'].astype(str) + '_' + df['course_semester']
-
-            # Group courses by year and semester and calculate weighted average
-            year_semester_groups = df.groupby('year_semester')
-            averages = {}  # Store averages for each year and semester pair
-            for year_semester, year_semester_df in year_semester_groups:
-                total_weighted_score = (year_semester_df['course_grade'] * year_semester_df['course_credit']).sum()
-                total_credits = year_semester_df['course_credit'].sum()
-                weighted_average = total_weighted_score / total_credits if total_credits > 0 else 0
-                averages[year_semester] = weighted_average
-
-            # Sort the keys of the averages dictionary by year and then by semester
-            sorted_keys = sorted(averages.keys(), key=lambda x: (int(x.split('_')[0]), x.split('_')[1]))
-            sorted_averages = {key: averages[key] for key in sorted_keys}
-
-            # Plotting the line graph
-            if sorted_averages:  # Check if there are any averages to plot
-                plt.figure(figsize=(10, 6))
-                plt.plot(list(sorted_averages.keys()), list(sorted_averages.values()), marker='o', linestyle='-')
-                plt.title('Weighted Average by Year and Semester')
-                plt.xlabel('Year-Semester')
-                plt.ylabel('Weighted Average')
-                plt.xticks(rotation=45)
-                plt.tight_layout()
-                st.pyplot(plt)
-            else:
-                st.write("No data available to plot.")
+# CHANGE EVENTS
+
+# Returned by patch_snapshot for snapshots the changes cannot be applied to
+STALE = object()
+
+class ChangeListener:
+    # Follows the backend's change events (GET /events) of one course
+    # collection in a background thread. One listener is shared by all the
+    # sessions of this process; it keeps the latest events so every session
+    # can bring its own snapshots up to date.
+
+    def __init__(self, url):
+        self.url = url
+        self.condition = threading.Condition()
+        self.log = deque(maxlen=CHANGE_LOG_SIZE)
+        # Backend data version as of the last event, None if unknown
+        self.latest = None
+        self.connected = False
+        self.last_used = time.monotonic()
+        self.thread = threading.Thread(target=self.run, name=f"changes {url}", daemon=True)
+        self.thread.start()
+
+    def running(self):
+        return self.thread.is_alive()
+
+    def idle(self):
+        return time.monotonic() - self.last_used > CHANGE_LISTENER_IDLE
+
+    def run(self):
+        while not self.idle():
+            try:
+                with requests.get(self.url, stream=True, timeout=(5, CHANGE_READ_TIMEOUT)) as response:
+                    response.raise_for_status()
+                    for event, data in iter_events(response):
+                        if self.idle():
+                            return
+                        if event is not None:
+                            self.receive(event, json.loads(data))
+            except (RequestException, ValueError):
+                pass
+            finally:
+                with self.condition:
+                    self.connected = False
+            time.sleep(CHANGE_RETRY)
+
+    def receive(self, event, data):
+        with self.condition:
+            if event == "version":
+                # Sent on every (re)connection: events in between may be lost
+                if data["version"] != self.latest:
+                    self.log.clear()
+                self.latest = data["version"]
+                self.connected = True
+            elif event == "change":
+                # Writes publish their events after committing, so two close
+                # together can arrive out of order; a late one is dropped and
+                # the gap it leaves makes older snapshots refetch
+                if self.latest is not None and data["version"] <= self.latest:
+                    return
+                if self.latest is None or data["version"] != self.latest + 1:
+                    self.log.clear()
+                self.log.append(data)
+                self.latest = data["version"]
+            elif event == "reset":
+                self.log.clear()
+                self.latest = None
+            self.condition.notify_all()
+
+    def since(self, version):
+        # The events after version in order, or None if some are missing
+        with self.condition:
+            self.last_used = time.monotonic()
+            if self.latest is None:
+                return None
+            if version >= self.latest:
+                return []
+            changes = [event for event in self.log if event["version"] > version]
+            if not changes or changes[0]["version"] != version + 1:
+                return None
+            return changes
+
+    def wait_past(self, version, timeout):
+        # Wait for an event newer than version; False on timeout or if not connected
+        with self.condition:
+            self.last_used = time.monotonic()
+            return self.connected and self.condition.wait_for(
+                lambda: self.latest is not None and self.latest > version, timeout
+            )
+
+@st.cache_resource(show_spinner=False, validate=lambda listener: listener.running())
+def change_listener(url):
+    return ChangeListener(url)
+
+def get_change_listener():
+    return change_listener(f"{api_url()}/events")
+
+def iter_events(response):
+    # Parse a Server-Sent Events stream into (event, data) pairs; comments
+    # (the keepalives) come out as (None, None)
+    response.encoding = "utf-8"
+    event, data = "message", []
+    for line in response.iter_lines(decode_unicode=True):
+        if not line:
+            if data:
+                yield event, "\n".join(data)
+            event, data = "message", []
+        elif line.startswith(":"):
+            yield None, None
         else:
-            st.write("No course credit information available for any course.")
+            name, _, value = line.partition(":")
+            value = value.removeprefix(" ")
+            if name == "event":
+                event = value
+            elif name == "data":
+                data.append(value)
+
+def etag_version(etag):
+    # The backend's ETags are its data version, as W/"<version>"
+    try:
+        return int(etag.removeprefix("W/").strip('"'))
+    except (AttributeError, ValueError):
+        return None
+
+def patch_snapshot(key, data, changes):
+    # Apply change events to a snapshot's data, or return STALE if they
+    # cannot be applied to it
+    kind, params = key
+    if kind == "averages" and params is None:
+        return changes[-1]["averages"] if changes else data
+    if kind == "averages":
+        changed_ids = {change["id"] for event in changes for change in event["changes"]}
+        return STALE if changed_ids.intersection(params) else data
+    if kind == "courses":
+        filters = dict(params)
+        courses = {course["id"]: course for course in data}
+        for event in changes:
+            for change in event["changes"]:
+                courses.pop(change["id"], None)
+                course = change["course"]
+                if course is not None and all(str(course[name]) == str(value) for name, value in filters.items()):
+                    courses[change["id"]] = {**course, "id": change["id"]}
+        # In id order, like the export
+        return [courses[item_id] for item_id in sorted(courses)]
+    # Pages would shift: fetch them again
+    return STALE if any(event["changes"] for event in changes) else data
+
+def render_average_chart(averages):
+    # Draw on an explicit Figure (not the global pyplot state) and return PNG bytes
+    fig = Figure(figsize=(10, 6))
+    ax = fig.subplots()
+    ax.plot(list(averages.keys()), list(averages.values()), marker='o', linestyle='-')
+    ax.set_title('Weighted Average by Year and Semester')
+    ax.set_xlabel('Year-Semester')
+    ax.set_ylabel('Weighted Average')
+    ax.tick_params(axis='x', labelrotation=45)
+    fig.tight_layout()
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png")
+    return buffer.getvalue()
+
+@st.cache_data(max_entries=16)
+def cached_average_chart(student_id, version, _averages):
+    # Keyed by the student and their backend data version only (arguments
+    # starting with an underscore are not hashed), so unchanged data reuses
+    # the rendered PNG
+    return render_average_chart(_averages)
+
+def plot_average_grade_by_semester():
+    # Get the year and semester averages from the backend
+    averages = get_averages(group_by=["year_semester"])["year_semester"]
+
+    # Sort the keys of the averages dictionary by year and then by semester
+    sorted_keys = sorted(averages.keys(), key=lambda x: (int(x.split('_')[0]), x.split('_')[1]))
+    sorted_averages = {key: averages[key]["average"] for key in sorted_keys}
+
+    # Plotting the line graph
+    if sorted_averages:  # Check if there are any averages to plot
+        version = get_snapshot_etag(("averages", None)) or json.dumps(sorted_averages)
+        st.image(cached_average_chart(st.session_state.get("student_id"), version, sorted_averages))
     else:
-        st.write("No courses available.")
+        st.write("No data available to plot.")
 
 def home():
     st.image(r"mylogo.png", width=400)
@@ -552,13 +900,22 @@ def home():
 def main():
     st.sidebar.image(r"mylogo.png", width=250)
 
-    menu = ["Home", "Create", "View/ Update/ Delete", "Calculate Average", "Simulate Grade Change"]
+    student_id = st.sidebar.text_input("Student ID", help="Leave empty to use the shared course list").strip()
+    if student_id != st.session_state.get("student_id", ""):
+        # Another student's data: nothing fetched so far applies
+        st.session_state["student_id"] = student_id
+        st.session_state["view_cursors"] = [None]
+        clear_snapshots()
+
+    menu = ["Home", "Create", "Import", "View/ Update/ Delete", "Calculate Average", "Simulate Grade Change"]
     choice = st.sidebar.selectbox("Menu", menu)
 
     if choice == "Home":
         home()
     elif choice == "Create":
         create_course()
+    elif choice == "Import":
+        import_courses()
     elif choice == "View/ Update/ Delete":
         view_course()
     elif choice == "Calculate Average":